@@ -0,0 +1,165 @@
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.linalg import lsqr
+
+from ChunkedMosaic import ChunkedMosaic
+from GlobalSettings import GlobalSettings
+from MosaicCanvas import MosaicCanvas
+import registration
+import utils
+
+
+class AlignmentGraph:
+    """Deferred stitching. Tiles are recorded with their stage position, every neighbouring pair is registered
+    (including the redundant ones between rows, not just one per row), and the (y, x) position and z offset of all tiles
+    are solved together by sparse least squares before compositing once. A bad pair only loses an edge instead of
+    needing the tile taken again, and errors don't pile up row after row.
+    Tile keys are (i, j) grid indices like TilePlan's: i along x (right), j along y (down)"""
+
+    settings = GlobalSettings()
+    overlap = settings.get("PIC_OVERLAP")
+    acceptableCross = 20  # [px] off the seam's axis, like Row.acceptableDy and AreaMap.acceptableDx
+    priorWeight = 0.01  # of the stage position, per edge. Only places tiles no edge reaches
+    outlierPx = 3.0  # edges off by more after the first solve are dropped
+    upsample = 1  # sub-pixel seams (1/upsample px), the solve and composite handle fractional offsets
+
+    def __init__(self, pxSize, calibration=None):
+        self.pxSize = pxSize
+        self.calibration = calibration  # StageCalibration for the priors
+        self.tiles = {}  # key: pic
+        self.stagePos = {}  # key: (x, y) [um]
+        self.edges = []  # (keyA, keyB, (dy, dx) of B's top left from A's [px], zDiff to add to B to match A)
+        self.pos = {}  # solved key: (y, x) [px] of the tile's top left
+        self.zOffset = {}  # solved key: z added to the tile [um]
+
+    def addTile(self, key, pic, stagePos):
+        self.tiles[key] = pic
+        self.stagePos[key] = np.array(stagePos[:2], float)
+
+    def prior(self, key):
+        """(y, x) [px] from the stage position, relative to the first tile (utils.stageToPx)"""
+        first = next(iter(self.stagePos.values()))
+        return utils.stageToPx(self.stagePos[key] - first, self.pxSize, self.calibration)
+
+    @staticmethod
+    def register(picA, picB, vertical, overlap=None):
+        """Registers the seam of B to the right of (or below) A over overlap (PIC_OVERLAP) px, like
+        Row.addToStitch/AreaMap.getShift.
+        Returns ((dy, dx) of B's top left from A's, zDiff to add to B) or None if the fit is off the seam or the strips are
+        mostly off the lens"""
+        ov = overlap or AlignmentGraph.overlap
+        shift, _, zDiff = registration.registerSeam(picA, picB, vertical, ov, AlignmentGraph.upsample)
+        return AlignmentGraph.toEdge(shift, zDiff, vertical, picA.shape, ov)
+
+    @staticmethod
+    def toEdge(shift, zDiff, vertical, picShape, overlap):
+        """(offset, zDiff) from a registration.registerSeam result, or None if it's off the seam or NaN"""
+        if np.isnan(shift).any() or abs(shift[1 if vertical else 0]) > AlignmentGraph.acceptableCross:
+            return None
+        nominal = np.array((picShape[0] - overlap, 0)) if vertical else np.array((0, picShape[1] - overlap))
+        return nominal + shift, zDiff
+
+    def pairs(self):
+        """(keyA, keyB, vertical) for every recorded tile and its right and lower neighbour"""
+        return [
+            (key, (key[0] + di, key[1] + dj), vertical)
+            for key in self.tiles
+            for di, dj, vertical in ((1, 0, False), (0, 1, True))
+            if (key[0] + di, key[1] + dj) in self.tiles
+        ]
+
+    def jobs(self, keys, overlap, picShape):
+        """registration.registerBatch jobs of every pair, keys: the tiles' order. Each is searched around the shift the
+        stage positions predict"""
+        index = {key: n for n, key in enumerate(keys)}
+        jobs = []
+        for keyA, keyB, vertical in self.pairs():
+            nominal = np.array((picShape[0] - overlap, 0)) if vertical else np.array((0, picShape[1] - overlap))
+            prior = self.prior(keyB) - self.prior(keyA) - nominal
+            jobs.append((index[keyA], index[keyB], vertical, overlap, prior))
+        return jobs
+
+    def addEdge(self, keyA, keyB, offset, zDiff):
+        self.edges.append((keyA, keyB, np.asarray(offset, float), float(zDiff)))
+
+    def measure(self, overlap=None, workers=1):
+        """Registers every neighbouring pair, across workers processes (registration.registerBatch) if more than 1.
+        Returns how many pairs couldn't be"""
+        ov = overlap or AlignmentGraph.overlap
+        pairs = self.pairs()
+        keys = list(self.tiles)
+        jobs = self.jobs(keys, ov, self.tiles[keys[0]].shape)
+        shifts, _, zDiffs = registration.registerBatch(
+            [self.tiles[key] for key in keys], jobs, workers, AlignmentGraph.upsample
+        )
+        failed = 0
+        for (keyA, keyB, vertical), shift, zDiff in zip(pairs, shifts, zDiffs):
+            result = AlignmentGraph.toEdge(shift, zDiff, vertical, self.tiles[keyA].shape, ov)
+            if result is None:
+                failed += 1
+                continue
+            self.addEdge(keyA, keyB, *result)
+        print(f"Registered {len(self.edges)} seams, {failed} failed")
+        return failed
+
+    def solveAxis(self, keys, edges, values, priors, priorWeight):
+        """Least squares of v[B] - v[A] = value per edge, and v = prior with priorWeight"""
+        index = {key: n for n, key in enumerate(keys)}
+        n, m = len(keys), len(edges)
+        rows = np.repeat(np.arange(m), 2)
+        cols = np.array([(index[a], index[b]) for a, b in edges], int).ravel()
+        vals = np.tile((-1.0, 1.0), m)
+        A = sp.vstack(
+            (sp.csr_matrix((vals, (rows, cols)), shape=(m, n)), priorWeight * sp.identity(n, format="csr"))
+        )
+        b = np.concatenate((values, priorWeight * np.asarray(priors, float)))
+        return lsqr(A, b, atol=1e-10, btol=1e-10)[0]
+
+    def solve(self):
+        """Solves every tile's position and z offset, drops edges further than outlierPx from the solution and solves
+        again. Returns the max residual [px] of the kept edges"""
+        keys = list(self.tiles)
+        priors = np.array([self.prior(key) for key in keys])
+        for attempt in range(2):
+            pairs = [(a, b) for a, b, _, _ in self.edges]
+            offsets = np.array([offset for _, _, offset, _ in self.edges]).reshape(-1, 2)
+            y = self.solveAxis(keys, pairs, offsets[:, 0], priors[:, 0], AlignmentGraph.priorWeight)
+            x = self.solveAxis(keys, pairs, offsets[:, 1], priors[:, 1], AlignmentGraph.priorWeight)
+            self.pos = {key: np.array((y[n], x[n])) for n, key in enumerate(keys)}
+            resids = np.array([np.hypot(*(self.pos[b] - self.pos[a] - offset)) for a, b, offset, _ in self.edges])
+            if attempt == 0 and np.any(resids > AlignmentGraph.outlierPx):
+                print(f"Dropping {np.count_nonzero(resids > AlignmentGraph.outlierPx)} inconsistent seams")
+                self.edges = [e for e, r in zip(self.edges, resids) if r <= AlignmentGraph.outlierPx]
+                continue
+            break
+
+        # z is anchored by the prior of no offset
+        zDiffs = np.array([zDiff for _, _, _, zDiff in self.edges])
+        z = self.solveAxis(keys, pairs, zDiffs, np.zeros(len(keys)), AlignmentGraph.priorWeight)
+        self.zOffset = {key: z[n] for n, key in enumerate(keys)}
+        maxResid = resids.max() if len(resids) else 0.0
+        print(f"Solved {len(keys)} tiles from {len(self.edges)} seams, max residual {maxResid:.2f}px")
+        return maxResid
+
+    def composite(self, keys=None):
+        """ChunkedMosaic of the solved tiles (all by default). Each row is stitched left to right, then the rows top to
+        bottom, so every blend is across one seam like Row and AreaMap's"""
+        keys = sorted(keys if keys is not None else self.tiles, key=lambda k: (k[1], k[0]))
+        mosaic = None
+        for j in sorted({key[1] for key in keys}):
+            rowKeys = [key for key in keys if key[1] == j]
+            row, rowOrigin = None, None  # rowOrigin: solved (y, x) of the row canvas' top left
+            for key in rowKeys:
+                pic = self.tiles[key] + self.zOffset[key]
+                pos = np.round(self.pos[key]).astype(int)
+                if row is None:
+                    row, rowOrigin = MosaicCanvas(pic), pos
+                    continue
+                stitchShift, _ = row.paste(pic, pos - rowOrigin)
+                rowOrigin = rowOrigin - stitchShift
+            if mosaic is None:
+                mosaic, origin = ChunkedMosaic(row.stitch), rowOrigin
+                continue
+            stitchShift, _ = mosaic.paste(row.stitch, rowOrigin - origin)
+            origin = origin - stitchShift
+        return mosaic
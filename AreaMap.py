@@ -4,14 +4,16 @@ import json
 import math
 from pathlib import Path
 import threading
-from skimage.transform import downscale_local_mean
-from skimage.registration import phase_cross_correlation
+from PhaseCorrelator import PhaseCorrelator
 
 from matplotlib import colors, gridspec, pyplot as plt
 import numpy as np
 from GlobalSettings import GlobalSettings
+from ChunkedMosaic import ChunkedMosaic
 from Row import Row
-from Traversal import BadFit
+from TileStore import TileStore
+from Traversal import BadFit, NoOverlap
+import registration
 import utils
 
 
@@ -20,11 +22,12 @@ class AreaMap:
     yOverlap = settings.get("PIC_OVERLAP")
     overlapVec = np.array((yOverlap, 0))
     acceptableDx = 15
+    previewPx = 800 * 800 * 3  # pixels in a live preview
 
     basePath = Path.cwd()
     baseFolder = "./stitches/"
 
-    def __init__(self, isProfile, picShape, pxSize, maxRadius, curvature, circle):
+    def __init__(self, isProfile, picShape, pxSize, maxRadius, curvature, circle, calibration=None):
         self.isProfile = isProfile
         self.curvature = curvature
         self.circle = circle
@@ -36,25 +39,59 @@ class AreaMap:
         self.done = False
         self.moveDir = -1  # go up first (-1) then down (1) each time from center
         self.stepY = (self.picShape[0] - AreaMap.yOverlap) * self.pxSize
-        self.stitch = None
+        self.calibration = calibration  # StageCalibration, for the steps and the shift every seam is searched around
+        # stage (dx, dy) of one row down, off the y axis if the camera is turned against the stage
+        if calibration is not None:
+            self.stepDown = calibration.steps(picShape, AreaMap.yOverlap)[1]
+        else:
+            self.stepDown = np.array((0, self.stepY))
+        self.mosaic = None  # ChunkedMosaic of the stitched rows
+        self.profile = None  # center row stitch, if there's no centerRow (setMosaic)
+        self.numMosaicPics = 0  # pics in a mosaic from setMosaic
         self.topPt = None  # top left corner of the top center pic
         self.botPt = None  # bot left corder of the bot center pic
+        self.thread = None  # last stitch thread
 
         folderName = datetime.now().strftime("%Y-%m-%dT%H%M%S")
         self.absFolderPath = AreaMap.basePath / AreaMap.baseFolder / folderName
         Path(str(self.absFolderPath)).mkdir(parents=True)
+        self.tileStore = TileStore(self.absFolderPath, pxSize, AreaMap.yOverlap, calibration)  # raw tiles, for restitch.py
         self.stitchDS = None
         self.downFacPxSize = None
 
+    def setMosaic(self, mosaic, profile, numPics):
+        """Use a mosaic composited elsewhere (AlignmentGraph) instead of stitching rows"""
+        self.mosaic = mosaic
+        self.profile = profile
+        self.numMosaicPics = numPics
+
+    @property
+    def numPics(self):
+        return sum(row.numPics for row in self.rows) if self.rows else self.numMosaicPics
+
+    def preview(self, maxPx=None):
+        """The mosaic with every step-th pixel, step picked so it has under maxPx pixels"""
+        h, w = self.mosaic.shape
+        step = h * w // (maxPx or AreaMap.previewPx) + 1
+        return self.mosaic.window(step=step)
+
     def nextRow(self):
         totalCenter = getattr(self.centerRow, "centerPos", None)  # could be none
         row = Row(self.circle, maxRadius=self.maxRadius, totalCenter=totalCenter)
+        row.tileStore = self.tileStore
+        row.calibration = self.calibration
         if self.centerRow is None:
             self.centerRow = row
 
         self.rows.append(row)
         return row
 
+    def dropRow(self, row):
+        """Forget a row that can't be stitched to the others"""
+        self.rows.remove(row)
+        if self.centerRow is row:
+            self.centerRow = self.rows[0] if self.rows else None
+
     def prematureEdge(self, y):
         return (
             self.maxRadius
@@ -70,16 +107,25 @@ class AreaMap:
         else:
             self.done = True
 
-    def getShift(self, lastPic, currPic):
-        """takes 2 pictures. One is the last row's center pic, and a the other is the pic of the current row's center, and gets the shift to stitch pic2 ON TOP of pic1."""
+    def getShift(self, lastPic, currPic, lastPos=None, currPos=None):
+        """takes 2 pictures. One is the last row's center pic, and a the other is the pic of the current row's center, and gets the shift to stitch pic2 ON TOP of pic1.
+        With both stage positions the seam is searched around the shift they predict. Throws NoOverlap if the seam is off the lens"""
         if self.moveDir == -1:  # stitch up
             lastArea = lastPic[: AreaMap.yOverlap, :]
             currArea = currPic[-AreaMap.yOverlap :, :]
         else:  # stitch down
             lastArea = lastPic[-AreaMap.yOverlap :, :]
             currArea = currPic[: AreaMap.yOverlap, :]
+        if not registration.enoughValid(lastArea, currArea):
+            print("Seam is off the lens")
+            raise NoOverlap
 
-        shift = phase_cross_correlation(lastArea, currArea)[0].astype(int)
+        prior = None
+        nominal = np.array((self.moveDir * (self.picShape[0] - AreaMap.yOverlap), 0))  # currPic from lastPic [px]
+        if lastPos is not None and currPos is not None:
+            stageDelta = np.array(currPos[:2], float) - np.array(lastPos[:2], float)
+            prior = utils.stageToPx(stageDelta, self.pxSize, self.calibration) - nominal
+        shift = PhaseCorrelator.get(currArea.shape)(lastArea, currArea, prior)[0].astype(int)
 
         if abs(shift[1]) > AreaMap.acceptableDx:
             print(f"Fit not acceptable (dx={shift[1]}), trying again")
@@ -89,41 +135,44 @@ class AreaMap:
         return shift, zDiff
 
     def stitchUp(self, row: Row):
-        row.stitch += row.zDiff
+        row.stitch[...] += row.zDiff  # in place, stitch is a view of the canvas
 
         stitchPt = self.topPt + AreaMap.overlapVec + row.shift
         rowPt = row.centerPt + (row.picShape[0], 0)
-        self.stitch, stitchShift, picShift = utils.ptToPtStitch(
-            self.stitch, stitchPt, row.stitch, rowPt
-        )
+        stitchShift, picShift = self.mosaic.paste(row.stitch, stitchPt - rowPt)
         self.topPt = picShift + row.centerPt
         self.botPt += stitchShift
         self.saveImages()  # on a thread so non blocking
 
     def stitchDown(self, row: Row):
-        row.stitch += row.zDiff
+        row.stitch[...] += row.zDiff  # in place, stitch is a view of the canvas
 
         stitchPt = self.botPt + (self.picShape[0], 0) - AreaMap.overlapVec + row.shift
         rowPt = row.centerPt
-        self.stitch, stitchShift, picShift = utils.ptToPtStitch(
-            self.stitch, stitchPt, row.stitch, rowPt
-        )
+        stitchShift, picShift = self.mosaic.paste(row.stitch, stitchPt - rowPt)
         self.botPt = picShift + row.centerPt
         self.topPt += stitchShift
         self.saveImages()  # on a thread so non blocking
 
     def addToStitch(self, row):
         stitchUp = self.moveDir == -1
-        if self.stitch is None:
-            self.stitch = row.stitch.copy()
+        row.wait()
+        self.wait()
+        if self.mosaic is None:
+            self.mosaic = ChunkedMosaic(row.stitch)
             self.topPt = row.centerPt.copy()
             self.botPt = row.centerPt.copy()
             return
-        thread = threading.Thread(
+        self.thread = threading.Thread(
             target=self.stitchUp if stitchUp else self.stitchDown,
             args=(row,),  # need trailing comma
         )
-        thread.start()
+        self.thread.start()
+
+    def wait(self):
+        """Waits for the last stitch thread"""
+        if self.thread is not None:
+            self.thread.join()
 
     def saveFit(self, phase=None, pxSize=None, curvature=None):
         if phase is None:
@@ -227,18 +276,19 @@ class AreaMap:
     def saveImages(self):
         """Saves .npy array and png image of the stitch and profile"""
 
-        stitch = self.stitch if self.stitch is not None else self.centerRow.stitch
-        profile = self.centerRow.stitch
-        np.save(str(self.absFolderPath / "profile.npy"), profile)
+        mosaic = self.mosaic if self.mosaic is not None else ChunkedMosaic(self.centerRow.stitch)
+        profile = self.profile if self.centerRow is None else self.centerRow.stitch
+        if profile is not None:
+            np.save(str(self.absFolderPath / "profile.npy"), profile)
 
         # limit stitch size under 100mb
-        stitchSize = np.prod(stitch.shape) * np.dtype(stitch.dtype).itemsize / (1024**2)
+        stitchSize = np.prod(mosaic.shape) * np.dtype(float).itemsize / (1024**2)
         downFac = max(1, math.floor(stitchSize / 100))
         self.downFacPxSize = self.pxSize * downFac
-        self.stitchDS = downscale_local_mean(stitch, (downFac, downFac))
+        self.stitchDS = mosaic.downscaled(downFac)
         np.save(str(self.absFolderPath / "stitch_DS.npy"), self.stitchDS)
 
-        stitchNoNan = np.nan_to_num(self.stitchDS, nan=np.nanmin(stitch))
+        stitchNoNan = np.nan_to_num(self.stitchDS, nan=np.nanmin(self.stitchDS))
         plt.imsave(str(self.absFolderPath / "stitch_DS.png"), stitchNoNan, cmap="jet")
 
         with open(str(self.absFolderPath / "info.json"), "w") as f:
@@ -0,0 +1,115 @@
+import numpy as np
+
+from MaxContSearch import MaxContSearch
+
+CGOLD = 0.3819660  # 1 - 1/golden ratio
+
+
+class BrentContSearch(MaxContSearch):
+    """Refines a bracketed contrast peak with Brent's method (golden section steps + parabolic interpolation) instead of
+    a linear sweep. Takes the interval [(cont, z), (maxCont, z), (cont, z)] that a coarse search returns (the max can
+    also be an end, when the coarse search never saw the contrast drop), and starts from its best point.
+    Stops when the bracket is under zTol, when the best points differ by less than contNoise (the standard error of one
+    contrast read, KoalaController.refineMaxCont passes the measured one), or after maxEvals.
+    Use with KoalaController.searchBrent"""
+
+    def __init__(self, interval, minContrast, zTol=5, contNoise=0.1, avg=10, maxEvals=15):
+        zs = [z for _, z in interval]
+        c_m, z_m = max(interval, key=lambda pt: pt[0])
+        super().__init__(min(zs), max(zs), 1, minContrast, subdivisions=maxEvals, avg=avg)
+        self.zTol = zTol
+        self.contNoise = contNoise
+        self.maxEvals = maxEvals
+        self.known = {z: c for c, z in interval}  # every (z: cont) measured, including the bracket
+        self.steps = self.brent(z_m, c_m)
+        self.started = False
+
+    def nextZ(self):
+        """Next z to measure, or None when converged. Record the contrast at it with newContPt first"""
+        try:
+            if not self.started:
+                self.started = True
+                return next(self.steps)
+            return self.steps.send(self.contPts[-1][0])
+        except StopIteration:
+            return None
+
+    def newContPt(self, cont, z):
+        super().newContPt(cont, z)
+        self.known[z] = cont
+
+    def brent(self, x, cont):
+        """Generator yielding z's to measure and receiving their contrast. Minimises f = -contrast on [z_1, z_2]"""
+        a, b = self.z_1, self.z_2
+        v = w = x
+        fv = fw = fx = -cont
+        d = e = 0.0
+        for _ in range(self.maxEvals):
+            m = 0.5 * (a + b)
+            tol = self.zTol / 2
+            if abs(x - m) <= 2 * tol - 0.5 * (b - a):
+                return  # bracket is small enough
+            if len({x, w, v}) == 3 and max(fx, fw, fv) - min(fx, fw, fv) < self.contNoise:
+                print("Contrast differences are under the noise, stopping")
+                return
+
+            golden = True
+            if abs(e) > tol:  # try a parabolic step through x, w, v
+                r = (x - w) * (fx - fv)
+                q = (x - v) * (fx - fw)
+                p = (x - v) * q - (x - w) * r
+                q = 2 * (q - r)
+                if q > 0:
+                    p = -p
+                q = abs(q)
+                eTemp, e = e, d
+                if abs(p) < abs(0.5 * q * eTemp) and q * (a - x) < p < q * (b - x):
+                    d = p / q
+                    golden = False
+                    if (x + d) - a < 2 * tol or b - (x + d) < 2 * tol:
+                        d = tol if m >= x else -tol
+            if golden:
+                e = (a - x) if x >= m else (b - x)
+                d = CGOLD * e
+
+            u = x + (d if abs(d) >= tol else np.copysign(tol, d))
+            fu = -(yield u)
+
+            if fu <= fx:
+                if u >= x:
+                    a = x
+                else:
+                    b = x
+                v, w, x = w, x, u
+                fv, fw, fx = fw, fx, fu
+            else:
+                if u < x:
+                    a = u
+                else:
+                    b = u
+                if fu <= fw or w == x:
+                    v, w = w, u
+                    fv, fw = fw, fu
+                elif fu <= fv or v == x or v == w:
+                    v, fv = u, fu
+
+    def getMaxContInterval(self):
+        """Same format as the linear searches: [(cont, z below), (max cont, z of max), (cont, z above)].
+        The peak z is the vertex of a parabola through the best 3 points when it lands inside the bracket"""
+        pts = sorted(self.known.items())
+        zs = np.array([z for z, _ in pts])
+        conts = np.array([c for _, c in pts])
+        best = int(np.argmax(conts))
+        zPeak, cPeak = zs[best], conts[best]
+        if 0 < best < len(zs) - 1:
+            (z0, z1, z2), (c0, c1, c2) = zs[best - 1 : best + 2], conts[best - 1 : best + 2]
+            denom = (z0 - z1) * (z0 - z2) * (z1 - z2)
+            A = (z2 * (c1 - c0) + z1 * (c0 - c2) + z0 * (c2 - c1)) / denom
+            B = (z2**2 * (c0 - c1) + z1**2 * (c2 - c0) + z0**2 * (c1 - c2)) / denom
+            if A < 0 and z0 < -B / (2 * A) < z2:
+                zPeak = -B / (2 * A)
+        lo, hi = max(best - 1, 0), min(best + 1, len(zs) - 1)
+        self.maxCont = cPeak
+        self.maxContInterval = [(conts[lo], zs[lo]), (cPeak, zPeak), (conts[hi], zs[hi])]
+        print(f"Found max contrast = {cPeak:.2f} @ z = {zPeak:.1f} ({len(self.contPts) - 2} evaluations)")
+        return self.maxContInterval
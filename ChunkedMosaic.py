@@ -0,0 +1,109 @@
+import threading
+
+import numpy as np
+from skimage.transform import downscale_local_mean
+
+from MosaicCanvas import MosaicCanvas
+
+
+class ChunkedMosaic:
+    """A stitch stored as fixed size blocks (chunk x chunk), allocated the first time a valid pixel lands in them, so
+    the NaN corners of a circular map never exist. Same paste as MosaicCanvas (view coordinates, returns the shifts),
+    but it's read through window() and downscaled() instead of one dense array. dense() builds it only when asked.
+    Pastes and reads can come from different threads"""
+
+    chunk = 512
+
+    def __init__(self, pic, chunk=None):
+        self.chunk = chunk or ChunkedMosaic.chunk
+        self.blocks = {}  # (blockRow, blockCol): (data, valid)
+        self.lock = threading.Lock()
+        # bounds of the view in world coordinates (the first pic's top left is (0, 0)). Blocks are in world coordinates
+        self.top, self.left = 0, 0
+        self.h, self.w = 0, 0
+        self.write(np.asarray(pic, float), 0, 0, (False, False))
+        self.h, self.w = pic.shape
+
+    @property
+    def shape(self):
+        return (self.h, self.w)
+
+    def blockSlices(self, top, left, bottom, right):
+        """Yields ((blockRow, blockCol), block slice, window slice) for every block under world [top:bottom, left:right]"""
+        c = self.chunk
+        for by in range(top // c, -(-bottom // c)):
+            for bx in range(left // c, -(-right // c)):
+                y0, y1 = max(top, by * c), min(bottom, (by + 1) * c)
+                x0, x1 = max(left, bx * c), min(right, (bx + 1) * c)
+                blockSl = (slice(y0 - by * c, y1 - by * c), slice(x0 - bx * c, x1 - bx * c))
+                windowSl = (slice(y0 - top, y1 - top), slice(x0 - left, x1 - left))
+                yield (by, bx), blockSl, windowSl
+
+    def gather(self, top, left, bottom, right):
+        """(data, valid) copies of world [top:bottom, left:right], NaN/False where no block exists"""
+        data = np.full((bottom - top, right - left), np.nan)
+        valid = np.zeros(data.shape, bool)
+        for key, blockSl, windowSl in self.blockSlices(top, left, bottom, right):
+            if key in self.blocks:
+                blockData, blockValid = self.blocks[key]
+                data[windowSl] = blockData[blockSl]
+                valid[windowSl] = blockValid[blockSl]
+        return data, valid
+
+    def write(self, pic, top, left, after):
+        """Blends pic in at world (top, left), touching only the blocks under it"""
+        h, w = pic.shape
+        with self.lock:
+            data, valid = self.gather(top, left, top + h, left + w)
+            MosaicCanvas.blend(data, valid, pic, after)
+            for key, blockSl, windowSl in self.blockSlices(top, left, top + h, left + w):
+                if key not in self.blocks:
+                    if not np.any(valid[windowSl]):
+                        continue  # nothing valid here (yet)
+                    self.blocks[key] = (np.full((self.chunk, self.chunk), np.nan), np.zeros((self.chunk, self.chunk), bool))
+                blockData, blockValid = self.blocks[key]
+                blockData[blockSl] = data[windowSl]
+                blockValid[blockSl] = valid[windowSl]
+
+    def paste(self, pic, pt):
+        """Blends pic in with its top left at pt (y, x) of the current view, which grows to fit it.
+        Returns (stitchShift, picShift): where the old view's (0, 0) and pic's top left are in the new view"""
+        y, x = int(pt[0]), int(pt[1])
+        h2, w2 = pic.shape
+        newTop, newLeft = min(0, y), min(0, x)
+        newBottom, newRight = max(self.h, y + h2), max(self.w, x + w2)
+        stitchShift = np.array((-newTop, -newLeft))
+        picShift = np.array((y - newTop, x - newLeft))
+        self.write(np.asarray(pic, float), self.top + y, self.left + x, picShift > stitchShift)
+        with self.lock:
+            self.top += newTop
+            self.left += newLeft
+            self.h, self.w = newBottom - newTop, newRight - newLeft
+        return stitchShift, picShift
+
+    def window(self, rows=slice(None), cols=slice(None), step=1):
+        """A copy of view[rows, cols] keeping every step-th pixel (a cheap level of detail for previews)"""
+        with self.lock:
+            y0, y1, _ = rows.indices(self.h)
+            x0, x1, _ = cols.indices(self.w)
+            data, _ = self.gather(self.top + y0, self.left + x0, self.top + y1, self.left + x1)
+        return data[::step, ::step]
+
+    def downscaled(self, factor):
+        """The whole view downscaled by factor (local mean, like skimage's downscale_local_mean of dense()),
+        built a band of blocks at a time"""
+        if factor == 1:
+            return self.dense()
+        bandH = max(self.chunk // factor, 1) * factor
+        bands = [
+            downscale_local_mean(self.window(rows=slice(y, min(y + bandH, self.h))), (factor, factor))
+            for y in range(0, self.h, bandH)
+        ]
+        return np.vstack(bands)
+
+    def dense(self):
+        return self.window()
+
+    def nbytes(self):
+        """Memory held by the blocks"""
+        return sum(data.nbytes + valid.nbytes for data, valid in self.blocks.values())
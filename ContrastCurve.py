@@ -0,0 +1,73 @@
+import warnings
+import numpy as np
+import scipy.optimize as opt
+import scipy.stats
+
+
+def gaussian(z, base, amp, z0, width):
+    return base + amp * np.exp(-0.5 * np.square((z - z0) / width))
+
+
+def lorentzian(z, base, amp, z0, width):
+    return base + amp / (1 + np.square((z - z0) / width))
+
+
+class ContrastCurve:
+    """Contrast vs z model (a peak on a baseline), fitted to a handful of (z, contrast) samples to predict where the
+    focus peak is, with an uncertainty, before it has been sampled finely"""
+
+    models = {"gaussian": gaussian, "lorentzian": lorentzian}
+    minPts = 5  # 4 parameters + at least one degree of freedom
+
+    def __init__(self, model="gaussian"):
+        if model not in ContrastCurve.models:
+            raise ValueError(f"Unknown contrast curve model {model}")
+        self.model = model
+        self.func = ContrastCurve.models[model]
+        self.popt = None
+        self.peakErr = np.inf
+        self.dof = 0  # points - parameters of the last fit
+
+    def __call__(self, z):
+        return self.func(z, *self.popt)
+
+    def fit(self, zs, conts):
+        """Returns True if the fit converged to a peak inside the sampled range"""
+        zs, conts = np.asarray(zs, float), np.asarray(conts, float)
+        if len(zs) < ContrastCurve.minPts:
+            return False
+        best = np.argmax(conts)
+        if best in (np.argmin(zs), np.argmax(zs)):
+            return False  # peak isn't bracketed yet
+
+        span = np.ptp(zs)
+        guess = (np.min(conts), np.ptp(conts), zs[best], span / 8)
+        lower = (-np.inf, 0, zs.min(), span / 1000)
+        upper = (np.inf, np.inf, zs.max(), span)
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", opt.OptimizeWarning)
+                popt, pcov = opt.curve_fit(self.func, zs, conts, p0=guess, bounds=(lower, upper))
+        except (RuntimeError, ValueError):
+            return False
+        peakErr = np.sqrt(pcov[2, 2])
+        if not np.isfinite(peakErr):
+            return False
+        self.popt, self.peakErr = popt, peakErr
+        self.dof = len(zs) - len(popt)
+        return True
+
+    @property
+    def peak(self):
+        """z of max contrast"""
+        return self.popt[2]
+
+    @property
+    def peakCont(self):
+        return self.popt[0] + self.popt[1]
+
+    @property
+    def peakInterval(self):
+        """Half width of the 95% confidence interval on the peak z. Student's t, since the noise is estimated from the
+        fit's few residuals (12.7 sigma with 5 points, 2.8 with 8)"""
+        return scipy.stats.t.ppf(0.975, self.dof) * self.peakErr
@@ -0,0 +1,72 @@
+import numpy as np
+
+from MaxContSearch import MaxContSearch
+
+
+class ContrastSweep(MaxContSearch):
+    """Contrast sampled at full rate while the stage makes one long move from z_1 to z_2, instead of stopping at every z.
+    Stage positions are read between reconstructions and each contrast sample gets the z interpolated at its time.
+    Use with KoalaController.sweepUntilDecrease"""
+
+    captureFrac = 0.5  # where in the SingleReconstruction call the hologram is taken (0 = start, 1 = end)
+    arriveTol = 1.0  # [um]
+    drop = 0.5  # past the peak once the contrast fell this fraction of the way from the max back to minContrast
+    maxSamples = 2_000
+
+    def __init__(self, z_a, z_b, direction, minContrast, peakTol=None, model="gaussian"):
+        super().__init__(z_a, z_b, direction, minContrast, subdivisions=1, peakTol=peakTol, model=model)
+        self.posTimes, self.posZs = [], []
+        self.contTimes, self.conts = [], []
+        self.arrived = False
+
+    def logPos(self, t, z):
+        self.posTimes.append(t)
+        self.posZs.append(z)
+        if len(self.posZs) >= 2:
+            still = abs(self.posZs[-1] - self.posZs[-2]) < ContrastSweep.arriveTol
+            self.arrived = still and abs(z - self.z_2) < ContrastSweep.arriveTol
+
+    def logCont(self, t, cont):
+        self.contTimes.append(t)
+        self.conts.append(cont)
+
+    def isPastPeak(self):
+        if len(self.conts) < 3:
+            return False
+        maxCont = max(self.conts)
+        threshold = maxCont - ContrastSweep.drop * (maxCont - self.minContrast)
+        return maxCont > self.minContrast and max(self.conts[-2:]) < threshold
+
+    def done(self):
+        return self.arrived or self.isPastPeak() or len(self.conts) >= ContrastSweep.maxSamples
+
+    def finish(self):
+        """Turns the samples into contPts, (cont, z) in sweep order. Samples outside the logged positions get the nearest one"""
+        zs = np.interp(self.contTimes, self.posTimes, self.posZs)
+        self.contPts = [(-1, -1), (-1, self.z_1)] + list(zip(self.conts, zs))
+        self.step = abs(zs[-1] - zs[0]) / max(len(zs) - 1, 1)
+        self.subdivisions = len(zs)
+
+    def getMaxContInterval(self):
+        """[(cont, z), (max cont, z), (cont, z)] around the max, the neighbours being the samples before and after it.
+        None if no sample was over minContrast"""
+        pts = self.contPts[2:]
+        best = int(np.argmax([c for c, _ in pts]))
+        if pts[best][0] < self.minContrast:
+            return None
+        if self.isPeakPredicted():
+            # samples taken on the move can be off by the capture timing, so the fit only centers the bracket
+            (_, z_lo), mid, (_, z_hi) = self.getPredictedInterval()
+            self.predicted = False
+            halfWidth = max(self.peakTol, self.step)
+            z = mid[1]
+            self.maxContInterval = [(self.curve(z - halfWidth), z - halfWidth), mid, (self.curve(z + halfWidth), z + halfWidth)]
+            return self.maxContInterval
+        # a max on the first/last sample gets a neighbour one step further out, so the bracket isn't empty
+        (cont, z), step = pts[best], self.step * self.direction
+        before = pts[best - 1] if best > 0 else (self.minContrast, z - step)
+        after = pts[best + 1] if best < len(pts) - 1 else (self.minContrast, z + step)
+        self.maxCont = cont
+        self.maxContInterval = [before, pts[best], after]
+        print(f"Swept max contrast = {self.maxCont:.2f} @ z = {pts[best][1]:.1f} ({len(pts)} samples)")
+        return self.maxContInterval
@@ -0,0 +1,90 @@
+import hashlib
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+class FocusCache:
+    """Focused (x, y, z, contrast) samples kept on disk between sessions, one file per specimen/holder and setup
+    (objective config, ABS_MAX_Z, focusDist), so searches can start from a narrow bracket around a known z.
+    Samples older than maxAge are dropped on load, and samples that disagree with a fresh focus by more than driftTol
+    are dropped as soon as the disagreement is seen (holder moved, crank turned...)."""
+
+    basePath = Path.cwd()
+    baseFolder = "./focusCache/"
+    maxAge = 30 * 24 * 3600  # [s]
+    driftTol = 50  # [um]
+    radius = 500  # [um] how far away a sample can still say something about the focus here
+
+    def __init__(self, specimen, setup):
+        self.specimen = specimen
+        self.setup = setup  # dict, e.g. {"config": 142, "ABS_MAX_Z": 27175, "focusDist": 6468}
+        setupHash = hashlib.sha1(json.dumps(setup, sort_keys=True).encode()).hexdigest()[:8]
+        folder = FocusCache.basePath / FocusCache.baseFolder
+        folder.mkdir(parents=True, exist_ok=True)
+        self.filePath = folder / f"{specimen}_{setupHash}.json"
+        self.samples = np.empty((0, 5))  # x, y, z, contrast, unix time
+        self.tree = None
+        self.load()
+
+    def load(self):
+        if not self.filePath.exists():
+            return
+        with open(self.filePath, "r") as f:
+            samples = np.array(json.load(f)["samples"], float).reshape(-1, 5)
+        fresh = samples[:, 4] > time.time() - FocusCache.maxAge
+        self.samples = samples[fresh]
+        print(f"Loaded {len(self.samples)} cached focus points ({np.sum(~fresh)} expired)")
+
+    def save(self):
+        with open(self.filePath, "w") as f:
+            json.dump(
+                {
+                    "specimen": self.specimen,
+                    "setup": self.setup,
+                    "columns": ["x", "y", "z", "contrast", "time"],
+                    "samples": self.samples.tolist(),
+                },
+                f,
+            )
+
+    def near(self, x, y, radius=None):
+        """Indices of the samples within radius of (x, y)"""
+        if not len(self.samples):
+            return []
+        if self.tree is None:
+            self.tree = cKDTree(self.samples[:, :2])
+        return self.tree.query_ball_point((x, y), radius or FocusCache.radius)
+
+    def lookup(self, x, y):
+        """Returns the expected focus z at (x, y) or None. Nearby samples are corrected with the local plane through them"""
+        idx = self.near(x, y)
+        if not len(idx):
+            return None
+        pts = self.samples[idx]
+        if len(pts) >= 3:
+            A = np.column_stack((pts[:, 0] - x, pts[:, 1] - y, np.ones(len(pts))))
+            (_, _, z), _, rank, _ = np.linalg.lstsq(A, pts[:, 2], rcond=None)
+            if rank == 3:  # points along a single row don't define a plane
+                return z
+        dists = np.hypot(pts[:, 0] - x, pts[:, 1] - y)
+        return pts[np.argmin(dists), 2]
+
+    def add(self, x, y, z, contrast):
+        """Record a focus. Drops nearby samples it contradicts"""
+        expected = self.lookup(x, y)
+        if expected is not None and abs(expected - z) > FocusCache.driftTol:
+            idx = self.near(x, y)
+            print(f"Focus drifted {z - expected:.0f}um from the cache, dropping {len(idx)} old points")
+            self.samples = np.delete(self.samples, idx, axis=0)
+        self.samples = np.vstack((self.samples, (x, y, z, contrast, time.time())))
+        self.tree = None
+
+    def invalidate(self, x, y):
+        """The cache was wrong here (nothing found near the cached z)"""
+        idx = self.near(x, y)
+        self.samples = np.delete(self.samples, idx, axis=0)
+        self.tree = None
@@ -0,0 +1,62 @@
+import numpy as np
+
+
+class FocusSurface:
+    """Focus z as a smooth function of stage (x, y), learned from every position we found focused.
+    A weighted least squares polynomial (degree 2 by default) kept as running normal equations, so adding a point and
+    predicting are both O(terms^2) no matter how many points were seen."""
+
+    scale = 1_000  # [um] positions are centered on the first point and scaled so the normal equations stay well conditioned
+    minExtraPts = 3  # points beyond the number of terms before predicting
+    minSigma = 1.0  # [um] a handful of points can fit suspiciously well
+
+    def __init__(self, degree=2):
+        self.degree = degree
+        self.powers = [(i, j) for i in range(degree + 1) for j in range(degree + 1 - i)]
+        n = len(self.powers)
+        self.AtA = np.zeros((n, n))
+        self.Atb = np.zeros(n)
+        self.btb = 0.0
+        self.weightSum = 0.0
+        self.numPts = 0
+        self.origin = None
+        self.coef = None
+        self.cov = None  # (AtA)^-1
+        self.sigma = np.inf  # residual std of one sample [um]
+
+    def terms(self, x, y):
+        u, v = (np.array((x, y), float) - self.origin) / FocusSurface.scale
+        return np.array([u**i * v**j for i, j in self.powers])
+
+    def add(self, x, y, z, weight=1.0):
+        """Learn a focused position. Lower weight for positions that were only roughly focused"""
+        if self.origin is None:
+            self.origin = np.array((x, y), float)
+        phi = self.terms(x, y)
+        self.AtA += weight * np.outer(phi, phi)
+        self.Atb += weight * phi * z
+        self.btb += weight * z**2
+        self.weightSum += weight
+        self.numPts += 1
+        self.solve()
+
+    def solve(self):
+        dof = self.numPts - len(self.powers)
+        if dof < FocusSurface.minExtraPts:
+            return
+        # a tiny ridge keeps directions nothing was learned in (e.g. y, along a single row) uncertain instead of singular
+        ridge = 1e-6 * np.eye(len(self.powers))
+        self.cov = np.linalg.inv(self.AtA + ridge)
+        self.coef = self.cov @ self.Atb
+        # weighted residual sum of squares from the normal equations, per unit weight sample
+        rss = max(self.btb - self.coef @ self.Atb, 0)
+        self.sigma = max(np.sqrt(rss / dof), FocusSurface.minSigma)
+
+    def predict(self, x, y):
+        """Returns (z, uncertainty [um, 1 std of a new point]) or None if there isn't enough data yet.
+        The uncertainty grows quickly when extrapolating away from learned points"""
+        if self.coef is None:
+            return None
+        phi = self.terms(x, y)
+        leverage = phi @ self.cov @ phi
+        return phi @ self.coef, self.sigma * np.sqrt(1 + leverage)
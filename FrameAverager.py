@@ -0,0 +1,101 @@
+import numpy as np
+import scipy.stats
+
+
+class FrameAverager:
+    """Streams frames into a per-pixel running mean/variance (Welford) held in preallocated float32 buffers, so memory
+    doesn't grow with the number of frames averaged.
+
+    mode="mean": plain running mean. With clip set, pixels further than clip*sigma from the running mean are rejected,
+    and a whole frame is dropped if more than rejectFrac of its pixels are (vibration smears the whole frame). sigma is
+    only estimated from the frames so far, so clipping waits for minClipCount of them and the threshold is widened to
+    the Student t quantile with the same tail as clip (clipThreshold).
+    mode="median": running median over the last `window` frames (window+ frames of memory, robust to single bad frames).
+    """
+
+    minClipCount = 8  # frames before clipping. With 3, noise alone put ~7% of pixels past 4 sample sigmas
+
+    def __init__(self, shape, mode="mean", clip=None, rejectFrac=0.2, window=5):
+        if mode not in ("mean", "median"):
+            raise ValueError(f"Unknown averaging mode {mode}")
+        self.mode = mode
+        self.clip = clip
+        self.rejectFrac = rejectFrac
+
+        self.count = np.zeros(shape, np.float32)  # accepted samples per pixel
+        self.mean = np.zeros(shape, np.float32)
+        self.m2 = np.zeros(shape, np.float32)  # sum of squared deviations from the mean
+        self.holes = np.zeros(shape, bool)  # NaN in any accepted frame. Nans must persist for stitching
+        self.delta = np.empty(shape, np.float32)  # scratch
+        self.scratch = np.empty(shape, np.float32)
+        self.frames = 0
+        self.rejected = 0
+
+        if mode == "median":
+            self.ring = np.full((window, *shape), np.nan, np.float32)
+
+    def add(self, frame):
+        """Adds a frame. Returns False if it was rejected as an outlier"""
+        nans = np.isnan(frame)
+        np.subtract(frame, self.mean, out=self.delta)
+        self.delta[nans] = 0
+
+        if self.clip is not None and self.frames >= FrameAverager.minClipCount:
+            outliers = np.abs(self.delta) > self.clipThreshold() * self.std()
+            if np.count_nonzero(outliers) > self.rejectFrac * outliers.size:
+                self.rejected += 1
+                print(f"Rejected frame ({np.mean(outliers) * 100:.0f}% outliers)")
+                return False
+            self.delta[outliers] = 0
+            nans |= outliers
+
+        if self.mode == "median":
+            self.ring[self.frames % len(self.ring)] = frame
+
+        valid = ~nans
+        self.holes |= np.isnan(frame)
+        self.count += valid
+        # mean += delta / n, m2 += delta * (x - new mean), only where the pixel was used
+        self.scratch.fill(0)
+        np.divide(self.delta, self.count, out=self.scratch, where=valid)
+        self.mean += self.scratch
+        np.subtract(frame, self.mean, out=self.scratch)
+        self.scratch[nans] = 0
+        self.scratch *= self.delta
+        self.m2 += self.scratch
+        self.frames += 1
+        return True
+
+    def clipThreshold(self):
+        """clip in sample std of the frames so far: a new frame's deviation from the mean of n frames over their sample
+        std is t distributed (n - 1 degrees of freedom) times sqrt(1 + 1/n). Rejects good pixels as rarely as clip
+        Gaussian sigmas would (9.0 for clip=4 after 8 frames, 5.2 after 20)"""
+        n = self.frames
+        return scipy.stats.t.isf(scipy.stats.norm.sf(self.clip), n - 1) * np.sqrt(1 + 1 / n)
+
+    def std(self):
+        """Per-pixel sample standard deviation [same units as frames]"""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.sqrt(self.m2 / np.maximum(self.count - 1, 0))
+
+    def noise(self):
+        """Per-pixel standard error of the result"""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            stdErr = self.std() / np.sqrt(self.count)
+        if self.mode == "median":
+            stdErr *= np.sqrt(np.pi / 2)  # median is a less efficient estimator
+        return stdErr
+
+    def noiseLevel(self):
+        """Typical per-pixel standard error, inf until there are at least 2 frames"""
+        if self.frames < 2:
+            return np.inf
+        return float(np.nanmedian(self.noise()))
+
+    def result(self):
+        """Returns the averaged frame. Reuses the internal buffer, so don't add frames after calling this"""
+        if self.mode == "median":
+            with np.errstate(all="ignore"):
+                np.nanmedian(self.ring[: min(self.frames, len(self.ring))], axis=0, out=self.mean)
+        self.mean[self.holes | (self.count == 0)] = np.nan
+        return self.mean
@@ -39,14 +39,6 @@ class GlobalSettings:
             "defaultValue": 25,
             "description": "The small distance in um to go up and down to see if the contrast increases.",
         },
-        "FAST_MOVE_REL_TIME": {
-            "name": "Fast Relative Move Wait Time",
-            "type": "float",
-            "value": 0.4,
-            "stagedVal": None,
-            "defaultValue": 0.4,
-            "description": "Time to wait for a fast (small) relative move in seconds. No reason to go over 0.6.",
-        },
         "DZ_THRESH": {
             "name": "Delta Z Top of Curvature Threshold",
             "type": "float",
@@ -55,6 +47,70 @@ class GlobalSettings:
             "defaultValue": 0.01,
             "description": "If the slope of the image is less than this value while traversing to an extreme, stop because we are at the top.",
         },
+        "PHASE_NOISE_TARGET": {
+            "name": "Phase Averaging Noise Target",
+            "type": "float",
+            "value": 0.0,
+            "stagedVal": None,
+            "defaultValue": 0.0,
+            "description": "Stop averaging phase frames once the typical per-pixel standard error is under this value in um. 0 always averages the full count.",
+        },
+        "FRAME_SIGMA_CLIP": {
+            "name": "Frame Outlier Sigma Clip",
+            "type": "float",
+            "value": 4.0,
+            "stagedVal": None,
+            "defaultValue": 4.0,
+            "description": "While averaging phase frames, pixels further than this many standard deviations from the running mean are rejected (whole frames if too many are). 0 disables.",
+        },
+        "FOCUS_Z_TOL": {
+            "name": "Predicted Focus Z Tolerance",
+            "type": "float",
+            "value": 15.0,
+            "stagedVal": None,
+            "defaultValue": 15.0,
+            "description": "A focus sweep stops and goes straight to the peak predicted by a contrast curve fit once its 95% confidence interval is within +- this many um. 0 disables prediction.",
+        },
+        "CONTRAST_CONFIDENCE": {
+            "name": "Adaptive Contrast Confidence",
+            "type": "float",
+            "value": 2.5,
+            "stagedVal": None,
+            "defaultValue": 2.5,
+            "description": "Contrast checks stop sampling once the estimate is this many standard errors above or below the value it is compared to. 0 always takes the full average.",
+        },
+        "FOCUS_SURFACE_TOL": {
+            "name": "Focus Surface Tolerance",
+            "type": "float",
+            "value": 15.0,
+            "stagedVal": None,
+            "defaultValue": 15.0,
+            "description": "While mapping, move straight to the focus z predicted from already focused points and skip the contrast check if the prediction's uncertainty is under this many um. 0 always checks.",
+        },
+        "FOCUS_CACHE_BRACKET": {
+            "name": "Cached Focus Bracket",
+            "type": "float",
+            "value": 150.0,
+            "stagedVal": None,
+            "defaultValue": 150.0,
+            "description": "When a previous session focused near this spot, search only +- this many um around the cached z instead of the whole range. 0 ignores the focus cache. Planned maps (mapArea planned=True) also only search this far around a tile's predicted z before pruning it.",
+        },
+        "FOCUS_METRIC_MIN_R2": {
+            "name": "Image Focus Check Fit Quality",
+            "type": "float",
+            "value": 0.8,
+            "stagedVal": None,
+            "defaultValue": 0.8,
+            "description": "Mapping checks focus from each tile's phase image instead of reconstructing for GetHoloContrast when the image metric -> contrast calibration has at least this r^2. 0 never calibrates or checks from the image.",
+        },
+        "SETTLE_TOL": {
+            "name": "Settle Position Tolerance",
+            "type": "float",
+            "value": 1.0,
+            "stagedVal": None,
+            "defaultValue": 1.0,
+            "description": "Fast moves poll the stage position until it is within this many um of the target and still, instead of sleeping. 0 sleeps the settle time SettleModel expects instead (settleModel.json, re-fit with python SettleModel.py).",
+        },
     }
 
     filePath = Path("./settings.json")
@@ -67,6 +123,7 @@ class GlobalSettings:
     def __init__(self):
         if GlobalSettings.filePath.exists():
             self.settings = self.read()
+            self.addMissingDefaults()
         else:
             self.writeDefault()
             self.settings = copy.deepcopy(GlobalSettings.defaultSettings)
@@ -88,6 +145,14 @@ class GlobalSettings:
         with open(GlobalSettings.filePath.as_posix(), "r") as json_file:
             return json.load(json_file)
 
+    def addMissingDefaults(self):
+        """Settings files written before a setting existed get its default"""
+        missing = [k for k in GlobalSettings.defaultSettings if k not in self.settings]
+        for key in missing:
+            self.settings[key] = copy.deepcopy(GlobalSettings.defaultSettings[key])
+        if missing:
+            self.write()
+
     def keys(self):
         return self.settings.keys()
 
@@ -13,8 +13,9 @@ from Traversal import Traversal
 
 
 class Graph:
-    def __init__(self, areaMap: AreaMap):
+    def __init__(self, areaMap: AreaMap, show=True):
         self.areaMap = areaMap
+        self.show = show
 
         self.texts = []
         self.contPoints = []  # contains (x, y, z contrast)
@@ -24,6 +25,8 @@ class Graph:
         self.setupGraph()
 
     def setupGraph(self):
+        if not self.show:
+            return
         plt.ion()
         self.fig, axes = plt.subplots(2, 1, figsize=(10, 10))
         self.fig.canvas.manager.window.geometry("+800+0")
@@ -153,12 +156,14 @@ class Graph:
 
     def updateAreaMap(self):
         def getStitchPreview():
-            if self.areaMap.stitch is None:
-                return self.areaMap.rows[-1].stitch
-            if self.areaMap.rows[-1].done:
-                return self.areaMap.stitch
-
-            return self.areaMap.stitch
+            if self.areaMap.mosaic is None and not self.areaMap.rows:
+                return None  # nothing stitched yet (deferred stitching)
+            if self.areaMap.mosaic is None:
+                stitch = self.areaMap.rows[-1].stitch
+                step = stitch.shape[0] * stitch.shape[1] // AreaMap.previewPx + 1
+                return stitch[::step, ::step]
+            # only the sampled pixels are assembled, never the whole mosaic
+            return self.areaMap.preview()
             # stitch = self.areaMap.stitch
             # lastRow = self.areaMap.rows[-1].stitch + self.areaMap.rows[-1].zDiff
 
@@ -177,8 +182,8 @@ class Graph:
             #     return np.vstack((stitch, lastRow))
 
         stitch = getStitchPreview()
-        step = stitch.shape[0] * stitch.shape[1] // (800 * 800 * 3) + 1
-        stitch = stitch[::step, ::step]
+        if stitch is None:
+            return
 
         self.im.set_data(stitch)
         self.map.set_aspect("auto")
@@ -192,6 +197,8 @@ class Graph:
         self.ax.autoscale_view()
 
     def updateGraph(self):
+        if not self.show:
+            return
         t0 = time.time()
         # remove old annotations
         [txt.remove() for txt in self.texts]
@@ -237,26 +244,29 @@ class Graph:
 
     def clear(self):
         self.contPoints = []  # contains (x, y, z contrast)
+        self.maxContSearches = []
+        self.directionSearches = []
+        if not self.show:
+            return
         self.contSc.set_offsets(np.empty((0, 2)))
         self.contSc.set_array([])
 
-        self.maxContSearches = []
         self.maxContSearchSc1.set_offsets(np.empty((0, 2)))
         self.maxContSearchSc2.set_offsets(np.empty((0, 2)))
         self.maxContSearchSc2.set_array([])
 
-        self.directionSearches = []
         self.dirSearchSc1.set_offsets(np.empty((0, 2)))
         self.dirSearchSc2.set_offsets(np.empty((0, 2)))
         self.dirSearchSc2.set_array([])
 
     def saveToFiles(self, show=False):
-        plt.ioff()
-        if show:
-            print("holding pic open")
-            plt.show()
-
-        print("Saving traversal.png")
-        plt.savefig(str(self.areaMap.absFolderPath / "traversal.png"))
+        if self.show:
+            plt.ioff()
+            if show:
+                print("holding pic open")
+                plt.show()
+
+            print("Saving traversal.png")
+            plt.savefig(str(self.areaMap.absFolderPath / "traversal.png"))
 
         self.areaMap.saveFit()
@@ -2,28 +2,31 @@ import asyncio
 import sys
 from datetime import datetime
 from GlobalSettings import GlobalSettings
-import threading
 from Graph import Graph
+from AlignmentGraph import AlignmentGraph
 from AreaMap import AreaMap
+from BrentContSearch import BrentContSearch
+from ContrastSweep import ContrastSweep
+from FocusCache import FocusCache
+from FocusSurface import FocusSurface
+from FrameAverager import FrameAverager
+from focusMetric import MetricCalibration
 from MaxContSearch import MaxContSearch
+from MotionScheduler import MotionScheduler
+from PhasePipeline import PhasePipeline
 from Row import Row
 from Scan import Scan
-from Traversal import BadFit, Traversal
+from SessionRecorder import RecordingClient
+from SettleDetector import SettleDetector
+from SettleModel import SettleModel
+from StageCalibration import StageCalibration
+from TilePlan import TilePlan
+from Traversal import BadFit, NoOverlap, Traversal
 import utils
-import struct
 import pathlib
 import numpy as np
-import clr
 import time
-
-clr.AddReference("System")
-import System
-from System import Array
-
-# Add reference and import KoalaRemoteClient
-sys.path.append(r"C:\\Program Files\\LynceeTec\\Koala\\Remote\\Remote Libraries\\x64")
-clr.AddReference("LynceeTec.KoalaRemote.Client")
-from LynceeTec.KoalaRemote.Client import KoalaRemoteClient
+import KoalaHost
 
 
 class FocusNotFound(Exception):
@@ -42,26 +45,68 @@ class InvalidMove(Exception):
 
 
 class KoalaController:
-    def __init__(self, host="localhost", user="user", passw="user"):
+    focusStrategies = ("brent", "linear")
+
+    def __init__(
+        self,
+        host="localhost",
+        user="user",
+        passw="user",
+        client=None,
+        show=True,
+        recordTo=None,
+        focusStrategy="brent",
+        specimen=None,
+    ):
+        """client: an already connected KoalaRemoteClient-like backend (e.g. SimKoala.SimKoalaClient). Connects to the real Koala if None
+        recordTo: session folder to record every host call into (see SessionRecorder)
+        focusStrategy: how a bracketed focus is refined. "brent" (BrentContSearch) or "linear" (nested MaxContSearch sweeps)
+        specimen: name of the specimen/holder. Focus positions are cached on disk under it and reused by later sessions
+        """
+        if focusStrategy not in KoalaController.focusStrategies:
+            raise ValueError(f"focusStrategy must be one of {KoalaController.focusStrategies}")
+        self.focusStrategy = focusStrategy
         self.basePath = pathlib.Path.cwd()
         self.settings = GlobalSettings()
-        self.host = KoalaRemoteClient()
-        ret, username = self.host.Connect(
-            host, user, True
-        )  # True is deprecated but required
-        self.host.Login(passw)
+        self.host = client if client is not None else KoalaHost.connect(host, user, passw)
+        # SimKoala and replayed sessions: learned models stay in memory instead of overwriting the instrument's files
+        self.simulated = getattr(client, "simulated", False)
+        self.recorder = None
+        if recordTo is not None:
+            self.host = self.recorder = RecordingClient(self.host, recordTo)
+        self.host = KoalaHost.SerialClient(self.host)  # the pipeline and motion threads call it too
+        self.show = show  # live graphs
         self.maxZ = None
         self.scan = None
+        self.lastSearch = None
+        self.contrastSigma = 0.3  # std of a single GetHoloContrast read, updated as we go
+        self.focusSurface = FocusSurface()  # learns focus z(x, y) of the current specimen
+        self.focusMetric = MetricCalibration()  # tile image -> contrast, see calibrateFocusMetric
         # d_focus = Z_max - Z_focus - h_real #! calibrated dont touch now
         self.focusDist = 27175 - 13207 - (7.66 - 0.16) * 1e3
         self.ABS_MAX_H = self.settings.get("ABS_MAX_Z") - self.focusDist
         self.scan = Scan(show=False)
+        self.phases = PhasePipeline(self.host)
+        self.motion = MotionScheduler(self.host)  # every MoveAxes goes through its thread, in order
+        self.settleModel = SettleModel(persist=not self.simulated)  # expected settle time per axis and distance
+        self.settle = SettleDetector(self.getPos, self.settleModel)  # fast moves poll for completion
+        self.config = 142  # for 20x objective
+        self.stageCalibration = None  # stage -> camera, for self.config. Made in setup, which knows pxSize
+        self.focusCache = None
+        if specimen is not None:
+            setup = {
+                "config": self.config,
+                "ABS_MAX_Z": self.settings.get("ABS_MAX_Z"),
+                "focusDist": self.focusDist,
+            }
+            self.focusCache = FocusCache(specimen, setup)
 
     def setup(self):
         """Initialize configuration and source state."""
-        self.host.OpenConfig(142)  # for 20x objective
+        self.host.OpenConfig(self.config)
         self.host.SetSourceState(0, True, True)
         self.pxSize = self.host.GetPxSizeUm()
+        self.stageCalibration = StageCalibration(self.config, self.pxSize, persist=not self.simulated)
         self.host.SetUnwrap2DMethod(0)
         self.host.OpenPhaseWin()
         time.sleep(0.1)
@@ -72,7 +117,8 @@ class KoalaController:
         self.maxZ = self.settings.get("ABS_MAX_Z") - h
 
     def getPos(self):
-        buffer = System.Array.CreateInstance(System.Double, 4)
+        self.motion.wait()  # a move still queued would make the position stale
+        buffer = KoalaHost.doubleArray(4)
         self.host.GetAxesPosMu(buffer)
         return np.array([buffer[0], buffer[1], buffer[2] / 10])
 
@@ -84,9 +130,9 @@ class KoalaController:
             raise Exception(f"Cannot convert z to h when z = {z}")
         return self.settings.get("ABS_MAX_Z") - self.focusDist - z
 
-    def move_to(self, x=0, y=0, z=0, h=0, fatal=True, fast=False):
-        """MUST SET self.maxZ in order to move the Z axis"""
-        # ? Fast mode does not wait for the moving to finish (according to Koala), but adds 0.4s delay. ~50% speedup for small movements
+    def move_to(self, x=0, y=0, z=0, h=0, fatal=True, fast=False, wait=True):
+        """MUST SET self.maxZ in order to move the Z axis. wait=False returns the move's Future as soon as it is queued"""
+        # ? Fast mode does not wait for the moving to finish (according to Koala), but polls until settled (or sleeps the settle time SettleModel expects). ~50% speedup for small movements
         # * give Z in joystick/real heights
         # * h is height of surface from stage.
         if h != 0:
@@ -100,100 +146,101 @@ class KoalaController:
                     raise InvalidMove(z)
                 else:
                     return False
-        ok = self.host.MoveAxes(
-            True,
-            bool(x != 0),
-            bool(y != 0),
-            bool(z != 0),
-            False,
-            int(x),
-            int(y),
-            int(z * 10),
-            0,
-            1,
-            1,
-            1,
-            1,
-            not fast,
-        )
+        settleTol = self.settings.get("SETTLE_TOL")
+        start = self.getPos() if fast and wait else None
+        move = self.motion.submit(True, x, y, z * 10, waitEnd=wait and not fast)
+        if not wait:
+            return move
+        ok = move.result()
         if fast:
-            time.sleep(0.4)
+            moving = np.array((x != 0, y != 0, z != 0))
+            target = np.where(moving, (int(x), int(y), int(z * 10) / 10), start)
+            if settleTol:
+                self.settle.tol = settleTol
+                self.settle.wait(target, moving, start)
+            else:
+                time.sleep(self.settleModel.predict(np.abs(target - start)))
         return ok
 
-    def move_rel(self, dx=0, dy=0, dz=0, fast=False):
+    def move_rel(self, dx=0, dy=0, dz=0, fast=False, wait=True):
+        """wait=False returns the move's Future as soon as it is queued"""
         # TODO should prbably put in z safeguard
-        def move():
-            return self.host.MoveAxes(
-                False,
-                bool(dx != 0),
-                bool(dy != 0),
-                bool(dz != 0),
-                False,
-                int(dx),
-                int(dy),
-                int(dz * 10),
-                0,
-                1,
-                1,
-                1,
-                1,
-                not fast,
-            )
-
+        if not wait:
+            return self.motion.submit(False, dx, dy, dz * 10, waitEnd=not fast)
         if fast:
-            thread = threading.Thread(target=move)
-            thread.start()
-            time.sleep(self.settings.get("FAST_MOVE_REL_TIME"))
+            settleTol = self.settings.get("SETTLE_TOL")
+            start = self.getPos() if settleTol else None
+            self.motion.submit(False, dx, dy, dz * 10)
+            d = np.array((int(dx), int(dy), int(dz * 10) / 10))
+            if settleTol:
+                self.settle.tol = settleTol
+                self.settle.wait(start + d, d != 0, start)
+            else:
+                time.sleep(self.settleModel.predict(np.abs(d)))
         else:
-            return move()
-
-    def phase_um(self):
-        """Load phase image to file, then read file and return numpy array with height in um"""
-        # implies SetUnwrap2DMethod == 0 (fast method). (For time saving)
-        self.host.SingleReconstruction()
-        self.host.SetUnwrap2DState(True)
-
-        # dump the displayed phase as a .bin file
-        fpath = str(self.basePath / "./tmp/phase.bin")
-        try:
-            self.host.SaveImageFloatToFile(4, fpath, True)
-        except Exception as err:
-            print("err in SaveImageFloatToFile")
-            return self.phase_um()
-
-        with open(fpath, "rb") as f:
-            hdr_ver, endian = struct.unpack("bb", f.read(2))
-            int32 = "<i" if endian == 0 else ">i"
-            float32 = "<f" if endian == 0 else ">f"
-            header_size = struct.unpack(int32, f.read(4))[0]
-            width = struct.unpack(int32, f.read(4))[0]
-            height = struct.unpack(int32, f.read(4))[0]
-            pxSize_um = struct.unpack(float32, f.read(4))[0] * 1e6
-            hconv = struct.unpack(float32, f.read(4))[0]  # * metres / radian
-            unit = struct.unpack("b", f.read(1))[0]
-            phase = np.fromfile(f, np.float32).reshape(height, width)
-
-        if unit == 1:  # 1 = rad, 2 = m
-            # [um] = [rad] * [m/rad] * [um/m]
-            phase = phase * hconv * 1e6
-        return phase, pxSize_um  # [um (height)], [um/px (x and y)]
-
-    def phaseAvg_um(self, avg=5):
+            return self.motion.submit(False, dx, dy, dz * 10, waitEnd=True).result()
+
+    def phase_um(self, rows=None, cols=None):
+        """Load phase image to file, then read file and return numpy array with height in um. rows/cols (slices) only read a window"""
+        return self.phases.get(rows, cols)  # [um (height)], [um/px (x and y)]
+
+    def phaseAvg_um(self, avg=5, prefetch=0, noiseTarget=None, noise=False):
+        """Streams up to avg + 2 frames into a FrameAverager. Frame N+1 is exported while frame N is accumulated.
+        Stops early once the per-pixel noise is under noiseTarget [um] (PHASE_NOISE_TARGET if None, 0 = never).
+        prefetch > 0 leaves frames exporting for the next call, so only use it if the stage won't move (then call self.phases.drain())
+        Returns (phase [um], pxSize [um/px]) and the per-pixel noise [um] if noise=True
+        """
+        if noiseTarget is None:
+            noiseTarget = self.settings.get("PHASE_NOISE_TARGET")
+        clip = self.settings.get("FRAME_SIGMA_CLIP") or None
         avg += 2
         avg = max(avg - 1, 0)
-        phase0, pxSize = self.phase_um()
-        phases = [self.phase_um()[0] for _ in range(avg)]
-        return np.mean((phase0, *phases), axis=0), pxSize
-
-    def getContrast(self, avg=5):
+        frames = self.phases.take(avg + 1, prefetch=prefetch)
+        phase0, pxSize = next(frames)
+        averager = FrameAverager(phase0.shape, clip=clip)
+        averager.add(phase0)
+        for phase, _ in frames:
+            averager.add(phase)
+            if noiseTarget and averager.noiseLevel() < noiseTarget:
+                print(f"Noise target reached after {averager.frames} frames")
+                break
+        if prefetch == 0:
+            self.phases.drain()  # frames left over from stopping early
+
+        if noise:
+            return averager.result(), pxSize, averager.noise()
+        return averager.result(), pxSize
+
+    def getContrast(self, avg=5, threshold=None, maxAvg=None):
+        """Mean of the highest half of avg contrast samples.
+        If threshold is given (and CONTRAST_CONFIDENCE > 0), samples only until the mean is confidently above or
+        below it, using at most maxAvg (default avg) samples. Clear-cut cases take 1 or 2 reconstructions. Returns the
+        plain mean then, since the highest half of 1 or 2 samples is biased differently than of 5"""
+        confidence = self.settings.get("CONTRAST_CONFIDENCE")
+        adaptive = threshold is not None and confidence > 0
+        maxAvg = avg if maxAvg is None else maxAvg
         contrasts = []
-        for i in range(0, avg):
+        for i in range(0, maxAvg if adaptive else avg):
             self.host.SingleReconstruction()
             contrasts.append(self.host.GetHoloContrast())
+            if adaptive:
+                estimate, stdErr = self.contrastEstimate(contrasts)
+                if abs(estimate - threshold) > confidence * stdErr:
+                    break
 
+        if len(contrasts) >= 3:  # learn the read noise for the next adaptive calls
+            self.contrastSigma = 0.8 * self.contrastSigma + 0.2 * np.std(contrasts, ddof=1)
+        if adaptive:
+            return self.contrastEstimate(contrasts)[0]
         highest_half = np.partition(contrasts, -avg // 2)[-avg // 2 :]
         return np.mean(highest_half)
 
+    def contrastEstimate(self, contrasts):
+        """(mean, its standard error). Unbiased whatever the number of samples"""
+        n = len(contrasts)
+        sigma = np.std(contrasts, ddof=1) if n >= 3 else self.contrastSigma
+        return np.mean(contrasts), sigma / np.sqrt(n)
+
     def searchUntilDecrease(self, search: MaxContSearch):
         """Search from z_1 to z_2 until the first decrease in contrast. Throws if contrast never decreased"""
         print(
@@ -202,13 +249,17 @@ class KoalaController:
 
         search.logXYPos(*self.getPos()[:2])
         self.scan.startLogMaxContSearch(search)
+        self.lastSearch = search  # the one that returns, if this recurses
 
         # search
         for z in np.arange(search.z_1, search.z_2, search.step * search.direction):
             self.move_to(z=z, fast=True)
-            search.newContPt(self.getContrast(avg=search.avg), z)
+            cont = self.getContrast(avg=search.avg, threshold=search.decisionThreshold())
+            search.newContPt(cont, z)
             self.scan.updateGraph()
 
+            if search.isPeakPredicted():
+                return search.getPredictedInterval()
             if search.isAtLocalMaxCont():
                 return search.getRecentMaxContInterval()
 
@@ -227,50 +278,168 @@ class KoalaController:
             return self.searchUntilDecrease(search.emptyCopy())
         raise FocusNotFound()
 
-    def find_focus(self, direction=-1):
-        """Finds the focus from scratch. Can throw FocusNotFound error if nothing is found. Return (contrast, z)at max contrast"""
-        # ? Convention: z's are from the top, h's are from the bottom with focus distance included.
-        # * Direction: -1 for stage going down, 1 for stage going up
-        maxZ = self.maxZ - self.focusDist / 2
+    def sweepUntilDecrease(self, sweep: ContrastSweep):
+        """Samples contrast while one long move goes from z_1 to z_2, and stops the stage once the contrast has dropped
+        past a peak. Throws FocusNotFound if the contrast was never over minContrast"""
+        print(f"Sweeping for max contrast from z_1 = {int(sweep.z_1)} to z_2 = {int(sweep.z_2)}")
+        self.move_to(z=sweep.z_1)
+        sweep.logXYPos(*self.getPos()[:2])
+        self.scan.startLogMaxContSearch(sweep)
+        self.lastSearch = sweep
+
+        def logPos():
+            t0 = time.monotonic()
+            z = self.getPos()[2]
+            sweep.logPos((t0 + time.monotonic()) / 2, z)
+
+        logPos()
+        self.move_to(z=sweep.z_2, wait=False)
+        while not sweep.done():
+            t0 = time.monotonic()
+            self.host.SingleReconstruction()
+            t1 = time.monotonic()
+            sweep.logCont(t0 + ContrastSweep.captureFrac * (t1 - t0), self.host.GetHoloContrast())
+            logPos()
+        if not sweep.arrived:
+            self.move_to(z=self.getPos()[2])  # retarget the running move to stop it here
+
+        sweep.finish()
+        self.scan.updateGraph()
+        I = sweep.getMaxContInterval()
+        if I is None:
+            raise FocusNotFound()
+        # sweep contrasts are single reads on the move, measure the max again standing still for the refinement
+        zMax = I[1][1]
+        self.move_to(z=zMax, fast=True)
+        I[1] = (self.getContrast(avg=10), zMax)
+        return I
+
+    def searchBrent(self, search: BrentContSearch):
+        """Refine a bracketed max contrast with Brent's method. Returns the interval with the max contrast in the middle"""
+        print(
+            f"Refining max contrast between z_1 = {int(search.z_1)} and z_2 = {int(search.z_2)} with Brent's method (avg = {search.avg})"
+        )
+        search.logXYPos(*self.getPos()[:2])
+        self.scan.startLogMaxContSearch(search)
 
-        # running max interval
-        I = []
-        I = self.searchUntilDecrease(
-            MaxContSearch(
-                0,
-                maxZ,
-                direction,
-                minContrast=self.settings.get("IDEAL_NOISE_CUTOFF"),
-                step=200,
-                avg=5,
-            )
-        )  # will throw NoFocusFound if nothing found
-        I = self.searchUntilDecrease(
+        z = search.nextZ()
+        while z is not None:
+            self.move_to(z=z, fast=True)
+            search.newContPt(self.getContrast(avg=search.avg), z)
+            self.scan.updateGraph()
+            z = search.nextZ()
+        return search.getMaxContInterval()
+
+    def refineMaxCont(self, I, minContrast, subdivisions, avg):
+        """Narrow down a max contrast interval I (3 points, max in the middle) with self.focusStrategy"""
+        if self.focusStrategy == "brent":
+            # a read is the mean of the highest half of avg samples
+            contNoise = self.contrastSigma / np.sqrt(max(avg // 2, 1))
+            return self.searchBrent(BrentContSearch(I, minContrast, contNoise=contNoise, avg=avg))
+        return self.searchUntilDecrease(
             MaxContSearch(
                 I[0][1],
                 I[-1][1],
                 # start on the side with higher contrast
                 np.sign(I[-1][0] - I[0][0]),
-                minContrast=I[1][0] * 0.9,
-                subdivisions=12,
-                avg=10,
+                minContrast=minContrast,
+                subdivisions=subdivisions,
+                avg=avg,
             )
         )
-        I = self.searchUntilDecrease(
-            MaxContSearch(
-                I[0][1],
-                I[-1][1],
-                # start on the side with higher contrast
-                np.sign(I[-1][0] - I[0][0]),
-                minContrast=I[1][0] * 0.9,
-                subdivisions=10,
-                avg=20,
+
+    def searchCachedFocus(self, minContrast):
+        """Searches +- FOCUS_CACHE_BRACKET around the focus z a previous session found here.
+        Returns the max contrast interval, or None if nothing is cached here or the focus isn't in the bracket anymore
+        """
+        if self.focusCache is None or not self.settings.get("FOCUS_CACHE_BRACKET"):
+            return None
+        x, y, _ = self.getPos()
+        zCached = self.focusCache.lookup(x, y)
+        if zCached is None:
+            return None
+        print(f"Focus cached @ z = {zCached:.1f}")
+        I = self.searchBracket(zCached, minContrast)
+        if I is None:
+            print("Cached focus is stale here, forgetting it")
+            self.focusCache.invalidate(x, y)
+        return I
+
+    def searchBracket(self, zCenter, minContrast):
+        """Searches +- FOCUS_CACHE_BRACKET around zCenter. Returns the max contrast interval, or None if the focus
+        isn't in the bracket"""
+        bracket = self.settings.get("FOCUS_CACHE_BRACKET")
+        zMin, zMax = max(zCenter - bracket, 0), min(zCenter + bracket, self.maxZ - self.focusDist / 2)
+        print(f"Searching z = {int(zMin)} to {int(zMax)}")
+
+        dontTryAgain = MaxContSearch.dontTryAgain
+        MaxContSearch.dontTryAgain = True
+        try:
+            return self.searchUntilDecrease(
+                MaxContSearch(
+                    zMin,
+                    zMax,
+                    1,
+                    minContrast,
+                    step=50,
+                    peakTol=self.settings.get("FOCUS_Z_TOL"),
+                )
             )
-        )
+        except (FocusNotFound, InvalidMove):
+            return None
+        finally:
+            MaxContSearch.dontTryAgain = dontTryAgain
+
+    def learnFocus(self, cont, pos, weight=1.0):
+        """Remember a focused position for this session (focusSurface) and the next ones (focusCache)"""
+        self.focusSurface.add(*pos, weight=weight)
+        if self.focusCache is not None:
+            self.focusCache.add(*pos, cont)
+
+    def find_focus(self, direction=-1, sweep=True):
+        """Finds the focus from scratch (or from the focus cache). Can throw FocusNotFound error if nothing is found. Return (contrast, z)at max contrast
+        sweep: locate the focus with one continuous move (sweepUntilDecrease) instead of stopping every 200um"""
+        # ? Convention: z's are from the top, h's are from the bottom with focus distance included.
+        # * Direction: -1 for stage going down, 1 for stage going up
+        maxZ = self.maxZ - self.focusDist / 2
+        minContrast = self.settings.get("IDEAL_NOISE_CUTOFF")
+        peakTol = self.settings.get("FOCUS_Z_TOL")
+
+        # running max interval
+        I = self.searchCachedFocus(minContrast)
+        if I is None and sweep:
+            try:
+                # z=1, z=0 means "don't move z" to move_to
+                I = self.sweepUntilDecrease(
+                    ContrastSweep(1, maxZ, direction, minContrast, peakTol=peakTol)
+                )
+            except FocusNotFound:
+                print("Sweep found nothing, searching step by step")
+        if I is None:
+            I = self.searchUntilDecrease(
+                MaxContSearch(
+                    0,
+                    maxZ,
+                    direction,
+                    minContrast=minContrast,
+                    step=200,
+                    avg=5,
+                    peakTol=peakTol,
+                )
+            )  # will throw NoFocusFound if nothing found
+        if self.lastSearch.predicted:
+            pass  # the contrast curve model already located the peak closely enough
+        elif self.focusStrategy == "brent":
+            I = self.refineMaxCont(I, I[1][0] * 0.9, None, avg=10)
+        else:
+            I = self.refineMaxCont(I, I[1][0] * 0.9, subdivisions=12, avg=10)
+            I = self.refineMaxCont(I, I[1][0] * 0.9, subdivisions=10, avg=20)
         zFocus = I[1][1]
         self.move_to(z=zFocus)
         print(f"Found focus @ z = {int(zFocus)}")
-        return I[1][0], self.getPos()
+        pos = self.getPos()
+        self.learnFocus(I[1][0], pos)
+        return I[1][0], pos
 
     def find_maximising_dir(self, minContrast):
         """Go up and down a bit and see which direction has increasing contrast. Then goes to the less focused point
@@ -304,6 +473,15 @@ class KoalaController:
         if minContrast == None:
             minContrast = self.settings.get("IDEAL_NOISE_CUTOFF")
 
+        I = self.searchCachedFocus(minContrast)
+        if I is not None:
+            if not self.lastSearch.predicted:
+                I = self.refineMaxCont(I, I[1][0], subdivisions=10, avg=10)
+            self.move_to(z=I[1][1])
+            pos = self.getPos()
+            self.learnFocus(I[1][0], pos)
+            return I[1][0], pos
+
         maximisingDir = None
         try:
             maximisingDir = self.find_maximising_dir(minContrast)
@@ -328,22 +506,16 @@ class KoalaController:
                     maximisingDir,
                     minContrast,
                     step=50,  # safe to do a small step beacuse we're already half focused, and the focus depth is not that big
+                    peakTol=self.settings.get("FOCUS_Z_TOL"),
                 ),
             )
-            I = self.searchUntilDecrease(
-                MaxContSearch(
-                    I[0][1],
-                    I[-1][1],
-                    # start on the side with higher contrast
-                    np.sign(I[-1][0] - I[0][0]),
-                    minContrast=I[1][0],
-                    subdivisions=10,
-                    avg=10,
-                )
-            )
+            if not self.lastSearch.predicted:
+                I = self.refineMaxCont(I, I[1][0], subdivisions=10, avg=10)
             print(f"Found focus {I[1][0]} @ z = {int(I[1][1])}")
             self.move_to(z=I[1][1])
-            return I[1][0], self.getPos()
+            pos = self.getPos()
+            self.learnFocus(I[1][0], pos)
+            return I[1][0], pos
         except FocusNotFound:  # maybe we got maximising direction wrong?
             print("No focus found. Trying total search")
             # will throw if found nothing
@@ -351,7 +523,7 @@ class KoalaController:
 
     def ensureFocus(self, minContrast, avg=5):
         """Sees if focused, if not, maximizesFocus. Returns (contrast, pos)"""
-        cont = self.getContrast(avg=avg)
+        cont = self.getContrast(avg=avg, threshold=minContrast)
         pos = self.getPos()
 
         self.scan.logContrast(*pos, cont)
@@ -359,9 +531,39 @@ class KoalaController:
 
         # Could make this more advanced, where min contrast could be a functino of how big your step was, and your slope
         if cont > minContrast:
+            # only roughly focused, so it counts less than a search result
+            self.learnFocus(cont, pos, weight=0.25)
             return cont, pos  # already focused
         return self.maximizeFocus()
 
+    def calibrateFocusMetric(self, span=150, steps=7):
+        """Measures GetHoloContrast and the focus metric of a tile (same averaging as mapRow's) at steps z's within
+        +- span of the current (focused) z, and fits the metric -> contrast mapping. Returns to the starting z"""
+        x, y, z0 = self.getPos()
+        metricValues, contrasts = [], []
+        for dz in np.linspace(-span, span, steps):
+            if self.move_to(z=z0 + dz, fatal=False) is False:
+                continue
+            contrasts.append(self.getContrast(avg=5))
+            phase, _ = self.phaseAvg_um(avg=0)
+            metricValues.append(self.focusMetric(phase))
+        self.move_to(z=z0)
+        return self.focusMetric.calibrate(metricValues, contrasts)
+
+    def canCheckTiles(self):
+        """True if the focus metric calibration fits well enough (FOCUS_METRIC_MIN_R2) to judge focus from tiles"""
+        minR2 = self.settings.get("FOCUS_METRIC_MIN_R2")
+        return bool(minR2) and self.focusMetric.r2 >= minR2
+
+    def startContrast(self, pic):
+        """Contrast of the focused picture the next ones are compared to: from pic if tiles can be checked and it has
+        valid pixels, else with GetHoloContrast"""
+        if self.canCheckTiles():
+            cont = self.focusMetric.contrast(pic)
+            if np.isfinite(cont):
+                return cont
+        return self.getContrast()
+
     def smart_move_rel(self, dx=0, dy=0, fast=False):
         phase, pxSize = self.phase_um()
 
@@ -374,6 +576,20 @@ class KoalaController:
         self.move_rel(dx, dy, dz, fast=fast)
         return dz
 
+    def predictive_move_rel(self, dx=0, dy=0, fast=False):
+        """Moves by (dx, dy) straight to the focus z predicted by self.focusSurface and returns True if the prediction
+        is within FOCUS_SURFACE_TOL. Otherwise does a smart_move_rel (plane fit) and returns False"""
+        x, y, z = self.getPos()
+        prediction = self.focusSurface.predict(x + dx, y + dy)
+        tol = self.settings.get("FOCUS_SURFACE_TOL")
+        if prediction is not None and tol and prediction[1] <= tol:
+            zPred, uncert = prediction
+            if self.move_to(x + dx, y + dy, zPred, fatal=False, fast=fast) is not False:
+                print(f"Moved to predicted focus z = {zPred:.1f} ± {uncert:.1f}")
+                return True
+        self.smart_move_rel(dx, dy, fast=fast)
+        return False
+
     def stepToExtreme(self, dir, speed=100_000, maxStep=300):
         """Dir = 1 for the top of a convex object, dir =-1 for the bottom of a concave object"""
         # ?* Assumes already focused
@@ -409,72 +625,291 @@ class KoalaController:
 
     def mapRow(self, row: Row):
         """Asumes we are focused at the center of the row. The row has already been initialized at the center"""
-        startCont = self.getContrast()
+        startCont = self.startContrast(row.centerPic)
         pos = self.getPos()
         self.scan.logContrast(*pos, startCont)
 
         while not row.done:
             t0 = time.time()
-            self.smart_move_rel(dx=row.moveDir * row.stepX, fast=True)
+            dx, dy = row.moveDir * row.stepRight
+            predicted = self.predictive_move_rel(dx=dx, dy=dy, fast=True)
+            # with a calibrated focus metric the tile itself tells if we're focused, no reconstructions needed
+            checkTile = self.canCheckTiles()
 
             try:
                 MaxContSearch.dontTryAgain = True
-                cont, (x, y, z) = self.ensureFocus(minContrast=startCont * 0.5, avg=3)
+                if predicted or checkTile:  # the contrast check is skipped, or done on the tile
+                    x, y, z = self.getPos()
+                else:
+                    cont, (x, y, z) = self.ensureFocus(minContrast=startCont * 0.5, avg=3)
 
                 if row.prematureEdge(x):
                     raise FocusNotFound
+
+                for i in range(1000):  # try 1000 times at maximum
+                    try:
+                        # once retrying, the next attempt's first frame is exported while this one is stitched
+                        phase, _ = self.phaseAvg_um(avg=i // 100, prefetch=int(i > 0))
+                        if checkTile:
+                            cont = self.focusMetric.contrast(phase)
+                            self.scan.logContrast(x, y, z, cont)
+                            if not (cont >= startCont * 0.5):
+                                raise BadFit  # refocus and take the tile again
+                            if not predicted:  # don't learn the surface's own predictions back
+                                self.learnFocus(cont, (x, y, z), weight=0.25)
+                        row.addToStitch(phase, pos=(x, y, z))
+                        row.tileStore.add(phase, (x, y, z))
+                        break
+                    except NoOverlap:  # the tile is focused but the lens ends in the seam
+                        raise FocusNotFound
+                    except BadFit:
+                        if predicted or checkTile:  # focus was never checked, make sure we didn't go off the edge
+                            predicted = checkTile = False
+                            self.phases.drain()
+                            self.ensureFocus(minContrast=startCont * 0.5, avg=3)
+                else:
+                    raise Exception("Could not find a valid stitch")  # not caught
+                self.phases.drain()  # drop the unused prefetched frame before moving
             except FocusNotFound:
                 row.atEdge(*self.getPos())
                 self.move_to(*row.centerPos)
                 continue
-
-            for i in range(1000):  # try 1000 times at maximum
-                try:
-                    phase, _ = self.phaseAvg_um(avg=i // 100)
-                    row.addToStitch(phase)
-                    break
-                except BadFit:
-                    ...
-            else:
-                raise Exception("Could not find a valid stitch")  # not caught
             picTime = time.time() - t0
             print(f"Total Pic time: {picTime:.3f}s")
 
     def mapProfile(self, curvature, maxRadius=None):
         """Curvature=1, traverse to top, =-1 to bottom, =0 dont traverse at all"""
         if curvature != 0:  # convex
-            self.scan = Scan(show=True)
+            self.scan = Scan(show=self.show)
             startCont, center = self.traverseToExtreme(dir=curvature)
             self.scan.saveToFiles()
         else:
             self.move_to(58249.36, 52110, 12227.2)  # TODO just for debugging, remove
             center = self.getPos()
+        if self.settings.get("FOCUS_METRIC_MIN_R2"):
+            self.calibrateFocusMetric()
 
         phase, pxSize = self.phaseAvg_um(avg=1)
-        areaMap = AreaMap(True, phase.shape, pxSize, maxRadius, curvature)
-        self.scan = Graph(areaMap=areaMap)
+        areaMap = AreaMap(True, phase.shape, pxSize, maxRadius, curvature, calibration=self.stageCalibration)
+        self.scan = Graph(areaMap=areaMap, show=self.show)
         row = areaMap.nextRow()
         row.initCenter(phase, pxSize, center, None, 0)
+        areaMap.tileStore.add(phase, center)
         self.mapRow(row)
 
         areaMap.saveImages()
+        areaMap.tileStore.close()
         self.scan.saveToFiles(show=False)
 
-    def mapArea(self, curvature, circle, maxRadius=None):
-        """Curvature=1, traverse to top, =-1 to bottom, =0 dont traverse at all"""
+    def predictFocusZ(self, x, y):
+        """Focus z expected at (x, y): from focusSurface if it's within FOCUS_CACHE_BRACKET, else from the focusCache.
+        None if neither knows"""
+        prediction = self.focusSurface.predict(x, y)
+        if prediction is not None and prediction[1] <= self.settings.get("FOCUS_CACHE_BRACKET"):
+            return prediction[0]
+        if self.focusCache is not None:
+            return self.focusCache.lookup(x, y)
+        return None
+
+    def focusTile(self, tile, minContrast):
+        """Moves to a planned tile at its predicted z (a plane fit of the current picture if there's none) and makes sure
+        it's focused: not checked if focusSurface is within FOCUS_SURFACE_TOL, from the tile's image if the focus metric
+        is calibrated, else with GetHoloContrast. Refocusing only searches +- FOCUS_CACHE_BRACKET, so tiles off the
+        specimen fail fast. Returns (focused, phase). phase is the tile's picture if the check took one"""
+        prediction = self.focusSurface.predict(tile.x, tile.y)
+        tol = self.settings.get("FOCUS_SURFACE_TOL")
+        if tile.z is None or self.move_to(tile.x, tile.y, tile.z, fatal=False, fast=True) is False:
+            x, y, _ = self.getPos()
+            self.smart_move_rel(tile.x - x, tile.y - y, fast=True)
+        if prediction is not None and tol and prediction[1] <= tol:
+            return True, None
+        pos = self.getPos()
+
+        phase = None
+        if self.canCheckTiles():
+            phase, _ = self.phaseAvg_um(avg=0)
+            cont = self.focusMetric.contrast(phase)
+        else:
+            cont = self.getContrast(avg=3, threshold=minContrast)
+        self.scan.logContrast(*pos, cont)
+        if cont >= minContrast:
+            self.learnFocus(cont, pos, weight=0.25)
+            return True, phase
+
+        if not self.settings.get("FOCUS_CACHE_BRACKET"):
+            try:
+                self.maximizeFocus(minContrast)
+                return True, None
+            except FocusNotFound:
+                return False, None
+        I = self.searchBracket(pos[2], minContrast)
+        if I is None:
+            return False, None
+        if not self.lastSearch.predicted:
+            I = self.refineMaxCont(I, I[1][0], subdivisions=10, avg=10)
+        self.move_to(z=I[1][1])
+        self.learnFocus(I[1][0], self.getPos())
+        return True, None
+
+    def mapPlanned(self, areaMap, center, centerPic):
+        """Maps the tiles of a TilePlan row by row from the top (serpentine) instead of finding the edges center out.
+        A row is stitched from its first tile and hangs below the last row by its center column tile, as the plan's
+        stitch parents. Tiles without focus are pruned with the rest of their row outwards. Returns the plan"""
+        plan = TilePlan.fromPic(
+            center, areaMap.picShape, areaMap.pxSize, areaMap.maxRadius, areaMap.circle, calibration=areaMap.calibration
+        )
+        startCont = self.startContrast(centerPic)
+        minContrast = startCont * 0.5
+        areaMap.moveDir = 1  # every row is stitched below the last one
+        MaxContSearch.dontTryAgain = True
+
+        lastRow = None
+        for tiles in plan.rowRuns():
+            self.scan.clear()
+            plan.predict(self.predictFocusZ)
+            row, hasCenter, lastTile = None, False, None
+            for tile in tiles:
+                if tile.state != "todo":
+                    continue
+                focused, phase = self.focusTile(tile, minContrast)
+                if focused:
+                    pos = self.getPos()
+                    for i in range(1000):  # try 1000 times at maximum
+                        try:
+                            if phase is None:
+                                phase, _ = self.phaseAvg_um(avg=i // 100, prefetch=int(i > 0))
+                            if row is None:
+                                row = areaMap.nextRow()
+                                row.initCenter(phase, areaMap.pxSize, pos, None, 0)
+                                row.moveDir = 1 if tiles[-1].i > tiles[0].i else -1
+                            else:
+                                row.addToStitch(phase, isCenter=tile.i == 0, pos=pos)
+                            break
+                        except NoOverlap:  # focused, but the lens ends in the seam. Taking it again won't help
+                            print(f"Seam of {tile} is off the lens, pruning it")
+                            focused = False
+                            break
+                        except BadFit:
+                            phase = None
+                    else:
+                        raise Exception("Could not find a valid stitch")  # not caught
+                    self.phases.drain()  # drop the unused prefetched frame before moving
+                if not focused:
+                    inwards = lastTile is not None and abs(tile.i) < abs(lastTile.i)
+                    if row is not None and inwards:
+                        print(f"Gap in row {tile.j} at {tile}, starting the row over")
+                        areaMap.dropRow(row)
+                        row, hasCenter = None, False
+                    plan.prune(tile, outwards=row is not None)
+                    continue
+
+                areaMap.tileStore.add(phase, pos, tile.key)
+                hasCenter = hasCenter or tile.i == 0
+                lastTile = tile
+                plan.markDone(tile)
+                print(plan.progress())
+
+            if row is None:
+                continue
+            if not hasCenter:
+                areaMap.dropRow(row)
+                if lastRow is not None:
+                    print(f"Row {tiles[0].j} has no center tile to stitch the rows below with, stopping")
+                    plan.pruneRemaining()
+                    break
+                continue
+            row.wait()
+            row.done = True
+            if lastRow is not None:
+                try:
+                    shift, zDiff = areaMap.getShift(lastRow.centerPic, row.centerPic, lastRow.centerPos, row.centerPos)
+                except BadFit as err:  # the stage moved on, trust it instead of taking the center tile again
+                    nominal = np.array((areaMap.picShape[0] - AreaMap.yOverlap, 0))
+                    stageDelta = np.asarray(row.centerPos[:2], float) - np.asarray(lastRow.centerPos[:2], float)
+                    predicted = utils.stageToPx(stageDelta, areaMap.pxSize, areaMap.calibration) - nominal
+                    shift = np.round(predicted).astype(int)
+                    print(f"Row {tiles[0].j} didn't register ({type(err).__name__}), using the stage's shift {shift}")
+                    zDiff = utils.getZDiff(
+                        shift, lastRow.centerPic[-AreaMap.yOverlap :], row.centerPic[: AreaMap.yOverlap]
+                    )
+                row.shift, row.zDiff = shift, lastRow.zDiff + zDiff
+            areaMap.addToStitch(row)
+            lastRow = row
+
+        areaMap.wait()
+        areaMap.done = True
+        print(f"Tile plan done, {plan.progress()}")
+        return plan
+
+    def mapPlannedDeferred(self, areaMap, center, centerPic):
+        """Like mapPlanned, but nothing is stitched while mapping: every focused tile is taken once and recorded in an
+        AlignmentGraph, then all neighbouring seams are registered and solved together and composited at the end.
+        A seam that doesn't fit only loses an edge, so no tile is taken again. Returns (plan, graph)"""
+        plan = TilePlan.fromPic(
+            center, areaMap.picShape, areaMap.pxSize, areaMap.maxRadius, areaMap.circle, calibration=areaMap.calibration
+        )
+        startCont = self.startContrast(centerPic)
+        minContrast = startCont * 0.5
+        graph = AlignmentGraph(areaMap.pxSize, areaMap.calibration)
+        MaxContSearch.dontTryAgain = True
+
+        for tiles in plan.rowRuns():
+            self.scan.clear()
+            plan.predict(self.predictFocusZ)
+            lastTile = None
+            for tile in tiles:
+                if tile.state != "todo":
+                    continue
+                focused, phase = self.focusTile(tile, minContrast)
+                if not focused:
+                    outwards = lastTile is not None and abs(tile.i) > abs(lastTile.i)
+                    plan.prune(tile, outwards=outwards)  # a gap inwards is just a missing tile
+                    continue
+                if phase is None:
+                    phase, _ = self.phaseAvg_um(avg=0)
+                pos = self.getPos()
+                graph.addTile(tile.key, phase, pos)
+                areaMap.tileStore.add(phase, pos, tile.key)
+                lastTile = tile
+                plan.markDone(tile)
+                print(plan.progress())
+
+        graph.measure()
+        graph.solve()
+        areaMap.tileStore.setEdges(graph.edges)
+        centerRowKeys = [key for key in graph.tiles if key[1] == 0]
+        profile = graph.composite(centerRowKeys).dense() if centerRowKeys else None
+        areaMap.setMosaic(graph.composite(), profile, len(graph.tiles))
+        areaMap.saveImages()
+        areaMap.done = True
+        print(f"Tile plan done, {plan.progress()}")
+        return plan, graph
+
+    def mapArea(self, curvature, circle, maxRadius=None, planned=False, deferred=False):
+        """Curvature=1, traverse to top, =-1 to bottom, =0 dont traverse at all
+        planned: visit the tiles of a TilePlan (mapPlanned, needs maxRadius) instead of finding the edges center out
+        deferred: with planned, solve all seams together at the end instead of stitching as we go (mapPlannedDeferred)"""
         if curvature != 0:
-            self.scan = Scan(show=True)
+            self.scan = Scan(show=self.show)
             startCont, center = self.traverseToExtreme(dir=curvature)
             self.scan.saveToFiles()
         else:
             self.move_to(58249.36, 52110, 12227.2)  # TODO just for debugging, remove
             center = self.getPos()
+        if self.settings.get("FOCUS_METRIC_MIN_R2"):
+            self.calibrateFocusMetric()
 
         phase, pxSize = self.phaseAvg_um(avg=1)
-        areaMap = AreaMap(True, phase.shape, pxSize, maxRadius, curvature, circle)
-        self.scan = Graph(areaMap=areaMap)
-        row = areaMap.nextRow()
-        row.initCenter(phase, pxSize, center, None, 0)
+        areaMap = AreaMap(True, phase.shape, pxSize, maxRadius, curvature, circle, self.stageCalibration)
+        self.scan = Graph(areaMap=areaMap, show=self.show)
+        if planned and deferred:
+            self.mapPlannedDeferred(areaMap, center, phase)  # sets areaMap.done
+        elif planned:
+            self.mapPlanned(areaMap, center, phase)  # sets areaMap.done
+        else:
+            row = areaMap.nextRow()
+            row.initCenter(phase, pxSize, center, None, 0)
+            areaMap.tileStore.add(phase, center)
 
         # * for each row:
         while not areaMap.done:
@@ -483,14 +918,24 @@ class KoalaController:
                 self.mapRow(row)
                 areaMap.addToStitch(row)
 
-            self.smart_move_rel(dy=areaMap.moveDir * areaMap.stepY)
-            startCont = self.getContrast()
+            dx, dy = areaMap.moveDir * areaMap.stepDown
+            self.predictive_move_rel(dx=dx, dy=dy)
             pos = self.getPos()
 
             try:
                 MaxContSearch.dontTryAgain = True
-                cont, (x, y, z) = self.ensureFocus(minContrast=startCont * 0.5, avg=3)
-
+                phase = None
+                if self.canCheckTiles():  # judge focus from the row's center tile, which is needed anyway
+                    phase, _ = self.phaseAvg_um(avg=0)
+                    cont = self.focusMetric.contrast(phase)
+                    self.scan.logContrast(*pos, cont)
+                    if not (cont >= self.settings.get("IDEAL_NOISE_CUTOFF")):
+                        phase = None
+                if phase is None:
+                    startCont = self.getContrast()
+                    self.ensureFocus(minContrast=startCont * 0.5, avg=3)
+
+                x, y, z = pos
                 if areaMap.prematureEdge(y):
                     raise FocusNotFound
             except FocusNotFound:
@@ -501,19 +946,42 @@ class KoalaController:
 
             for i in range(1000):  # try 1000 times at maximum
                 try:
-                    phase, _ = self.phaseAvg_um(avg=i // 100)
-                    shift, zDiff = areaMap.getShift(row.centerPic, phase)
+                    if phase is None:
+                        phase, _ = self.phaseAvg_um(avg=i // 100, prefetch=int(i > 0))
+                    shift, zDiff = areaMap.getShift(row.centerPic, phase, row.centerPos, pos)
                     curZDiff = row.zDiff
                     row = areaMap.nextRow()
                     row.initCenter(phase, pxSize, pos, shift, curZDiff + zDiff)
+                    areaMap.tileStore.add(phase, pos)
+                    break
+                except NoOverlap:  # the lens ends in the seam, another picture won't register either
+                    phase = None
                     break
                 except BadFit:
-                    ...
+                    phase = None
             else:
                 raise Exception("Could not find a valid stitch")  # not caught
+            self.phases.drain()  # drop the unused prefetched frame before moving
+            if phase is None:
+                areaMap.atEdge(*pos)
+                row = areaMap.centerRow
+                self.move_to(*center)
 
+        areaMap.tileStore.close()
         self.scan.saveToFiles(show=False)
+        if self.focusCache is not None:
+            self.focusCache.save()
+        return areaMap
 
     def logout(self):
         """Logout from the Koala remote client."""
+        self.phases.close()
+        self.motion.close()
+        if self.settle.stats:
+            print(self.settle.summary())
+            self.settleModel.save()
+        if self.focusCache is not None:
+            self.focusCache.save()
         self.host.Logout()
+        if self.recorder is not None:
+            self.recorder.close()
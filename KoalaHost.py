@@ -0,0 +1,50 @@
+import sys
+import threading
+
+KOALA_REMOTE_PATH = r"C:\\Program Files\\LynceeTec\\Koala\\Remote\\Remote Libraries\\x64"
+
+
+def connect(host="localhost", user="user", passw="user"):
+    """Connects to the real Koala through pythonnet. Only works on the instrument PC"""
+    import clr
+
+    clr.AddReference("System")
+    import System  # noqa: F401, puts System in sys.modules so doubleArray makes real Double[] out parameters
+    # Add reference and import KoalaRemoteClient
+    sys.path.append(KOALA_REMOTE_PATH)
+    clr.AddReference("LynceeTec.KoalaRemote.Client")
+    from LynceeTec.KoalaRemote.Client import KoalaRemoteClient
+
+    client = KoalaRemoteClient()
+    ret, username = client.Connect(host, user, True)  # True is deprecated but required
+    client.Login(passw)
+    return client
+
+
+def doubleArray(n):
+    """Out parameter for calls like GetAxesPosMu. System.Double[] for the real Koala, a plain list for python backends"""
+    if "System" in sys.modules:
+        import System
+
+        return System.Array.CreateInstance(System.Double, n)
+    return [0.0] * n
+
+
+class SerialClient:
+    """Wraps a Koala client so only one call runs at a time. PhasePipeline, MotionScheduler and the caller each call
+    from their own thread, and nothing says KoalaRemoteClient is thread safe"""
+
+    def __init__(self, client):
+        self.client = client
+        self.lock = threading.RLock()
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args):
+            with self.lock:
+                return attr(*args)
+
+        return call
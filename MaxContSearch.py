@@ -1,5 +1,7 @@
 import copy as copyLib
 
+from ContrastCurve import ContrastCurve
+
 
 class MaxContSearch:
     dontTryAgain = False
@@ -13,12 +15,18 @@ class MaxContSearch:
         subdivisions=None,
         step=None,
         avg=5,
+        peakTol=None,
+        model="gaussian",
     ):
         interval = self.zsToInterval(z_a, z_b, direction)
         (self.z_1, self.z_2) = interval
         self.direction = direction
         self.minContrast = minContrast
         self.avg = avg
+        # stop once a fitted contrast curve pins the peak down to +-peakTol (95%). None = always sweep
+        self.peakTol = peakTol
+        self.curve = ContrastCurve(model) if peakTol else None
+        self.predicted = False
 
         if subdivisions != None:
             self.step = abs(z_a - z_b) / subdivisions
@@ -47,12 +55,45 @@ class MaxContSearch:
     def newContPt(self, cont, z):
         self.contPts.append((cont, z))
 
+    def decisionThreshold(self):
+        """The contrast the next point has to be compared to: 0.1 under the candidate peak (contPts[-3] once the next
+        point is in) for isAtLocalMaxCont, but never under minContrast since noise points can't be a max anyway"""
+        peak = self.contPts[-2][0]
+        return max(peak - 0.1, self.minContrast)
+
     def isAtLocalMaxCont(self):
         maxGreaterThanLast = self.contPts[-3][0] - self.contPts[-1][0] > 0.1
         maxGreaterThan2ndLast = self.contPts[-3][0] - self.contPts[-2][0] > 0.1
         maxIsNotNoise = self.contPts[-3][0] > self.minContrast
         return maxGreaterThanLast and maxGreaterThan2ndLast and maxIsNotNoise
 
+    def isPeakPredicted(self):
+        """Fits the contrast curve to the points so far. True if its peak is confidently located and not noise"""
+        if self.curve is None:
+            return False
+        pts = [pt for pt in self.contPts if -1 not in pt]
+        if not self.curve.fit([pt[1] for pt in pts], [pt[0] for pt in pts]):
+            return False
+        return (
+            self.curve.peakInterval <= self.peakTol
+            and self.curve.peakCont > self.minContrast
+        )
+
+    def getPredictedInterval(self):
+        """Same format as getRecentMaxContInterval, centered on the predicted peak"""
+        self.predicted = True
+        z, tol = self.curve.peak, self.peakTol
+        self.maxCont = self.curve.peakCont
+        self.maxContInterval = [
+            (self.curve(z - tol), z - tol),
+            (self.maxCont, z),
+            (self.curve(z + tol), z + tol),
+        ]
+        print(
+            f"Predicted max contrast = {self.maxCont:.2f} @ z = {z:.1f} ± {self.curve.peakInterval:.1f}"
+        )
+        return self.maxContInterval
+
     def isStillIncreasing(self):
         conts = [pt[0] for pt in self.contPts]
         lastIsMax = max(conts) in [self.contPts[-1][0], self.contPts[-2][0]]
@@ -67,9 +108,14 @@ class MaxContSearch:
         return allAboveMin or (smallRange and allAbove90p)
 
     def getTotalMaxContInterval(self):
-        # Find the point with the maximum contrast
-        max_idx = max(range(len(self.contPts) - 1), key=lambda i: self.contPts[i][0])
-        return self.contPts[max_idx - 1 : max_idx + 1]
+        """The measured points around the highest contrast, max in the middle like the other intervals. If the max is at
+        an end of the sweep, it's also that end of the interval"""
+        pts = [pt for pt in self.contPts if -1 not in pt]
+        max_idx = max(range(len(pts)), key=lambda i: pts[i][0])
+        self.maxCont = pts[max_idx][0]
+        self.maxContInterval = [pts[max(max_idx - 1, 0)], pts[max_idx], pts[min(max_idx + 1, len(pts) - 1)]]
+        print(f"Found max contrast = {self.maxCont:.2f}")
+        return self.maxContInterval
 
     def getRecentMaxContInterval(self):
         self.maxCont = self.contPts[-3][0]
@@ -0,0 +1,104 @@
+import numpy as np
+
+
+class MosaicCanvas:
+    """A stitch that grows in place, replacing utils.ptToPtStitch's full copy per tile.
+    The buffer is reallocated (at least doubling on the side that overflowed) only when a pic lands outside it, so adding
+    a pic costs its own footprint. `valid` marks the pixels some pic covered (not NaN), so NaNs persist like before.
+    `stitch` is a view of the used part. Coordinates are relative to its top left, as with ptToPtStitch"""
+
+    def __init__(self, pic):
+        self.data = np.array(pic, dtype=float)
+        self.valid = ~np.isnan(self.data)
+        self.top, self.left = 0, 0  # buffer index of the view's top left
+        self.h, self.w = pic.shape
+
+    @property
+    def stitch(self):
+        return self.data[self.top : self.top + self.h, self.left : self.left + self.w]
+
+    @property
+    def shape(self):
+        return (self.h, self.w)
+
+    @staticmethod
+    def grownAxis(start, end, size):
+        """New (size, offset of the old buffer) for one axis so [start, end) fits, start/end relative to the old buffer"""
+        if start >= 0 and end <= size:
+            return size, 0
+        span = max(end, size) - min(start, 0)
+        newSize = max(2 * size, span + size)  # geometric, so n pics cost O(n) copies
+        extra = newSize - span
+        if start < 0 and end > size:
+            offset = extra // 2
+        elif start < 0:
+            offset = extra  # room goes to the side that grew
+        else:
+            offset = 0
+        return newSize, offset - min(start, 0)
+
+    def reserve(self, top, left, bottom, right):
+        """Makes buffer rows top:bottom and columns left:right exist (can be out of the current buffer)"""
+        H, W = self.data.shape
+        newH, dy = MosaicCanvas.grownAxis(top, bottom, H)
+        newW, dx = MosaicCanvas.grownAxis(left, right, W)
+        if (newH, newW) == (H, W):
+            return
+        data = np.full((newH, newW), np.nan)
+        valid = np.zeros((newH, newW), bool)
+        data[dy : dy + H, dx : dx + W] = self.data
+        valid[dy : dy + H, dx : dx + W] = self.valid
+        self.data, self.valid = data, valid
+        self.top += dy
+        self.left += dx
+
+    def paste(self, pic, pt):
+        """Blends pic in with its top left at pt (y, x) of the current view, which grows to fit it.
+        The overlap is cos^2 blended across its narrow side, like ptToPtStitch.
+        Returns (stitchShift, picShift): where the old view's (0, 0) and pic's top left are in the new view"""
+        y, x = int(pt[0]), int(pt[1])
+        h2, w2 = pic.shape
+        newTop, newLeft = min(0, y), min(0, x)
+        newBottom, newRight = max(self.h, y + h2), max(self.w, x + w2)
+        self.reserve(self.top + newTop, self.left + newLeft, self.top + newBottom, self.left + newRight)
+        self.top += newTop
+        self.left += newLeft
+        self.h, self.w = newBottom - newTop, newRight - newLeft
+        stitchShift = np.array((-newTop, -newLeft))
+        picShift = np.array((y - newTop, x - newLeft))
+
+        rows = slice(self.top + picShift[0], self.top + picShift[0] + h2)
+        cols = slice(self.left + picShift[1], self.left + picShift[1] + w2)
+        # views of the footprint
+        MosaicCanvas.blend(self.data[rows, cols], self.valid[rows, cols], pic, picShift > stitchShift)
+        return stitchShift, picShift
+
+    @staticmethod
+    def blend(data, valid, pic, after):
+        """Blends pic into data (in place) where valid, writes it where not. The overlap is cos^2 blended across its
+        narrow side, like ptToPtStitch. after: (pic is below, pic is right of) the stitch it's added to"""
+        picValid = ~np.isnan(pic)
+        both = valid & picValid
+
+        weight = picValid.astype(float)  # of pic. 1 where only pic is valid, 0 where it isn't
+        if np.any(both):
+            # * Alpha-blend the overlap
+            rIdx, cIdx = np.nonzero(both)
+            yMin, yMax = rIdx.min(), rIdx.max() + 1
+            xMin, xMax = cIdx.min(), cIdx.max() + 1
+            overlapH, overlapW = yMax - yMin, xMax - xMin
+            if overlapW > overlapH:  # x stitch
+                start, end = (1, 0) if after[1] else (0, 1)
+                ramp = np.square(np.cos(np.pi * np.linspace(start, end, overlapW) / 2))[np.newaxis, :]
+            else:  # y stitch
+                start, end = (1, 0) if after[0] else (0, 1)
+                ramp = np.square(np.cos(np.pi * np.linspace(start, end, overlapH) / 2))[:, np.newaxis]
+            box = np.broadcast_to(ramp, (overlapH, overlapW))
+            weight[yMin:yMax, xMin:xMax][both[yMin:yMax, xMin:xMax]] = box[both[yMin:yMax, xMin:xMax]]
+
+        old = np.where(valid, data, 0)
+        new = np.where(picValid, pic, 0)
+        blended = old * (1 - weight) + new * weight
+        covered = valid | picValid
+        data[covered] = blended[covered]
+        valid |= picValid
@@ -0,0 +1,84 @@
+import queue
+import threading
+from concurrent.futures import Future
+
+
+class MotionScheduler:
+    """One worker thread owns every MoveAxes call, so moves reach Koala in the order they were submitted and never
+    overlap. Each move returns a Future that is done once MoveAxes returned (for waitEnd=False that is when Koala
+    accepted the move, not when the stage settled). Moves not yet started can be cancelled.
+    Position reads should wait() first, so they never see a position from before a submitted move"""
+
+    def __init__(self, host):
+        self.host = host
+        self.jobs = queue.Queue()  # (Future, MoveAxes args), None to stop
+        self.pending = []  # Futures submitted and not done yet
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            future, args = job
+            if not future.set_running_or_notify_cancel():
+                continue  # cancelled while queued
+            try:
+                future.set_result(self.host.MoveAxes(*args))
+            except Exception as err:
+                future.set_exception(err)
+            finally:
+                with self.lock:
+                    self.pending.remove(future)
+
+    def submit(self, absolute, x=0, y=0, z=0, waitEnd=False):
+        """Queues a move. x, y [um], z [um / 10, as MoveAxes takes it]. An axis given 0 doesn't move (absolute moves)
+        or moves by 0 (relative ones). waitEnd: MoveAxes blocks until the stage arrived. Returns a Future"""
+        future = Future()
+        args = (
+            absolute,
+            bool(x != 0),
+            bool(y != 0),
+            bool(z != 0),
+            False,
+            int(x),
+            int(y),
+            int(z),
+            0,
+            1,
+            1,
+            1,
+            1,
+            waitEnd,
+        )
+        with self.lock:
+            self.pending.append(future)
+        self.jobs.put((future, args))
+        return future
+
+    def wait(self):
+        """Blocks until every submitted move is done (or cancelled). Errors are raised by the move's own Future"""
+        with self.lock:
+            pending = list(self.pending)
+        for future in pending:
+            if not future.cancelled():
+                future.exception()
+
+    def cancel(self):
+        """Cancels the moves that haven't started. A move Koala already has can't be taken back. Returns how many"""
+        with self.lock:
+            pending = list(self.pending)
+        cancelled = 0
+        for future in pending:
+            if future.cancel():
+                cancelled += 1
+                with self.lock:
+                    self.pending.remove(future)
+        return cancelled
+
+    def close(self):
+        self.wait()
+        self.jobs.put(None)
+        self.thread.join()
@@ -0,0 +1,137 @@
+import threading
+
+import numpy as np
+import scipy.fft
+from scipy.signal.windows import hann
+
+
+class PhaseCorrelator:
+    """skimage's phase_cross_correlation (normalization="phase") for one strip shape, which stays the same for a whole
+    run (PIC_OVERLAP x the frame's width or height). The real FFTs (scipy.fft, on workers threads) run in buffers and with
+    kernels kept between calls instead of planned and allocated each time.
+    NaN pixels (off the lens, or outside a stitch) are filled with the strip's mean so partial tiles still register.
+    Given the shift predicted from the stage positions (prior), the peak is taken from a small window around it, so a
+    somewhat stronger but wrong peak elsewhere in the strip can't win. The whole strip's peak is taken instead if the
+    windowed one is weak, on the window's border (the true peak is further out), or well under the global one (the
+    prior is off, and the window only holds a side lobe or the zero shift artifact).
+    Get one with PhaseCorrelator.get(shape), which keeps one per thread since the buffers are reused"""
+
+    workers = -1  # scipy.fft threads, -1 for every core
+    eps = 100 * np.finfo(float).eps  # like skimage, so flat spectra don't divide by 0
+    searchRadius = 6  # [px] around the prior
+    minPeakSigma = 8  # windowed peak height, in noise std (1/sqrt(pixels)), to trust it over the global one
+    rivalRatio = 0.8  # the global peak wins if the windowed one is under this fraction of it
+    cache = threading.local()
+
+    def __init__(self, shape, upsample=1, window=False, normalization="phase"):
+        """upsample: refine the shift to 1/upsample px with a matrix DFT around the peak, like skimage's upsample_factor.
+        window: taper the strips with a Hann window first (skimage doesn't), which helps strips with a strong gradient.
+        normalization: "phase" (whitened spectrum) or None (plain cross correlation, like skimage's), which holds up
+        better on sparse texture under white noise. error is then sqrt(1 - NCC^2)"""
+        if normalization not in ("phase", None):
+            raise ValueError(f"normalization must be 'phase' or None, got {normalization}")
+        self.shape = tuple(int(s) for s in shape)
+        self.upsample = upsample
+        self.normalization = normalization
+        self.window = np.outer(hann(self.shape[0], sym=False), hann(self.shape[1], sym=False)) if window else None
+        self.bufA = np.empty(self.shape)
+        self.bufB = np.empty(self.shape)
+        self.amp = np.empty((self.shape[0], self.shape[1] // 2 + 1))
+        self.midpoints = np.fix(np.array(self.shape) / 2)
+
+        # the upsampled DFT evaluates the cross correlation from the half spectrum at regionSize^2 points around the peak
+        self.regionSize = int(np.ceil(upsample * 1.5))
+        self.dftShift = np.fix(self.regionSize / 2)
+        self.freqY = scipy.fft.fftfreq(self.shape[0])
+        self.freqX = scipy.fft.rfftfreq(self.shape[1])
+        self.weightX = np.full(self.freqX.size, 2.0)  # the other half of the spectrum is the conjugate
+        self.weightX[0] = 1
+        if self.shape[1] % 2 == 0:
+            self.weightX[-1] = 1  # Nyquist
+        self.upsampleKernels = self.kernels((np.arange(self.regionSize) - self.dftShift) / upsample)
+        self.windowed = 0  # registrations given a prior
+        self.fallbacks = 0  # of which took the whole strip's peak
+
+    @classmethod
+    def get(cls, shape, upsample=1, window=False, normalization="phase"):
+        """The calling thread's PhaseCorrelator for this shape, made on first use"""
+        correlators = getattr(cls.cache, "correlators", None)
+        if correlators is None:
+            correlators = cls.cache.correlators = {}
+        key = (tuple(int(s) for s in shape), upsample, window, normalization)
+        if key not in correlators:
+            correlators[key] = cls(*key)
+        return correlators[key]
+
+    def load(self, area, buf):
+        """Copies area into buf, NaNs filled with the mean. Returns the sum of squares (Parseval: skimage's amplitude)"""
+        np.copyto(buf, area)
+        nan = np.isnan(buf)
+        if nan.any():
+            buf[nan] = buf[~nan].mean() if not nan.all() else 0
+        if self.window is not None:
+            buf *= self.window
+        return np.dot(buf.ravel(), buf.ravel())
+
+    def kernels(self, offsets):
+        """Row and column DFT kernels that evaluate the cross correlation at offsets [px] (both axes) from a point"""
+        rowKernel = np.exp(2j * np.pi * np.outer(offsets, self.freqY))
+        colKernel = self.weightX[:, None] * np.exp(2j * np.pi * np.outer(self.freqX, offsets))
+        return rowKernel, colKernel
+
+    def __call__(self, reference, moving, prior=None):
+        """Returns (shift, error, phasediff) like phase_cross_correlation(reference, moving): shift (dy, dx) registers
+        moving onto reference, whole px unless upsample > 1.
+        prior: the expected shift (dy, dx) [px], searched within searchRadius. Phase normalization only, since the
+        windowed peak is judged in noise std. The whole strip is correlated either way, to check the window against"""
+        if reference.shape != self.shape or moving.shape != self.shape:
+            raise ValueError(f"PhaseCorrelator is for {self.shape}, got {reference.shape} and {moving.shape}")
+        if prior is not None and self.normalization != "phase":
+            raise ValueError("A prior needs phase normalization")
+        refAmp = self.load(reference, self.bufA)
+        movAmp = self.load(moving, self.bufB)
+        product = scipy.fft.rfft2(self.bufA, workers=PhaseCorrelator.workers, overwrite_x=True)
+        movFreq = scipy.fft.rfft2(self.bufB, workers=PhaseCorrelator.workers, overwrite_x=True)
+        np.conjugate(movFreq, out=movFreq)
+        product *= movFreq
+        if self.normalization == "phase":
+            np.abs(product, out=self.amp)
+            np.maximum(self.amp, PhaseCorrelator.eps, out=self.amp)
+            product /= self.amp
+
+        cross = scipy.fft.irfft2(product, s=self.shape, workers=PhaseCorrelator.workers)
+        maxima = np.unravel_index(np.argmax(np.abs(cross)), self.shape)
+        if prior is not None:
+            self.windowed += 1
+            r = PhaseCorrelator.searchRadius
+            center = np.round(np.asarray(prior, float)).astype(int)
+            offsets = np.arange(-r, r + 1)
+            # the cross correlation is periodic, negative shifts are at the far end
+            region = cross[np.ix_((center[0] + offsets) % self.shape[0], (center[1] + offsets) % self.shape[1])]
+            peak = np.unravel_index(np.argmax(np.abs(region)), region.shape)
+            onBorder = any(p in (0, 2 * r) for p in peak)
+            weak = abs(region[peak]) * np.sqrt(reference.size) < PhaseCorrelator.minPeakSigma
+            outranked = abs(region[peak]) < PhaseCorrelator.rivalRatio * abs(cross[maxima])
+            if onBorder or weak or outranked:
+                self.fallbacks += 1
+            else:
+                maxima = tuple((center + np.array(peak) - r) % self.shape)
+        shift = np.array(maxima, float)
+        shift[shift > self.midpoints] -= np.array(self.shape)[shift > self.midpoints]
+        ccMax = cross[maxima]
+
+        if self.upsample > 1:
+            shift = np.round(shift * self.upsample) / self.upsample
+            region = self.evaluate(product, shift, *self.upsampleKernels)
+            peak = np.unravel_index(np.argmax(np.abs(region)), region.shape)
+            ccMax = region[peak]
+            shift += (np.array(peak) - self.dftShift) / self.upsample
+
+        error = np.sqrt(abs(1 - ccMax**2 / max(refAmp * movAmp, PhaseCorrelator.eps)))
+        return shift, error, 0.0  # the strips are real, so is the cross correlation
+
+    def evaluate(self, product, center, rowKernel, colKernel):
+        """The (real) cross correlation at the kernels' offsets around center (dy, dx) [px]"""
+        rowKernel = rowKernel * np.exp(2j * np.pi * center[0] * self.freqY)
+        colKernel = colKernel * np.exp(2j * np.pi * center[1] * self.freqX)[:, None]
+        return (rowKernel @ product @ colKernel).real / product.shape[0] / self.shape[1]
@@ -0,0 +1,112 @@
+import queue
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+
+import phaseFile
+
+
+class ExportFailed(Exception):
+    """Koala kept failing to dump the phase image"""
+
+    pass
+
+
+class PhasePipeline:
+    """Producer/consumer for phase frames. A worker thread asks Koala to reconstruct and dump frame N+1 into a free
+    export slot while the caller is still parsing/fitting/stitching frame N.
+    Only requested frames are ever produced, so nothing is exported from a stale stage position."""
+
+    slots = 3
+    retries = 5
+
+    def __init__(self, host, folder=None):
+        self.host = host
+        self.ownFolder = folder is None  # removed on close
+        self.folder = Path(folder) if folder is not None else PhasePipeline.defaultFolder()
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.paths = [str(self.folder / f"phase{i}.bin") for i in range(PhasePipeline.slots)]
+
+        self.free = queue.Queue()  # slot indices koala can write into
+        self.ready = queue.Queue()  # slot indices (or the error) holding a finished dump
+        self.jobs = queue.Queue()  # one item per frame to export, None to stop
+        for slot in range(PhasePipeline.slots):
+            self.free.put(slot)
+        self.outstanding = 0  # requested but not yet consumed. Only touched by the consumer
+
+        self.thread = threading.Thread(target=self.produce, daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def defaultFolder():
+        """A new folder of this instance's own, RAM backed if there is one, else under ./tmp"""
+        shm = Path("/dev/shm")
+        parent = shm if shm.is_dir() else Path.cwd() / "tmp"
+        parent.mkdir(parents=True, exist_ok=True)
+        return Path(tempfile.mkdtemp(prefix="lens-tools-", dir=parent))
+
+    def export(self, path):
+        # implies SetUnwrap2DMethod == 0 (fast method). (For time saving)
+        for attempt in range(PhasePipeline.retries):
+            try:
+                self.host.SingleReconstruction()
+                self.host.SetUnwrap2DState(True)
+                # dump the displayed phase as a .bin file
+                self.host.SaveImageFloatToFile(4, path, True)
+                return
+            except Exception as err:
+                print(f"err in SaveImageFloatToFile (attempt {attempt + 1}): {err}")
+        raise ExportFailed(f"Could not export phase to {path}")
+
+    def produce(self):
+        while True:
+            if self.jobs.get() is None:
+                return
+            slot = self.free.get()  # blocks until the consumer frees a slot
+            try:
+                self.export(self.paths[slot])
+                self.ready.put(slot)
+            except Exception as err:
+                self.free.put(slot)
+                self.ready.put(err)
+
+    def request(self, n):
+        """Queue n more frames for export"""
+        for _ in range(max(0, n)):
+            self.jobs.put(True)
+            self.outstanding += 1
+
+    def get(self, rows=None, cols=None):
+        """Blocks until the oldest requested frame is dumped, then parses it. Returns (phase [um], pxSize [um/px])"""
+        if self.outstanding == 0:
+            self.request(1)
+        slot = self.ready.get()
+        self.outstanding -= 1
+        if isinstance(slot, Exception):
+            raise slot
+        try:
+            return phaseFile.load(self.paths[slot], rows, cols)
+        finally:
+            self.free.put(slot)
+
+    def take(self, n, rows=None, cols=None, prefetch=0):
+        """Yields n frames. `prefetch` extra frames are left exporting for the next call (only if the stage won't move)"""
+        self.request(n + prefetch - self.outstanding)
+        for _ in range(n):
+            yield self.get(rows, cols)
+
+    def drain(self):
+        """Wait for and discard any prefetched frames, so no export is running once this returns"""
+        while self.outstanding > 0:
+            slot = self.ready.get()
+            self.outstanding -= 1
+            if not isinstance(slot, Exception):
+                self.free.put(slot)
+
+    def close(self):
+        self.drain()
+        self.jobs.put(None)
+        self.thread.join()
+        if self.ownFolder:
+            shutil.rmtree(self.folder, ignore_errors=True)
@@ -1,10 +1,12 @@
 import threading
 import numpy as np
-from skimage.registration import phase_cross_correlation
+from PhaseCorrelator import PhaseCorrelator
 
 from matplotlib import pyplot as plt
 from GlobalSettings import GlobalSettings
-from Traversal import BadFit
+from MosaicCanvas import MosaicCanvas
+from Traversal import BadFit, NoOverlap
+import registration
 import utils
 
 
@@ -21,6 +23,10 @@ class Row:
         self.halfWidth = None
         self.done = False
         self.moveDir = 1
+        self.thread = None  # last stitch thread
+        self.canvas = None
+        self.tileStore = None  # set by AreaMap.nextRow
+        self.calibration = None  # StageCalibration, set by AreaMap.nextRow
         # always go right (1) then left (-1) each time from center
 
     def initCenter(self, centerPic, pxSize, centerPos, shift, zDiff):
@@ -37,13 +43,24 @@ class Row:
             if self.circle and self.totalCenter is not None
             else self.maxRadius
         )
-        self.stitch = centerPic
+        self.canvas = MosaicCanvas(centerPic)
         self.picShape = np.array(self.centerPic.shape)  # (y, x) in px
         self.stepX = (self.picShape[1] - Row.xOverlap) * self.pxSize  # positive X
+        # stage (dx, dy) of one pic to the right, off the x axis if the camera is turned against the stage
+        if self.calibration is not None:
+            self.stepRight = self.calibration.steps(self.picShape, Row.xOverlap)[0]
+        else:
+            self.stepRight = np.array((self.stepX, 0))
 
         self.leftPt = np.array((0, 0))  # top left pont of stitch
         self.rightPt = np.array((0, self.picShape[1]))  # top right point of stitch
         self.centerPt = np.array((0, 0))  # top left of the center pic
+        self.leftPos = self.rightPos = np.array(centerPos, float)  # stage (x, y, z) of the pics at each end
+        self.numPics = 1
+
+    @property
+    def stitch(self):
+        return self.canvas.stitch if self.canvas is not None else None
 
     def prematureEdge(self, x):
         return (
@@ -58,31 +75,39 @@ class Row:
         else:
             self.done = True
 
-    def stitchRight(self, pic, shift):
+    def stitchRight(self, pic, shift, isCenter=False):
         stitchPt = self.rightPt - Row.overlapVec + shift
 
         # put the point pic(0, 0) onto point self.stitch[stitchPt]
-        self.stitch, stitchShift, picShift = utils.ptToPtStitch(
-            self.stitch, stitchPt, pic
-        )
+        stitchShift, picShift = self.canvas.paste(pic, stitchPt)
         self.leftPt += stitchShift
         self.centerPt += stitchShift
         self.rightPt = np.array((0, self.picShape[1])) + picShift
+        if isCenter:
+            self.setCenter(pic, picShift)
 
-    def stitchLeft(self, pic, shift):
+    def stitchLeft(self, pic, shift, isCenter=False):
         stitchPt = self.leftPt + Row.overlapVec + shift
         picPt = np.array((0, pic.shape[1]))
         # put the point pic(0, 0) onto point self.stitch(stitchPt)
 
-        self.stitch, stitchShift, picShift = utils.ptToPtStitch(
-            self.stitch, stitchPt, pic, picPt
-        )
+        stitchShift, picShift = self.canvas.paste(pic, stitchPt - picPt)
         self.leftPt = picShift
         self.centerPt += stitchShift
         self.rightPt += stitchShift
+        if isCenter:
+            self.setCenter(pic, picShift)
+
+    def setCenter(self, pic, picPt):
+        """pic (top left at picPt in the stitch) is the one the next row is registered against"""
+        self.centerPic = pic
+        self.centerPt = np.array(picPt)
 
-    def addToStitch(self, pic):
-        """Stitches based on self.moveDir. Throws BadFit if bad stitch"""
+    def addToStitch(self, pic, isCenter=False, pos=None):
+        """Stitches based on self.moveDir. Throws BadFit if bad stitch, NoOverlap if the seam is off the lens.
+        isCenter: pic becomes centerPic, for rows that didn't start at their center (TilePlan)
+        pos: stage (x, y, z) pic was taken at. The seam is then searched around the shift the stage predicts"""
+        self.wait()  # the last pic must be in the stitch before registering against it
         stitchRight = self.moveDir == 1
         if stitchRight:
             stitchArea = self.stitch[
@@ -94,14 +119,35 @@ class Row:
                 self.leftPt[0] : self.leftPt[0] + self.picShape[0], : Row.xOverlap
             ]
             picArea = pic[:, -Row.xOverlap :]
+        if not registration.enoughValid(stitchArea, picArea):
+            print("Seam is off the lens")
+            raise NoOverlap
 
-        shift = phase_cross_correlation(stitchArea, picArea)[0].astype(int)
+        prior = None
+        nominal = np.array((0, self.moveDir * (self.picShape[1] - Row.xOverlap)))  # pic from the end pic [px]
+        if pos is not None:
+            stageDelta = np.array(pos[:2], float) - (self.rightPos if stitchRight else self.leftPos)[:2]
+            prior = utils.stageToPx(stageDelta, self.pxSize, self.calibration) - nominal
+        shift = PhaseCorrelator.get(picArea.shape)(stitchArea, picArea, prior)[0].astype(int)
         if abs(shift[0]) > Row.acceptableDy:
             print(f"Fit not acceptable (dy={shift[0]}), trying again")
             raise BadFit
-        pic += utils.getZDiff(shift, stitchArea, picArea)
-        thread = threading.Thread(
+        pic = pic + utils.getZDiff(shift, stitchArea, picArea)  # the caller's pic stays raw (TileStore)
+        self.numPics += 1
+        if pos is not None:
+            if stitchRight:
+                self.rightPos = np.array(pos, float)
+            else:
+                self.leftPos = np.array(pos, float)
+            if isCenter:
+                self.centerPos = pos
+        self.thread = threading.Thread(
             target=self.stitchRight if stitchRight else self.stitchLeft,
-            args=(pic, shift),
+            args=(pic, shift, isCenter),
         )
-        thread.start()
+        self.thread.start()
+
+    def wait(self):
+        """Waits for the last stitch thread"""
+        if self.thread is not None:
+            self.thread.join()
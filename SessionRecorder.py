@@ -0,0 +1,206 @@
+"""Record every Koala host call into a session archive, and replay it later without the instrument.
+
+A session is a folder:
+    calls.jsonl         one line per call: name, args, start time, duration, result, out-buffer contents
+    frames_00000.npz    compressed chunks of the phase dumps (SaveImageFloatToFile), chunkFrames per file. The float
+                        bytes are split into planes first (like blosc's shuffle), which zlib compresses much better
+
+Record:  KoalaController(recordTo="./sessions/lens1")
+Replay:  KoalaController(client=ReplayClient("./sessions/lens1"), show=False)
+"""
+
+import json
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+import phaseFile
+
+FRAME_CALL = "SaveImageFloatToFile"
+
+
+class ReplayMismatch(Exception):
+    """The replayed code asked for more (or different) calls than were recorded"""
+
+    pass
+
+
+def toJson(value):
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, (tuple, list)):
+        return [toJson(v) for v in value]
+    try:  # .NET bool/double, numpy scalars
+        return float(value)
+    except (TypeError, ValueError):
+        return str(value)
+
+
+def isBuffer(arg):
+    """Out parameters (System.Double[] / list) are filled by the call"""
+    return not isinstance(arg, (bool, int, float, str, type(None))) and hasattr(arg, "__len__")
+
+
+class RecordingClient:
+    """Wraps a Koala client, forwarding every call and logging it to a session folder"""
+
+    chunkFrames = 16
+
+    def __init__(self, client, folder=None):
+        self.client = client
+        if folder is None:
+            folder = Path.cwd() / "sessions" / datetime.now().strftime("%Y-%m-%dT%H%M%S")
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.log = open(self.folder / "calls.jsonl", "w")
+        self.lock = threading.Lock()  # PhasePipeline calls from its own thread
+        self.t0 = time.monotonic()
+        self.numCalls = 0
+        self.frames = []  # (header bytes, frame) waiting to be written
+        self.numFrames = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args):
+            start = time.monotonic()
+            result = attr(*args)
+            self.record(name, args, start, time.monotonic() - start, result)
+            return result
+
+        return call
+
+    def record(self, name, args, start, dt, result):
+        entry = {
+            "call": name,
+            "args": [None if isBuffer(a) else toJson(a) for a in args],
+            "t": round(start - self.t0, 6),
+            "dt": round(dt, 6),
+            "result": toJson(result),
+        }
+        out = {i: [float(v) for v in a] for i, a in enumerate(args) if isBuffer(a)}
+        if out:
+            entry["out"] = out
+
+        with self.lock:
+            if name == FRAME_CALL:
+                raw = Path(args[1]).read_bytes()
+                header = raw[: phaseFile.HEADER_LEN]
+                frame, _ = phaseFile.frombuffer(raw)
+                self.frames.append((np.frombuffer(header, np.uint8), frame.copy()))
+                entry["frame"] = self.numFrames
+                self.numFrames += 1
+                if len(self.frames) >= RecordingClient.chunkFrames:
+                    self.writeChunk()
+            self.log.write(json.dumps(entry) + "\n")
+            self.numCalls += 1
+
+    def writeChunk(self):
+        if not self.frames:
+            return
+        chunk = (self.numFrames - len(self.frames)) // RecordingClient.chunkFrames
+        headers, frames = zip(*self.frames)
+        frames = np.stack(frames)
+        planes = frames.view(np.uint8).reshape(*frames.shape, -1).transpose(0, 3, 1, 2)
+        np.savez_compressed(
+            self.folder / f"frames_{chunk:05d}.npz",
+            headers=np.stack(headers),
+            planes=planes,
+            dtype=frames.dtype.str,
+        )
+        self.frames = []
+        self.log.flush()
+
+    def close(self):
+        with self.lock:
+            self.writeChunk()
+            self.log.close()
+        with open(self.folder / "info.json", "w") as f:
+            json.dump(
+                {
+                    "numCalls": self.numCalls,
+                    "numFrames": self.numFrames,
+                    "chunkFrames": RecordingClient.chunkFrames,
+                    "duration [s]": time.monotonic() - self.t0,
+                },
+                f,
+                indent=2,
+            )
+        print(f"Recorded {self.numCalls} calls and {self.numFrames} frames to {self.folder}")
+
+
+class ReplayClient:
+    """Plays a recorded session back as a Koala client. Calls are matched per call name in recorded order, so the
+    interleaving between threads doesn't have to be identical. realTime=True also waits the recorded durations."""
+
+    simulated = True  # KoalaController doesn't persist what it learns about this stage
+
+    def __init__(self, folder, realTime=False):
+        self.folder = Path(folder)
+        self.realTime = realTime
+        with open(self.folder / "info.json") as f:
+            self.chunkFrames = json.load(f)["chunkFrames"]
+        self.queues = {}  # call name: list of entries, consumed from the front
+        with open(self.folder / "calls.jsonl") as f:
+            for line in f:
+                entry = json.loads(line)
+                self.queues.setdefault(entry["call"], []).append(entry)
+        self.positions = {name: 0 for name in self.queues}
+        self.lock = threading.Lock()
+        self.chunk = (None, None)  # (index, npz data) of the last loaded chunk
+
+    def frame(self, i):
+        index, data = self.chunk
+        if index != i // self.chunkFrames:
+            index = i // self.chunkFrames
+            data = np.load(self.folder / f"frames_{index:05d}.npz")
+            planes = data["planes"]
+            frames = np.ascontiguousarray(planes.transpose(0, 2, 3, 1))
+            frames = frames.view(str(data["dtype"])).reshape(planes.shape[0], *planes.shape[2:])
+            data = (data["headers"], frames)
+            self.chunk = (index, data)
+        headers, frames = data
+        return headers[i % self.chunkFrames].tobytes(), frames[i % self.chunkFrames]
+
+    def next(self, name):
+        with self.lock:
+            pos = self.positions.get(name, 0)
+            entries = self.queues.get(name, [])
+            if pos >= len(entries):
+                raise ReplayMismatch(f"{name} was called more times than recorded ({len(entries)})")
+            self.positions[name] = pos + 1
+            return entries[pos]
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+
+        def call(*args):
+            entry = self.next(name)
+            if self.realTime:
+                time.sleep(entry["dt"])
+            for i, values in entry.get("out", {}).items():
+                for j, v in enumerate(values):
+                    args[int(i)][j] = v
+            if "frame" in entry:
+                header, frame = self.frame(entry["frame"])
+                with open(args[1], "wb") as f:
+                    f.write(header)
+                    f.write(frame.tobytes())
+            result = entry["result"]
+            return tuple(result) if isinstance(result, list) else result
+
+        return call
+
+    def remaining(self):
+        """Recorded calls that were never replayed, per call name"""
+        return {
+            name: len(entries) - self.positions[name]
+            for name, entries in self.queues.items()
+            if len(entries) > self.positions[name]
+        }
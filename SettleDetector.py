@@ -0,0 +1,83 @@
+import time
+
+import numpy as np
+
+
+class SettleDetector:
+    """Waits for a commanded move by polling the stage position until every moving axis is within tol of its target
+    and has stayed still for stableTime, instead of sleeping a fixed time. Polling starts after preSleep of the time
+    the SettleModel expects, and gives up after timeoutFactor times it. Single axis moves refine the model with their
+    time to first arrival, if it was measured: a move already there at the first poll after the pre-sleep only says it
+    took less than the sleep, so the next move is polled from the start instead"""
+
+    stableTime = 0.03  # [s]
+    pollInterval = 0.005  # [s] on top of the GetAxesPosMu round trip
+    preSleep = 0.5  # fraction of the expected time slept before polling, so long moves don't poll the whole way
+    minTimeout = 0.5  # [s]
+    timeoutFactor = 3
+
+    def __init__(self, getPos, model, tol=1.0):
+        self.getPos = getPos  # () -> np.array((x, y, z)) [um]
+        self.model = model  # SettleModel
+        self.tol = tol  # [um]
+        self.stats = []  # (|dx|, |dy|, |dz|, settle time [s], timed out, arrival time [s] or NaN if not measured)
+        self.probe = False  # poll the next move from the start, without the pre-sleep
+
+    def timeout(self, expected):
+        return max(SettleDetector.minTimeout, SettleDetector.timeoutFactor * expected)
+
+    def wait(self, target, moving, start):
+        """target, start: (x, y, z) [um]. moving: (bool, bool, bool) axes commanded. Returns the time waited [s]"""
+        target, moving = np.asarray(target, float), np.asarray(moving, bool)
+        dists = np.where(moving, np.abs(target - np.asarray(start, float)), 0)
+        expected = self.model.predict(dists)
+        timeout = self.timeout(expected)
+        t0 = time.monotonic()
+        preSleep = 0 if self.probe else SettleDetector.preSleep * expected
+        time.sleep(preSleep)
+        last, stableSince, timedOut = None, None, False
+        arrivedAt = None  # since t0, reset if the stage leaves the target again (overshoot)
+        while True:
+            pos = self.getPos()
+            now = time.monotonic()
+            arrived = np.all(np.abs(pos - target)[moving] <= self.tol)
+            if last is None:
+                movingAtFirstPoll = not arrived
+            if not arrived:
+                arrivedAt = None
+            elif arrivedAt is None:
+                arrivedAt = now - t0
+            still = last is not None and np.all(np.abs(pos - last)[moving] <= self.tol)
+            if arrived and still:
+                stableSince = stableSince or now
+                if now - stableSince >= SettleDetector.stableTime:
+                    break
+            else:
+                stableSince = None
+            if now - t0 > timeout:
+                print(f"Stage didn't settle within {timeout:.2f}s, off by {np.abs(pos - target)[moving]}um")
+                timedOut = True
+                break
+            last = pos
+            time.sleep(SettleDetector.pollInterval)
+        dt = time.monotonic() - t0
+        measured = not timedOut and (movingAtFirstPoll or preSleep == 0)
+        self.probe = not movingAtFirstPoll and preSleep > 0
+        self.record(dists, dt, timedOut, arrivedAt if measured else None)
+        return dt
+
+    def record(self, dists, dt, timedOut, arrival):
+        self.stats.append((*dists, dt, timedOut, np.nan if arrival is None else arrival))
+        if arrival is not None:
+            self.model.add(dists, arrival)
+
+    def summary(self):
+        """Settle time stats per axis, for moves of that axis alone"""
+        stats = np.array(self.stats, float).reshape(-1, 6)
+        lines = [f"{len(stats)} moves, {int(stats[:, 4].sum())} timed out, {stats[:, 3].sum():.1f}s waiting"]
+        for i, axis in enumerate("xyz"):
+            alone = (stats[:, i] > 0) & (np.count_nonzero(stats[:, :3], axis=1) == 1)
+            if np.any(alone):
+                d, t = stats[alone, i], stats[alone, 3]
+                lines.append(f"  {axis}: {len(d)} moves, median {np.median(d):.0f}um in {np.median(t) * 1000:.0f}ms")
+        return "\n".join(lines)
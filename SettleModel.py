@@ -0,0 +1,142 @@
+import argparse
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+from scipy.optimize import nnls
+
+
+class SettleModel:
+    """Settle time [s] of a move, per axis, as a curve of the distance d [um]: t = c0 + c1 sqrt(d) + c2 d.
+    sqrt(d) covers short acceleration limited hops, d long moves at cruising speed. Coefficients are fitted non negative
+    from the time to first arrival of single axis moves (measured by SettleDetector, or calibrate). A move on several
+    axes takes its slowest axis. Persisted to settleModel.json, unless persist=False (simulated or replayed stages,
+    which would overwrite the instrument's timings)"""
+
+    filePath = Path("./settleModel.json")
+    axes = "xyz"
+    defaultCoef = (0.3, 0.0, 1 / 1_000)  # until fitted: 0.3s + 1mm/s
+    minSamples = 6
+    maxSamples = 500  # per axis, oldest dropped first
+
+    def __init__(self, persist=True):
+        self.persist = persist
+        self.coef = {axis: np.array(SettleModel.defaultCoef) for axis in SettleModel.axes}
+        self.samples = {axis: [] for axis in SettleModel.axes}  # (d, t)
+        self.load()
+
+    @staticmethod
+    def terms(d):
+        d = np.asarray(d, float)
+        return np.stack((np.ones_like(d), np.sqrt(d), d), axis=-1)
+
+    def axisTime(self, axis, d):
+        return float(SettleModel.terms(d) @ self.coef[axis])
+
+    def predict(self, dists):
+        """Settle time [s] of a move of dists = (|dx|, |dy|, |dz|) [um], 0 on an axis that doesn't move"""
+        times = [self.axisTime(axis, d) for axis, d in zip(SettleModel.axes, dists) if d > 0]
+        return max(times, default=0.0)
+
+    def add(self, dists, t):
+        """Learn from a measured move. Ignored unless exactly one axis moved"""
+        moving = [i for i, d in enumerate(dists) if d > 0]
+        if len(moving) != 1:
+            return
+        axis = SettleModel.axes[moving[0]]
+        self.samples[axis].append((float(dists[moving[0]]), float(t)))
+        del self.samples[axis][: -SettleModel.maxSamples]
+        self.fit(axis)
+
+    def fit(self, axis):
+        if len(self.samples[axis]) < SettleModel.minSamples:
+            return
+        d, t = np.array(self.samples[axis]).T
+        self.coef[axis], _ = nnls(SettleModel.terms(d), t)
+
+    def load(self):
+        if not self.persist or not SettleModel.filePath.exists():
+            return
+        with open(SettleModel.filePath, "r") as f:
+            data = json.load(f)
+        for axis in SettleModel.axes:
+            if axis in data:
+                self.coef[axis] = np.array(data[axis]["coef"])
+                self.samples[axis] = [tuple(s) for s in data[axis]["samples"]]
+
+    def save(self):
+        if not self.persist:
+            return
+        with open(SettleModel.filePath, "w") as f:
+            json.dump(
+                {
+                    axis: {"coef": self.coef[axis].tolist(), "samples": self.samples[axis]}
+                    for axis in SettleModel.axes
+                },
+                f,
+            )
+
+    def describe(self):
+        return "\n".join(
+            f"  {axis}: t = {c0:.3f} + {c1:.4f} sqrt(d) + {c2 * 1000:.3f} d/mm  ({len(self.samples[axis])} moves)"
+            for axis, (c0, c1, c2) in self.coef.items()
+        )
+
+
+defaultDists = {"x": (10, 50, 200, 500, 1_000, 3_000), "y": (10, 50, 200, 500, 1_000, 3_000), "z": (5, 25, 100, 300, 1_000)}
+
+
+def calibrate(host, dists=defaultDists, repeats=3):
+    """Measures polled settle times of back and forth fast moves on each axis, from where the stage is now.
+    Goes down (-) first, so z never goes above its starting point.
+    host: a KoalaController with SETTLE_TOL > 0. Fits and saves host.settleModel, returns the measurements
+    {axis: [(d, t), ...]}"""
+    results = {}
+    for i, axis in enumerate(SettleModel.axes):
+        results[axis] = []
+        for d in dists.get(axis, ()):
+            for _ in range(repeats):
+                for sign in (-1, 1):
+                    delta = np.zeros(3)
+                    delta[i] = sign * d
+                    n = len(host.settle.stats)
+                    host.move_rel(*delta, fast=True)
+                    if len(host.settle.stats) > n and not np.isnan(host.settle.stats[-1][5]):
+                        results[axis].append((d, host.settle.stats[-1][5]))
+        print(f"{axis}: measured {len(results[axis])} moves")
+    host.settleModel.save()
+    return results
+
+
+def benchmark(model, results):
+    """Prints predicted vs measured settle time per axis and distance"""
+    for axis, measured in results.items():
+        for d in sorted({d for d, _ in measured}):
+            t = [t for dd, t in measured if dd == d]
+            print(f"  {axis} {d:>6}um: measured {np.median(t) * 1000:6.0f}ms, model {model.axisTime(axis, d) * 1000:6.0f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-fit the per axis settle time model (settleModel.json)")
+    parser.add_argument("--sim", action="store_true", help="calibrate against SimKoala instead of the real stage")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    from KoalaController import KoalaController
+
+    if args.sim:
+        from SimKoala import SimKoalaClient
+
+        host = KoalaController(client=SimKoalaClient(), show=False)
+        host.setup()
+        host.setLimit(h=8_000)
+        host.move_to(z=12_000)
+    else:
+        host = KoalaController()
+        host.setup()
+    t0 = time.time()
+    results = calibrate(host, repeats=args.repeats)
+    print(f"Calibrated in {time.time() - t0:.1f}s\n{host.settleModel.describe()}")
+    benchmark(host.settleModel, results)
+    host.logout()
@@ -0,0 +1,251 @@
+import threading
+import time
+import numpy as np
+
+import phaseFile
+
+
+class SimSpecimen:
+    """A sphere/asphere (conic) lens sitting on the stage. All lengths in um.
+    focusZ is the stage z (joystick units) that focuses the apex. curvature = 1 convex, -1 concave, 0 flat"""
+
+    def __init__(
+        self,
+        center=(58249.36, 52110),
+        focusZ=12227.2,
+        R=50_000,
+        conic=0,
+        curvature=1,
+        aperture=5_000,
+        tilt=(0, 0),
+        roughness=0.02,
+        holeDensity=0,
+        seed=0,
+    ):
+        self.center = np.array(center, float)
+        self.focusZ = focusZ
+        self.R = R
+        self.conic = conic
+        self.curvature = curvature
+        self.aperture = aperture
+        self.tilt = np.array(tilt, float)  # dz/dx, dz/dy of the holder [um/um]
+        self.holeDensity = holeDensity  # NaN holes per um^2. Koala's fast unwrap rarely leaves any
+        # fixed surface texture (polishing marks, dust) so registration has something to lock on to
+        rng = np.random.default_rng(seed)
+        numWaves = 24
+        wavelength = rng.uniform(4, 60, numWaves)  # [um]
+        angle = rng.uniform(0, np.pi, numWaves)
+        self.waveK = 2 * np.pi / wavelength * np.array((np.cos(angle), np.sin(angle)))
+        self.wavePhase = rng.uniform(0, 2 * np.pi, numWaves)
+        self.waveAmp = roughness / np.sqrt(numWaves / 2) * rng.uniform(0.5, 1.5, numWaves)
+
+    def sag(self, x, y):
+        r2 = np.square(x - self.center[0]) + np.square(y - self.center[1])
+        root = np.sqrt(np.maximum(1 - (1 + self.conic) * r2 / self.R**2, 0))
+        return r2 / (self.R * (1 + root))
+
+    def texture(self, x, y):
+        """Sum of cosines. cos(a + b) = cos(a)cos(b) - sin(a)sin(b), so a grid is two outer products per wave"""
+        x, y = np.asarray(x) - self.center[0], np.asarray(y) - self.center[1]
+        tex = np.zeros(np.broadcast_shapes(x.shape, y.shape))
+        for (kx, ky), p, amp in zip(self.waveK.T, self.wavePhase, self.waveAmp):
+            a, b = kx * x + p, ky * y
+            tex += amp * (np.cos(a) * np.cos(b) - np.sin(a) * np.sin(b))
+        return tex
+
+    def height(self, x, y, texture=True):
+        """Surface height relative to the apex [um], NaN off the lens"""
+        dx, dy = np.asarray(x) - self.center[0], np.asarray(y) - self.center[1]
+        h = -self.curvature * self.sag(x, y) + self.tilt[0] * dx + self.tilt[1] * dy
+        if texture:
+            h = h + self.texture(x, y)
+        return np.where(np.hypot(dx, dy) <= self.aperture, h, np.nan)
+
+    def zFocus(self, x, y):
+        """Stage z that focuses (x, y). Higher surfaces need a lower z"""
+        return self.focusZ - self.height(x, y, texture=False)
+
+
+class SimKoalaClient:
+    """Pure python stand in for LynceeTec.KoalaRemote.Client.KoalaRemoteClient, covering the calls KoalaController uses.
+    Every call sleeps latency[call] * timeScale, and stage moves take distance / speed + settle, so timings are realistic
+    enough to compare throughput. timeScale = 0 runs as fast as the host can compute."""
+
+    simulated = True  # KoalaController doesn't persist what it learns about this stage
+
+    latency = {  # [s]
+        "MoveAxes": 0.03,
+        "GetAxesPosMu": 0.01,
+        "SingleReconstruction": 0.06,
+        "GetHoloContrast": 0.005,
+        "SetUnwrap2DState": 0.01,
+        "SaveImageFloatToFile": 0.04,
+        "GetPxSizeUm": 0.005,
+        "OpenConfig": 1.0,
+    }
+    speed = np.array((2_000.0, 2_000.0, 1_000.0))  # x, y, z [um/s]
+    settle = np.array((0.15, 0.15, 0.1))  # [s] after arriving
+
+    def __init__(
+        self,
+        specimen=None,
+        timeScale=1.0,
+        shape=(800, 800),
+        pxSize=0.30502417303068796,
+        hconv=5.299766669963901e-08,
+        peakContrast=8.0,
+        noiseContrast=1.2,
+        contrastSigma=0.15,
+        focusWidth=80.0,
+        phaseNoise=0.005,
+        seed=0,
+        stageRotation=0.0,
+        pxScale=1.0,
+    ):
+        self.specimen = specimen if specimen is not None else SimSpecimen()
+        self.timeScale = timeScale
+        self.shape = shape
+        self.pxSize = pxSize  # [um/px]
+        self.hconv = hconv  # [m/rad]
+        self.peakContrast = peakContrast
+        self.noiseContrast = noiseContrast  # contrast with nothing in focus
+        self.contrastSigma = contrastSigma  # read noise of GetHoloContrast
+        self.focusWidth = focusWidth  # [um] std of the contrast vs defocus curve
+        self.phaseNoise = phaseNoise  # [um]
+        self.stageRotation = np.radians(stageRotation)  # of the camera against the stage axes
+        self.pxScale = pxScale  # true px size / the pxSize GetPxSizeUm reports
+        self.rng = np.random.default_rng(seed)
+        self.lock = threading.Lock()
+        self.calls = {}  # call name: count
+
+        # stage, z in um (koala reports 1/10 um)
+        self.moveStart = np.array((*self.specimen.center, 0.0))
+        self.moveEnd = self.moveStart.copy()
+        self.t0 = self.t1 = time.monotonic()
+        self.settleTime = 0
+        self.reconPos = self.moveEnd.copy()
+
+    # * helpers
+    def wait(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        dt = SimKoalaClient.latency.get(name, 0.001) * self.timeScale
+        if dt > 0:
+            time.sleep(dt)
+
+    def pos(self):
+        """Position right now, moving linearly from moveStart to moveEnd"""
+        with self.lock:
+            now = time.monotonic()
+            if now >= self.t1 or self.t1 == self.t0:
+                return self.moveEnd.copy()
+            frac = min(1, (now - self.t0) / max(self.t1 - self.t0 - self.settleTime, 1e-9))
+            return self.moveStart + (self.moveEnd - self.moveStart) * frac
+
+    def defocus(self, pos=None):
+        x, y, z = self.reconPos if pos is None else pos
+        return z - self.specimen.zFocus(x, y)
+
+    # * session
+    def Connect(self, host, user, flag):
+        return True, user
+
+    def Login(self, passw):
+        return True
+
+    def Logout(self):
+        return True
+
+    def OpenConfig(self, config):
+        self.wait("OpenConfig")
+
+    def SetSourceState(self, source, state, wait):
+        self.wait("SetSourceState")
+
+    def GetPxSizeUm(self):
+        self.wait("GetPxSizeUm")
+        return self.pxSize
+
+    def SetUnwrap2DMethod(self, method):
+        self.wait("SetUnwrap2DMethod")
+
+    def SetUnwrap2DState(self, state):
+        self.wait("SetUnwrap2DState")
+
+    def OpenPhaseWin(self):
+        self.wait("OpenPhaseWin")
+
+    # * stage
+    def MoveAxes(self, absMove, mvX, mvY, mvZ, mvTh, x, y, z, th, accX, accY, accZ, accTh, waitEnd):
+        self.wait("MoveAxes")
+        start = self.pos()
+        target = np.array((x, y, z / 10), float)  # koala z is in 1/10 um
+        mask = np.array((mvX, mvY, mvZ), bool)
+        end = start.copy()
+        end[mask] = target[mask] if absMove else start[mask] + target[mask]
+
+        dist = np.abs(end - start)
+        moving = dist > 0
+        duration = np.max(np.where(moving, dist / SimKoalaClient.speed + SimKoalaClient.settle, 0))
+        duration *= self.timeScale
+        with self.lock:
+            self.moveStart, self.moveEnd = start, end
+            self.settleTime = np.max(np.where(moving, SimKoalaClient.settle, 0)) * self.timeScale
+            self.t0 = time.monotonic()
+            self.t1 = self.t0 + duration
+        if waitEnd and duration > 0:
+            time.sleep(duration)
+        return True
+
+    def GetAxesPosMu(self, buffer):
+        self.wait("GetAxesPosMu")
+        x, y, z = self.pos()
+        buffer[0], buffer[1], buffer[2], buffer[3] = x, y, z * 10, 0
+        return True
+
+    # * imaging
+    def SingleReconstruction(self):
+        self.wait("SingleReconstruction")
+        self.reconPos = self.pos()
+
+    def GetHoloContrast(self):
+        self.wait("GetHoloContrast")
+        defocus = self.defocus()
+        inFocus = 0 if np.isnan(defocus) else np.exp(-0.5 * (defocus / self.focusWidth) ** 2)
+        signal = self.noiseContrast + (self.peakContrast - self.noiseContrast) * inFocus
+        return float(signal + self.rng.normal(0, self.contrastSigma))
+
+    def renderPhase(self):
+        """Height map [um] of the field of view at the last reconstruction. Row index grows with stage y, column with stage x
+        (turned by stageRotation, scaled by pxScale)"""
+        x0, y0, _ = self.reconPos
+        h, w = self.shape
+        rows = np.arange(h)[:, np.newaxis] * self.pxSize * self.pxScale
+        cols = np.arange(w)[np.newaxis, :] * self.pxSize * self.pxScale
+        if self.stageRotation:
+            cos, sin = np.cos(self.stageRotation), np.sin(self.stageRotation)
+            xs = x0 + cols * cos - rows * sin
+            ys = y0 + cols * sin + rows * cos
+        else:  # a row and a column, which texture() broadcasts much faster
+            xs, ys = x0 + cols, y0 + rows
+        height = self.specimen.height(xs, ys).astype(np.float32)
+
+        # defocus makes the unwrapping noisier
+        defocus = self.defocus()
+        blur = 1 if np.isnan(defocus) else 1 + abs(defocus) / self.focusWidth
+        height += self.rng.normal(0, self.phaseNoise * blur, self.shape).astype(np.float32)
+        height += self.rng.normal(0, 0.5)  # koala's phase offset is arbitrary for each frame
+
+        # unwrapping holes
+        numHoles = self.rng.poisson(self.specimen.holeDensity * h * w * self.pxSize**2)
+        for cy, cx, r in zip(
+            self.rng.integers(0, h, numHoles),
+            self.rng.integers(0, w, numHoles),
+            self.rng.integers(2, 12, numHoles),
+        ):
+            height[max(cy - r, 0) : cy + r, max(cx - r, 0) : cx + r] = np.nan
+        return height
+
+    def SaveImageFloatToFile(self, imageType, path, useBinary):
+        self.wait("SaveImageFloatToFile")
+        phaseRad = self.renderPhase() / (self.hconv * 1e6)
+        phaseFile.write(path, phaseRad, self.pxSize, self.hconv)
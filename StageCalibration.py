@@ -0,0 +1,194 @@
+import argparse
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+
+from focusMetric import detrend
+from PhaseCorrelator import PhaseCorrelator
+import registration
+
+
+class StageCalibration:
+    """Linear map from a stage move (dx, dy) [um] to how far the picture moves (dRow, dCol) [px], per objective config.
+    Nominally 1/pxSize along each axis, but the stage axes are never exactly square to the camera and pxSize is only
+    nominal, which shows up as the same dy (dx) at every seam of a row (between rows). Fitted by least squares from a
+    calibrate scan of one step each way. Mapping seams don't feed it: their narrow strips are biased towards no shift
+    across the seam, which would pull the fit back to nominal. Feeds the tile steps (steps) and the shift the stage
+    positions predict (toPx). Persisted to stageCalibration.json, unless persist=False (simulated or replayed stages).
+    Samples are dated: those older than maxAge are dropped on load (camera remounted, stage serviced...) and the matrix
+    refitted from the rest. calibrate starts from scratch unless told to keep the old samples"""
+
+    filePath = Path("./stageCalibration.json")
+    minSamples = 6
+    maxSamples = 500  # oldest dropped first
+    outlierPx = 2.0  # samples further from the first fit are left out of the second
+    overlap = 200  # [px] of the calibrate scan's seams, wide enough to resolve the shift across them
+    maxError = 0.8  # calibrate registrations with a weaker peak (error = sqrt(1 - NCC^2)) are left out
+    maxAge = 30 * 24 * 3600  # [s]
+
+    def __init__(self, config, pxSize, persist=True):
+        self.config = str(config)
+        self.pxSize = pxSize
+        self.persist = persist
+        self.nominal = np.array(((0, 1), (1, 0))) / pxSize  # (dRow, dCol) = matrix @ (dx, dy)
+        self.reset()
+        self.load()
+
+    @classmethod
+    def fixed(cls, config, pxSize, matrix):
+        """A calibration with a known matrix (e.g. the one a map was taken with, TileStore), not loaded or saved"""
+        calibration = cls(config, pxSize, persist=False)
+        calibration.matrix = np.array(matrix, float)
+        return calibration
+
+    def reset(self):
+        """Back to nominal, forgetting every sample"""
+        self.matrix = self.nominal.copy()
+        self.samples = []  # (dx, dy, dRow, dCol, unix time)
+
+    def toPx(self, stageDelta):
+        """(dRow, dCol) [px] the picture moves for a stage move of (dx, dy) [um]"""
+        return self.matrix @ np.asarray(stageDelta[:2], float)
+
+    def toStage(self, pxDelta):
+        """Stage move (dx, dy) [um] that moves the picture by (dRow, dCol) [px]"""
+        return np.linalg.solve(self.matrix, np.asarray(pxDelta, float))
+
+    def steps(self, picShape, overlap):
+        """Stage moves (dx, dy) [um] of one tile right and one tile down, overlapping by overlap px"""
+        return self.toStage((0, picShape[1] - overlap)), self.toStage((picShape[0] - overlap, 0))
+
+    def add(self, stageDelta, pxDelta):
+        """Learn from a registration: the stage moved by stageDelta (dx, dy, ...) [um] and the picture by
+        pxDelta (dRow, dCol) [px]"""
+        self.samples.append((*(float(d) for d in stageDelta[:2]), *(float(p) for p in pxDelta), time.time()))
+        del self.samples[: -StageCalibration.maxSamples]
+        self.fit()
+
+    def fit(self):
+        """Nominal until there are minSamples moves along both axes"""
+        if len(self.samples) < StageCalibration.minSamples:
+            return
+        samples = np.array(self.samples)
+        stage, px = samples[:, :2], samples[:, 2:4]
+        keep = np.ones(len(samples), bool)
+        for attempt in range(2):
+            matrix, _, rank, _ = np.linalg.lstsq(stage[keep], px[keep], rcond=None)
+            if rank < 2:
+                return
+            resids = np.linalg.norm(stage @ matrix - px, axis=1)
+            keep = resids <= StageCalibration.outlierPx
+            if keep.sum() < StageCalibration.minSamples:
+                break
+        self.matrix = matrix.T
+
+    def describe(self):
+        """Rotation and scale of the stage axes in the picture, against the nominal pxSize"""
+        (yx, yy), (xx, xy) = self.matrix * self.pxSize  # per axis: (dRow, dCol) per um, in nominal px
+        return (
+            f"  stage x: {np.hypot(xx, yx) * 100 - 100:+.2f}% scale, {np.degrees(np.arctan2(yx, xx)):+.3f} deg\n"
+            f"  stage y: {np.hypot(yy, xy) * 100 - 100:+.2f}% scale, {np.degrees(np.arctan2(-xy, yy)):+.3f} deg"
+            f"  ({len(self.samples)} samples)"
+        )
+
+    def load(self):
+        if not self.persist or not StageCalibration.filePath.exists():
+            return
+        with open(StageCalibration.filePath, "r") as f:
+            data = json.load(f).get(self.config)
+        if data is None:
+            return
+        # undated samples predate the dates and count as expired
+        minTime = time.time() - StageCalibration.maxAge
+        self.samples = [tuple(s) for s in data["samples"] if len(s) == 5 and s[4] > minTime]
+        print(f"Loaded {len(self.samples)} stage calibration samples ({len(data['samples']) - len(self.samples)} expired)")
+        self.fit()
+
+    def save(self):
+        if not self.persist:
+            return
+        data = {}
+        if StageCalibration.filePath.exists():
+            with open(StageCalibration.filePath, "r") as f:
+                data = json.load(f)  # keep the other configs
+        data[self.config] = {"pxSize": self.pxSize, "matrix": self.matrix.tolist(), "samples": self.samples}
+        with open(StageCalibration.filePath, "w") as f:
+            json.dump(data, f)
+
+
+def registerWide(picA, picB, vertical, overlap, upsample):
+    """Shift of B to the right of (below) A from its nominal top left [px], or None if the peak is weak.
+    The strips are detrended and Hann windowed, and cross correlated without phase normalization, which resolves
+    the few px across the seam where whitened, untapered strips lock onto no shift"""
+    areaA, areaB, _ = registration.seamAreas(picA, picB, vertical, overlap)
+    if not registration.enoughValid(areaA, areaB):
+        return None
+    correlator = PhaseCorrelator.get(areaA.shape, upsample, window=True, normalization=None)
+    shift, error, _ = correlator(detrend(areaA.astype(float)), detrend(areaB.astype(float)))
+    if error > StageCalibration.maxError:
+        print(f"Weak peak (error {error:.2f}), leaving it out")
+        return None
+    return shift
+
+
+def calibrate(host, repeats=2, upsample=10, reset=True):
+    """Takes a picture here and one step right, left, down and up, overlapping by StageCalibration.overlap, and
+    registers each seam (registerWide). host: a KoalaController after setup, focused.
+    reset: forget the samples of earlier scans first, else they're fitted along with the new ones.
+    Fits and saves host.stageCalibration, returns the (stageDelta, pxDelta) samples"""
+    calibration = host.stageCalibration
+    if reset:
+        calibration.reset()
+    start = host.getPos()
+    here, _ = host.phaseAvg_um(avg=1)
+    overlap = StageCalibration.overlap
+    samples = []
+    for _ in range(repeats):
+        stepRight, stepDown = calibration.steps(here.shape, overlap)
+        for step, vertical in ((stepRight, False), (-stepRight, False), (stepDown, True), (-stepDown, True)):
+            host.move_to(*(start[:2] + step))
+            pos = host.getPos()
+            there, _ = host.phaseAvg_um(avg=1)
+            # the seam always has A left of (above) B
+            forward = step @ (stepDown if vertical else stepRight) > 0
+            picA, picB = (here, there) if forward else (there, here)
+            stageDelta = (pos[:2] - start[:2]) * (1 if forward else -1)
+            _, _, nominal = registration.seamAreas(picA, picB, vertical, overlap)
+            shift = registerWide(picA, picB, vertical, overlap, upsample)
+            if shift is None:
+                continue
+            calibration.add(stageDelta, nominal + shift)
+            samples.append((stageDelta, nominal + shift))
+    host.move_to(*start[:2])
+    calibration.save()
+    return samples
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit the stage to camera calibration (stageCalibration.json)")
+    parser.add_argument("--sim", action="store_true", help="calibrate against SimKoala instead of the real stage")
+    parser.add_argument("--repeats", type=int, default=2)
+    parser.add_argument("--keep", action="store_true", help="fit along with the samples of earlier scans")
+    parser.add_argument("--stageRotation", type=float, default=0.0, help="[deg] of the simulated camera")
+    args = parser.parse_args()
+
+    from KoalaController import KoalaController
+
+    if args.sim:
+        from SimKoala import SimKoalaClient
+
+        client = SimKoalaClient(stageRotation=args.stageRotation)
+        host = KoalaController(client=client, show=False)
+        host.setup()
+        host.setLimit(h=8_000)
+        host.move_to(z=client.specimen.zFocus(*client.specimen.center))
+    else:
+        host = KoalaController()
+        host.setup()
+    samples = calibrate(host, args.repeats, reset=not args.keep)
+    for stageDelta, pxDelta in samples:
+        print(f"  stage {np.round(stageDelta, 1)}um -> {np.round(pxDelta, 2)}px")
+    print(host.stageCalibration.describe())
+    host.logout()
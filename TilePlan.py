@@ -0,0 +1,261 @@
+import argparse
+import time
+
+import numpy as np
+
+from GlobalSettings import GlobalSettings
+from SettleModel import SettleModel
+
+
+class Tile:
+    """One picture of the plan. (i, j) is its grid index from the center tile, i along x, j along y"""
+
+    def __init__(self, i, j, x, y):
+        self.i = i
+        self.j = j
+        self.x = x
+        self.y = y
+        self.z = None  # predicted focus z, None if unknown
+        self.parent = None  # Tile it is registered against when stitching, None for the center tile
+        self.neighbours = []  # Tiles left, right, above and below that are in the plan
+        self.state = "todo"  # "done" or "pruned" (off the specimen)
+
+    @property
+    def key(self):
+        return (self.i, self.j)
+
+    def __repr__(self):
+        return f"Tile({self.i}, {self.j})"
+
+
+class TilePlan:
+    """Every tile of a mapArea, computed before the first move from the center, tile step and maxRadius/circle
+    (same bounds as Row.prematureEdge and AreaMap.prematureEdge).
+    The visiting order (visitOrder) is a tour of all tiles. Stitching doesn't depend on it: each tile has a parent on
+    the same row towards the center column, and rows hang off the center column towards the center row, like the
+    current center-out strategy, so stitchOrder is any order where parents come first"""
+
+    orders = ("serpentine", "nearest", "centerOut")
+
+    def __init__(self, center, stepX, stepY, maxRadius, circle=True, order="serpentine", axes=None):
+        """axes: stage (dx, dy) of one tile right and of one tile down, if the stage isn't square to the camera
+        (StageCalibration.steps). (stepX, 0) and (0, stepY) by default"""
+        if not maxRadius:
+            raise ValueError("A tile plan needs a maxRadius")
+        if order not in TilePlan.orders:
+            raise ValueError(f"order must be one of {TilePlan.orders}")
+        self.center = np.array(center[:2], float)
+        self.stepX = stepX
+        self.stepY = stepY
+        self.maxRadius = maxRadius
+        self.circle = circle
+        self.order = order
+        self.axes = np.array(axes, float) if axes is not None else np.array(((stepX, 0), (0, stepY)), float)
+
+        self.tiles = {}  # (i, j): Tile
+        numRows = int(maxRadius // stepY)
+        for j in range(-numRows, numRows + 1):
+            dy = j * stepY
+            halfWidth = np.sqrt(maxRadius**2 - dy**2) if circle else maxRadius
+            numCols = int(halfWidth // stepX)
+            for i in range(-numCols, numCols + 1):
+                self.tiles[(i, j)] = Tile(i, j, *self.position(i, j))
+        for tile in self.tiles.values():
+            tile.parent = self.tiles.get(self.parentKey(tile))
+            for di, dj in ((-1, 0), (1, 0), (0, -1), (0, 1)):
+                if (tile.i + di, tile.j + dj) in self.tiles:
+                    tile.neighbours.append(self.tiles[(tile.i + di, tile.j + dj)])
+
+        self.visitOrder = self.tour(order)
+        self.t0 = None
+        self.numDone = 0
+
+    @classmethod
+    def fromPic(cls, center, picShape, pxSize, maxRadius, circle=True, order="serpentine", calibration=None):
+        """Steps from the picture size and PIC_OVERLAP, like Row.stepX and AreaMap.stepY, or Row.stepRight and
+        AreaMap.stepDown with a StageCalibration"""
+        overlap = GlobalSettings().get("PIC_OVERLAP")
+        stepX = (picShape[1] - overlap) * pxSize
+        stepY = (picShape[0] - overlap) * pxSize
+        axes = calibration.steps(picShape, overlap) if calibration is not None else None
+        return cls(center, stepX, stepY, maxRadius, circle, order, axes)
+
+    def position(self, i, j):
+        """Stage (x, y) of tile (i, j), which may be off the grid of the plan"""
+        return self.center + i * self.axes[0] + j * self.axes[1]
+
+    @staticmethod
+    def parentKey(tile):
+        if tile.i != 0:
+            return (tile.i - np.sign(tile.i), tile.j)
+        if tile.j != 0:
+            return (0, tile.j - np.sign(tile.j))
+        return None
+
+    def rows(self):
+        """{j: [tiles of row j, left to right]}"""
+        rows = {}
+        for key in sorted(self.tiles, key=lambda k: (k[1], k[0])):
+            rows.setdefault(key[1], []).append(self.tiles[key])
+        return rows
+
+    def tour(self, order):
+        if order == "serpentine":
+            # top row first (like mapArea, which goes up first), alternating directions
+            tiles = []
+            for n, (j, row) in enumerate(sorted(self.rows().items())):
+                tiles += row if n % 2 == 0 else row[::-1]
+            return tiles
+        if order == "nearest":
+            # greedy from the center tile. Ties go to the first tile in row major order
+            tiles = sorted(self.tiles.values(), key=lambda t: (t.j, t.i))
+            pos = np.array([(t.x, t.y) for t in tiles])
+            visited = np.zeros(len(tiles), bool)
+            n = tiles.index(self.tiles[(0, 0)])
+            order = []
+            for _ in tiles:
+                visited[n] = True
+                order.append(tiles[n])
+                dists = np.hypot(*(pos - pos[n]).T)
+                dists[visited] = np.inf
+                n = int(np.argmin(dists))
+            return order
+        return [tile for tile, _ in self.centerOutPath() if tile is not None]
+
+    def predict(self, predictZ):
+        """Sets z of every tile still to do with predictZ(x, y) -> z or None"""
+        for tile in self.tiles.values():
+            if tile.state == "todo":
+                tile.z = predictZ(tile.x, tile.y)
+
+    def rowRuns(self):
+        """The visiting order split into runs of consecutive tiles on the same row"""
+        runs = []
+        for tile in self.visitOrder:
+            if runs and runs[-1][-1].j == tile.j:
+                runs[-1].append(tile)
+            else:
+                runs.append([tile])
+        return runs
+
+    def markDone(self, tile):
+        if self.t0 is None:
+            self.t0 = time.time()
+        tile.state = "done"
+        self.numDone += 1
+
+    def prune(self, tile, outwards=False):
+        """tile is off the specimen. outwards=True also prunes the tiles further from the center column on its row"""
+        pruned = [tile]
+        if outwards:
+            pruned += [
+                t
+                for t in self.tiles.values()
+                if t.j == tile.j and t.state == "todo" and np.sign(t.i) == np.sign(tile.i) and abs(t.i) > abs(tile.i)
+            ]
+        for t in pruned:
+            t.state = "pruned"
+        print(f"Pruned {len(pruned)} tiles at {tile}")
+
+    def pruneRemaining(self):
+        for tile in self.tiles.values():
+            if tile.state == "todo":
+                tile.state = "pruned"
+
+    def progress(self):
+        """"done/total tiles, pruned, ETA" string. The ETA assumes the remaining tiles take as long as the done ones"""
+        numTodo = sum(t.state == "todo" for t in self.tiles.values())
+        numPruned = sum(t.state == "pruned" for t in self.tiles.values())
+        msg = f"{self.numDone}/{self.numDone + numTodo} tiles ({numPruned} pruned)"
+        if self.numDone > 1:
+            perTile = (time.time() - self.t0) / (self.numDone - 1)  # t0 is when the first one was done
+            msg += f", ETA {perTile * numTodo / 60:.1f}min"
+        return msg
+
+    def stitchOrder(self):
+        """Tiles ordered so every parent comes before its children (breadth first from the center tile)"""
+        children = {}
+        for tile in self.tiles.values():
+            if tile.parent is not None:
+                children.setdefault(tile.parent.key, []).append(tile)
+        order, queue = [], [self.tiles[(0, 0)]]
+        while queue:
+            tile = queue.pop(0)
+            order.append(tile)
+            queue += children.get(tile.key, [])
+        return order
+
+    def centerOutPath(self):
+        """Stage positions the current mapArea/mapRow strategy goes through, as (tile or None, (x, y)). Rows go right then
+        left from their center and mapArea goes up then down from the center row. Every edge is found by moving one
+        step past the last tile (None), then the stage goes back to the center of the row or of the map"""
+        path = []
+        rows = self.rows()
+
+        def probe(i, j):
+            return (None, tuple(self.position(i, j)))
+
+        for direction in (-1, 1):
+            j = 0 if direction == -1 else 1
+            while j in rows:
+                row = {tile.i: tile for tile in rows[j]}
+                path.append((row[0], (row[0].x, row[0].y)))
+                for rowDir in (1, -1):
+                    i = rowDir
+                    while i in row:
+                        path.append((row[i], (row[i].x, row[i].y)))
+                        i += rowDir
+                    path.append(probe(i, j))
+                    path.append((None, (row[0].x, row[0].y)))  # back to the row's center
+                j += direction
+            path.append(probe(0, j))
+            path.append((None, tuple(self.center)))  # back to the map's center
+        return path
+
+    @staticmethod
+    def moves(positions):
+        """(|dx|, |dy|) of each move between consecutive positions"""
+        positions = np.array(positions, float)
+        return np.abs(np.diff(positions, axis=0))
+
+    def travel(self, positions, model=None):
+        """(total distance [um], expected move time [s]). Axes move together, so a move takes its slowest axis"""
+        moves = TilePlan.moves(positions)
+        model = model if model is not None else SettleModel()
+        times = [model.predict((dx, dy, 0)) for dx, dy in moves]
+        return np.hypot(moves[:, 0], moves[:, 1]).sum(), sum(times)
+
+    def report(self, model=None):
+        """Expected travel of the visiting order vs the current center-out strategy, both starting at the center"""
+        planned = [tuple(self.center)] + [(t.x, t.y) for t in self.visitOrder]
+        current = [tuple(self.center)] + [pos for _, pos in self.centerOutPath()]
+        (dPlan, tPlan), (dNow, tNow) = self.travel(planned, model), self.travel(current, model)
+        result = {
+            "tiles": len(self.tiles),
+            "order": self.order,
+            "planned moves": len(planned) - 1,
+            "planned travel [mm]": dPlan / 1000,
+            "planned move time [s]": tPlan,
+            "center-out moves": len(current) - 1,
+            "center-out travel [mm]": dNow / 1000,
+            "center-out move time [s]": tNow,
+            "time saved [s]": tNow - tPlan,
+        }
+        print(
+            f"{len(self.tiles)} tiles, {self.order}: {dPlan / 1000:.1f}mm in {tPlan:.1f}s of moves"
+            f" vs center-out {dNow / 1000:.1f}mm in {tNow:.1f}s (saves {tNow - tPlan:.1f}s)"
+        )
+        return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare tile tours against the current center-out strategy")
+    parser.add_argument("--maxRadius", type=float, default=2_000)
+    parser.add_argument("--square", action="store_true")
+    parser.add_argument("--pxSize", type=float, default=0.30502417303068796)
+    parser.add_argument("--picSize", type=int, default=800)
+    args = parser.parse_args()
+
+    for order in ("serpentine", "nearest"):
+        plan = TilePlan.fromPic((0, 0), (args.picSize, args.picSize), args.pxSize, args.maxRadius, not args.square, order)
+        plan.report()
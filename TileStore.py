@@ -0,0 +1,111 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from StageCalibration import StageCalibration
+
+
+class TileStore:
+    """Every raw tile of a map, saved into the run folder so it can be stitched again offline (restitch.py).
+    Tiles go to tiles/tileNNNNN.npz (compressed, one per tile) on a background thread, so mapping doesn't wait on the
+    disk. tiles.json (rewritten after each tile, so a crashed run keeps what it had) holds the pixel size, overlap, the
+    objective config and stage calibration matrix the map was taken with (if any), each tile's stage position and grid key, and the seams measured while mapping. A tile is only listed once its file is
+    written, and only the writer thread touches the list, so the index never points at a missing file"""
+
+    folderName = "tiles"
+    indexName = "tiles.json"
+
+    def __init__(self, runFolder, pxSize=None, overlap=None, calibration=None):
+        self.folder = Path(runFolder) / TileStore.folderName
+        self.indexPath = Path(runFolder) / TileStore.indexName
+        self.meta = {
+            "pxSize": pxSize,
+            "overlap": overlap,
+            "config": None if calibration is None else calibration.config,
+            "stageMatrix": None if calibration is None else calibration.matrix.tolist(),
+            "tiles": [],
+            "edges": [],
+        }
+        self.writer = None  # ThreadPoolExecutor, started on the first add
+        self.added = 0  # tiles handed to the writer, some maybe not on disk yet
+
+    @classmethod
+    def load(cls, runFolder):
+        store = cls(runFolder)
+        with open(store.indexPath, "r") as f:
+            store.meta = json.load(f)
+        return store
+
+    def add(self, pic, pos, key=None):
+        """pos: stage (x, y, z) [um]. key: (i, j) grid index if known (planned maps)"""
+        if self.writer is None:
+            self.folder.mkdir(parents=True, exist_ok=True)
+            self.writer = ThreadPoolExecutor(max_workers=1)
+        entry = {
+            "file": f"{TileStore.folderName}/tile{self.added:05d}.npz",
+            "pos": [float(p) for p in pos],
+            "key": None if key is None else [int(k) for k in key],
+        }
+        self.added += 1
+        self.writer.submit(self.write, np.array(pic), entry)
+
+    def write(self, pic, entry):
+        np.savez_compressed(self.indexPath.parent / entry["file"], pic=pic)
+        self.meta["tiles"].append(entry)
+        self.saveIndex()
+
+    def saveIndex(self):
+        with open(self.indexPath, "w") as f:
+            json.dump(self.meta, f, indent=1)
+
+    def setEdges(self, edges):
+        """AlignmentGraph.edges measured while mapping"""
+        self.meta["edges"] = [
+            {"a": list(a), "b": list(b), "offset": [float(o) for o in offset], "zDiff": zDiff}
+            for a, b, offset, zDiff in edges
+        ]
+        if self.writer is not None:
+            self.writer.submit(self.saveIndex)
+
+    def close(self):
+        """Waits for every tile to be on disk"""
+        if self.writer is not None:
+            self.writer.shutdown(wait=True)
+            self.writer = None
+            self.saveIndex()
+
+    def __len__(self):
+        return len(self.meta["tiles"])
+
+    def tilePath(self, n):
+        return self.indexPath.parent / self.meta["tiles"][n]["file"]
+
+    def tile(self, n):
+        with np.load(self.tilePath(n)) as f:
+            return f["pic"]
+
+    def calibration(self):
+        """StageCalibration.fixed with the matrix the map was taken with, or None if it had none (nominal axes)"""
+        if self.meta.get("stageMatrix") is None:
+            return None
+        return StageCalibration.fixed(self.meta["config"], self.meta["pxSize"], self.meta["stageMatrix"])
+
+    def keys(self, picShape, calibration=None):
+        """(i, j) of every tile. Tiles saved without one get it from their stage position and the tile step
+        (picShape, overlap, pxSize, or calibration's steps), relative to the first tile"""
+        pxSize, overlap = self.meta["pxSize"], self.meta["overlap"]
+        if calibration is not None:
+            steps = np.column_stack(calibration.steps(picShape, overlap))  # stage (x, y) [um] = steps @ (i, j)
+        else:
+            steps = np.diag((np.array(picShape)[::-1] - overlap) * pxSize)
+        first = np.array(self.meta["tiles"][0]["pos"][:2])
+        keys = []
+        for entry in self.meta["tiles"]:
+            if entry["key"] is not None:
+                keys.append(tuple(entry["key"]))
+            else:
+                i, j = np.round(np.linalg.solve(steps, np.array(entry["pos"][:2]) - first)).astype(int)
+                keys.append((int(i), int(j)))
+        return keys
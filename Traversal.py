@@ -7,7 +7,7 @@ import time
 from matplotlib import cm, collections, patches, pyplot as plt
 from matplotlib.ticker import FuncFormatter
 from scipy import ndimage
-from skimage.registration import phase_cross_correlation
+from PhaseCorrelator import PhaseCorrelator
 from scipy.ndimage import zoom
 
 import numpy as np
@@ -19,6 +19,12 @@ class BadFit(Exception):
     pass
 
 
+class NoOverlap(BadFit):
+    """The seam is mostly off the lens, so taking the picture again won't help"""
+
+    pass
+
+
 class Traversal:
     basePath = Path.cwd()
     baseName = "holo"
@@ -168,7 +174,7 @@ class Traversal:
 
             Not assuming that pic1 is the big one, but assuing that at at most one picture is already padded
             """
-            (dy, dx), err, phaseDiff = phase_cross_correlation(f1Area, f2Area)
+            (dy, dx), err, phaseDiff = PhaseCorrelator.get(f2Area.shape)(f1Area, f2Area)
             dy, dx = int(dy), int(dx)
             return dx, dy
 
@@ -0,0 +1 @@
+"""Lets a plain `pytest` from the repo root import its flat modules, like `python -m pytest` does"""
@@ -0,0 +1,131 @@
+"""Focus metrics computed from a phase (or amplitude) frame, so tiles pulled for stitching can be checked for focus
+without extra SingleReconstruction/GetHoloContrast round trips.
+
+All metrics ignore NaNs (unwrapping holes, off the specimen). Phase frames are detrended first (quadratic fit), so the
+specimen's own slope and curvature don't count as detail.
+
+MetricCalibration maps a metric onto the GetHoloContrast scale (the one IDEAL_NOISE_CUTOFF and minContrast use) from
+(metric, contrast) pairs measured at the same positions, see KoalaController.calibrateFocusMetric
+"""
+
+import numpy as np
+
+
+def detrend(img, step=10):
+    """img minus its least squares quadratic surface (fitted on every step-th pixel). NaNs stay NaN"""
+    ny, nx = img.shape
+    Y, X = np.mgrid[0:ny:step, 0:nx:step] / max(ny, nx)
+    sub = img[::step, ::step]
+    ok = np.isfinite(sub)
+    if np.count_nonzero(ok) < 6:
+        return img - np.nanmean(img)
+
+    def terms(X, Y):
+        return [np.ones_like(X), X, Y, X * X, X * Y, Y * Y]
+
+    A = np.column_stack([t[ok] for t in terms(X, Y)])
+    coef, *_ = np.linalg.lstsq(A, sub[ok], rcond=None)
+    y = (np.arange(ny) / max(ny, nx))[:, np.newaxis]
+    x = (np.arange(nx) / max(ny, nx))[np.newaxis, :]
+    surface = sum(c * t for c, t in zip(coef, terms(x, y)))
+    return img - surface
+
+
+def gradientEnergy(img):
+    """Mean squared forward difference"""
+    dx = np.diff(img, axis=1)[:-1, :]
+    dy = np.diff(img, axis=0)[:, :-1]
+    return np.nanmean(dx * dx + dy * dy)
+
+
+def tenengrad(img, threshold=0.0):
+    """Mean squared Sobel gradient magnitude, counting only magnitudes over threshold"""
+    a = img
+    gx = (a[:-2, 2:] + 2 * a[1:-1, 2:] + a[2:, 2:]) - (a[:-2, :-2] + 2 * a[1:-1, :-2] + a[2:, :-2])
+    gy = (a[2:, :-2] + 2 * a[2:, 1:-1] + a[2:, 2:]) - (a[:-2, :-2] + 2 * a[:-2, 1:-1] + a[:-2, 2:])
+    g2 = gx * gx + gy * gy
+    if threshold:
+        g2 = np.where(g2 > threshold**2, g2, 0)
+    return np.nanmean(g2)
+
+
+def normalizedVariance(img):
+    """Variance over |mean|. Only meaningful for amplitude/intensity frames: a phase frame's offset is arbitrary"""
+    mean = np.nanmean(img)
+    return np.nanvar(img) / max(abs(mean), 1e-12)
+
+
+def spectralEnergy(img, cutoff=0.25):
+    """Fraction of the (Hann windowed) power spectrum above cutoff * Nyquist"""
+    img = np.nan_to_num(img - np.nanmean(img), nan=0.0)
+    ny, nx = img.shape
+    window = np.outer(np.hanning(ny), np.hanning(nx))
+    power = np.abs(np.fft.rfft2(img * window)) ** 2
+    fy = np.fft.fftfreq(ny)[:, np.newaxis]
+    fx = np.fft.rfftfreq(nx)[np.newaxis, :]
+    high = np.hypot(fx, fy) > cutoff * 0.5
+    total = power.sum() - power[0, 0]
+    return power[high].sum() / total if total > 0 else 0.0
+
+
+metrics = {
+    "gradientEnergy": gradientEnergy,
+    "tenengrad": tenengrad,
+    "normalizedVariance": normalizedVariance,
+    "spectralEnergy": spectralEnergy,
+}
+
+
+class MetricCalibration:
+    """contrast ~ a + b * log(metric), fitted on (metric, contrast) pairs around a focus.
+    The sign of b isn't assumed: defocus can remove detail or (in the phase) add unwrapping noise"""
+
+    minPts = 4
+    minValid = 0.25  # fraction of a frame that must be on the lens (not NaN) to judge its focus
+
+    def __init__(self, name="gradientEnergy", detrendPhase=True):
+        if name not in metrics:
+            raise ValueError(f"Unknown focus metric {name}")
+        self.name = name
+        self.func = metrics[name]
+        self.detrendPhase = detrendPhase
+        self.coef = None
+        self.r2 = 0.0
+        self.range = None  # (min, max) log metric seen while calibrating
+
+    def __call__(self, img):
+        """Metric of a frame"""
+        if self.detrendPhase:
+            img = detrend(img)
+        return self.func(img)
+
+    def calibrate(self, metricValues, contrasts):
+        """Fits the mapping. Returns its r^2"""
+        logM = np.log(np.maximum(np.asarray(metricValues, float), 1e-30))
+        contrasts = np.asarray(contrasts, float)
+        if len(logM) < MetricCalibration.minPts or np.ptp(logM) == 0:
+            return 0.0
+        self.coef = np.polyfit(logM, contrasts, 1)
+        residual = contrasts - np.polyval(self.coef, logM)
+        ssTot = np.sum(np.square(contrasts - contrasts.mean()))
+        self.r2 = 1 - np.sum(np.square(residual)) / ssTot if ssTot > 0 else 0.0
+        self.range = (logM.min(), logM.max())
+        print(f"Calibrated {self.name}: contrast = {self.coef[1]:.2f} + {self.coef[0]:.2f} log(metric), r^2 = {self.r2:.2f}")
+        return self.r2
+
+    def toContrast(self, metric):
+        """Contrast equivalent of a metric value, not extrapolated past the calibrated range.
+        -inf if the metric isn't finite (a frame that's all NaN, off the lens), so it fails every focus check"""
+        if not np.isfinite(metric):
+            return -np.inf
+        logM = np.clip(np.log(max(metric, 1e-30)), *self.range)
+        return float(np.polyval(self.coef, logM))
+
+    def contrast(self, img):
+        """Contrast equivalent of a frame, or None if not calibrated. -inf for a frame mostly off the lens (minValid),
+        whose few valid pixels can't tell focus"""
+        if self.coef is None:
+            return None
+        if np.mean(np.isfinite(img)) < MetricCalibration.minValid:
+            return -np.inf
+        return self.toContrast(self(img))
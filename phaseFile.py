@@ -0,0 +1,119 @@
+import functools
+import struct
+import numpy as np
+
+# hdr_ver (b), endian (b), header_size (i), width (i), height (i), pxSize [m] (f), hconv [m/rad] (f), unit (b)
+HEADER_FMT = "bbiiiffb"
+HEADER_LEN = struct.calcsize("<" + HEADER_FMT)  # 23 bytes
+
+
+class PhaseHeader:
+    """Parsed header of a Koala .bin float image. Immutable, shared between every frame with the same header bytes"""
+
+    def __init__(self, raw):
+        endian = struct.unpack("bb", raw[:2])[1]
+        order = "<" if endian == 0 else ">"
+        (
+            self.version,
+            self.endian,
+            self.headerSize,
+            self.width,
+            self.height,
+            pxSize_m,
+            self.hconv,  # * metres / radian
+            self.unit,  # 1 = rad, 2 = m
+        ) = struct.unpack(order + HEADER_FMT, raw)
+        self.pxSize_um = pxSize_m * 1e6
+        self.dtype = np.dtype(order + "f4")
+        self.shape = (self.height, self.width)
+        self.rowBytes = self.width * self.dtype.itemsize
+
+        # [um] = [rad] * [m/rad] * [um/m]
+        self.toUm = self.hconv * 1e6 if self.unit == 1 else 1.0
+
+    def offset(self, row=0):
+        """Byte offset of the start of a row in the file"""
+        return self.headerSize + row * self.rowBytes
+
+
+@functools.lru_cache(maxsize=8)
+def parseHeader(raw):
+    """Koala always dumps the same frame geometry, so this is only really parsed once per session"""
+    return PhaseHeader(raw)
+
+
+def readHeader(f):
+    """Reads the header from an open binary file and leaves f at the start of the data"""
+    raw = f.read(HEADER_LEN)
+    header = parseHeader(raw)
+    f.seek(header.headerSize)
+    return header
+
+
+def rowSlice(rows, height):
+    start, stop, step = (rows or slice(None)).indices(height)
+    if step != 1:
+        raise ValueError("Only contiguous row windows can be read from a phase file")
+    return start, max(start, stop)
+
+
+def load(path, rows=None, cols=None, out=None):
+    """Read a phase dump (or only a window of it) and return (height [um], pxSize [um/px]).
+    Only the requested rows are read from disk, straight into one float32 buffer that is converted to um in place.
+    `out` can be a preallocated float32 array of the window's shape to avoid allocating at all."""
+    with open(path, "rb") as f:
+        header = readHeader(f)
+        r0, r1 = rowSlice(rows, header.height)
+        shape = (r1 - r0, header.width)
+        buffer = out if out is not None and cols is None else np.empty(shape, np.float32)
+        if buffer.shape != shape:
+            raise ValueError(f"out has shape {buffer.shape}, expected {shape}")
+
+        f.seek(header.offset(r0))
+        if f.readinto(memoryview(buffer).cast("B")) != buffer.nbytes:
+            raise EOFError(f"Phase file {path} is truncated")
+
+    if not header.dtype.isnative:
+        buffer.byteswap(inplace=True)
+
+    phase = buffer if cols is None else buffer[:, cols]
+    if out is not None and cols is not None:
+        out[...] = phase
+        phase = out
+    if header.unit == 1:  # 1 = rad, 2 = m
+        phase *= np.float32(header.toUm)
+    return phase, header.pxSize_um  # [um (height)], [um/px (x and y)]
+
+
+def memmap(path, rows=None, cols=None):
+    """Zero-copy, read only view of the raw (unconverted) frame. Multiply by header.toUm to get um.
+    ! Keeps the file open until the view is dropped, so don't hold on to it while Koala overwrites the file"""
+    with open(path, "rb") as f:
+        header = readHeader(f)
+    r0, r1 = rowSlice(rows, header.height)
+    frame = np.memmap(
+        path, header.dtype, "r", offset=header.offset(r0), shape=(r1 - r0, header.width)
+    )
+    return (frame if cols is None else frame[:, cols]), header
+
+
+def frombuffer(data, rows=None, cols=None):
+    """Same as memmap, but for a dump that is already in memory (bytes, bytearray, mmap...)"""
+    header = parseHeader(bytes(data[:HEADER_LEN]))
+    r0, r1 = rowSlice(rows, header.height)
+    frame = np.frombuffer(
+        data, header.dtype, (r1 - r0) * header.width, header.offset(r0)
+    ).reshape(r1 - r0, header.width)
+    return (frame if cols is None else frame[:, cols]), header
+
+
+def write(path, frame, pxSize_um, hconv, unit=1):
+    """Writes a frame in Koala's .bin layout (little endian). frame is in rad if unit == 1, m if unit == 2"""
+    frame = np.ascontiguousarray(frame, "<f4")
+    height, width = frame.shape
+    header = struct.pack(
+        "<" + HEADER_FMT, 1, 0, HEADER_LEN, width, height, pxSize_um * 1e-6, hconv, unit
+    )
+    with open(path, "wb") as f:
+        f.write(header)
+        f.write(frame.tobytes())
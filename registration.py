@@ -0,0 +1,116 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from PhaseCorrelator import PhaseCorrelator
+import utils
+
+minValid = 0.25  # fraction of each strip that must be on the lens (not NaN) to register a seam
+
+
+def seamAreas(picA, picB, vertical, overlap):
+    """The overlap strips of B to the right of (or below) A, and B's nominal top left from A's (dy, dx) [px]"""
+    if vertical:
+        return picA[-overlap:, :], picB[:overlap, :], np.array((picA.shape[0] - overlap, 0))
+    return picA[:, -overlap:], picB[:, :overlap], np.array((0, picA.shape[1] - overlap))
+
+
+def enoughValid(areaA, areaB):
+    """True if both strips are at least minValid on the lens"""
+    return min(np.mean(~np.isnan(areaA)), np.mean(~np.isnan(areaB))) >= minValid
+
+
+def registerSeam(picA, picB, vertical, overlap, upsample=1, prior=None):
+    """Phase correlation (PhaseCorrelator) of one seam, like Row.addToStitch/AreaMap.getShift.
+    prior: the shift expected from the stage positions, searched around first.
+    Returns (shift (dy, dx) from the nominal overlap [px], error, zDiff to add to B).
+    Whole px unless upsample > 1. All NaN if a strip is mostly off the lens (minValid)"""
+    areaA, areaB, _ = seamAreas(picA, picB, vertical, overlap)
+    if not enoughValid(areaA, areaB):
+        return np.full(2, np.nan), np.nan, np.nan
+    shift, error, _ = PhaseCorrelator.get(areaA.shape, upsample)(areaA, areaB, prior)
+    if upsample == 1:
+        shift = shift.astype(int)
+    return shift, error, utils.getZDiff(np.round(shift).astype(int), areaA, areaB)
+
+
+class SharedTiles:
+    """A stack of same sized tiles in shared memory, so worker processes read them without pickling.
+    Fill `array` (n, height, width), then pass it to registerBatch. close() when done (or use as a context manager)"""
+
+    def __init__(self, n, shape, dtype=float):
+        self.shape = (n, *shape)
+        self.dtype = np.dtype(dtype)
+        self.shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(self.shape)) * self.dtype.itemsize, 1))
+        self.array = np.ndarray(self.shape, self.dtype, buffer=self.shm.buf)
+
+    @classmethod
+    def fromTiles(cls, tiles):
+        shared = cls(len(tiles), tiles[0].shape, tiles[0].dtype)
+        for n, tile in enumerate(tiles):
+            shared.array[n] = tile
+        return shared
+
+    def close(self):
+        del self.array  # no views may outlive the buffer
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+workerTiles = None  # the SharedTiles array, in each worker process
+workerShm = None
+
+
+def attach(name, shape, dtype):
+    global workerTiles, workerShm
+    PhaseCorrelator.workers = 1  # the pool already uses every core
+    workerShm = shared_memory.SharedMemory(name=name)
+    workerTiles = np.ndarray(shape, dtype, buffer=workerShm.buf)
+
+
+def registerJobs(jobs, tiles=None, upsample=1):
+    """jobs: [(indexA, indexB, vertical, overlap, prior)]. Returns [(shift, error, zDiff)]"""
+    tiles = workerTiles if tiles is None else tiles
+    return [
+        registerSeam(tiles[a], tiles[b], vertical, overlap, upsample, prior) for a, b, vertical, overlap, prior in jobs
+    ]
+
+
+def registerBatch(tiles, jobs, workers=None, upsample=1):
+    """Registers every (indexA, indexB, vertical, overlap [px], prior shift or None) job, B to the right of
+    (vertical=False) or below A, across a process pool.
+    tiles: SharedTiles (read in place by the workers) or a list of arrays (copied into one).
+    workers=1 runs in this process. upsample: see registerSeam.
+    Returns (shifts (n, 2) from the nominal overlap [px], errors (n,), zDiffs (n,)), NaN where a seam couldn't be"""
+    workers = workers or os.cpu_count()
+    jobs = list(jobs)
+    if workers == 1 or len(jobs) < 2:
+        array = tiles.array if isinstance(tiles, SharedTiles) else tiles
+        results = registerJobs(jobs, array, upsample)
+    else:
+        shared = tiles if isinstance(tiles, SharedTiles) else SharedTiles.fromTiles(tiles)
+        try:
+            numChunks = min(len(jobs), 4 * workers)  # a few per worker so uneven chunks even out
+            chunks = [jobs[n::numChunks] for n in range(numChunks)]
+            with ProcessPoolExecutor(workers, initializer=attach, initargs=(shared.shm.name, shared.shape, shared.dtype)) as pool:
+                chunkResults = list(pool.map(partial(registerJobs, upsample=upsample), chunks))
+            results = [None] * len(jobs)
+            for n, chunkResult in enumerate(chunkResults):
+                results[n::numChunks] = chunkResult
+        finally:
+            if shared is not tiles:
+                shared.close()
+
+    shifts = np.array([r[0] for r in results], float).reshape(-1, 2)
+    errors = np.array([r[1] for r in results], float)
+    zDiffs = np.array([r[2] for r in results], float)
+    return shifts, errors, zDiffs
@@ -0,0 +1,95 @@
+import argparse
+import time
+
+import numpy as np
+from scipy.ndimage import gaussian_filter
+from skimage.registration import phase_cross_correlation
+
+from GlobalSettings import GlobalSettings
+from PhaseCorrelator import PhaseCorrelator
+
+# PhaseCorrelator against skimage's phase_cross_correlation on seam strips (PIC_OVERLAP x the frame) with known shifts.
+# With --priorError it's also given the true shift off by up to that many px, like a stage prediction
+
+
+def strips(rng, frame, overlap, count, maxShift=8):
+    """count (reference, moving, true shift) pairs of a smooth random texture, moving shifted by up to maxShift px"""
+    pad = maxShift + 1
+    pairs = []
+    for _ in range(count):
+        texture = gaussian_filter(rng.normal(size=(frame + 2 * pad, overlap + 2 * pad)), 2)
+        dy, dx = rng.integers(-maxShift, maxShift + 1, 2)
+        reference = texture[pad : pad + frame, pad : pad + overlap]
+        moving = texture[pad - dy : pad - dy + frame, pad - dx : pad - dx + overlap]
+        moving = moving + rng.normal(0, 0.02, moving.shape)
+        pairs.append((reference, moving, np.array((-dy, -dx))))
+    return pairs
+
+
+def timed(register, pairs, repeat):
+    """Seconds per registration and the shifts of the last pass"""
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        shifts = [register(reference, moving)[0] for reference, moving, _ in pairs]
+    return (time.perf_counter() - t0) / repeat / len(pairs), np.array(shifts)
+
+
+def run(frame=800, overlap=None, count=50, repeat=5, upsample=1, seed=0, priorError=None, window=False, maxShift=8):
+    overlap = overlap or GlobalSettings().get("PIC_OVERLAP")
+    rng = np.random.default_rng(seed)
+    pairs = strips(rng, frame, overlap, count, maxShift)
+    truth = np.array([shift for _, _, shift in pairs])
+    correlator = PhaseCorrelator.get((frame, overlap), upsample, window)
+
+    skimageTime, skimageShifts = timed(
+        lambda a, b: phase_cross_correlation(a, b, upsample_factor=upsample), pairs, repeat
+    )
+    kernelTime, kernelShifts = timed(correlator, pairs, repeat)
+    results = {
+        "strip": f"{frame}x{overlap}",
+        "skimage [ms]": skimageTime * 1e3,
+        "PhaseCorrelator [ms]": kernelTime * 1e3,
+        "speedup": skimageTime / kernelTime,
+        "max |shift - skimage| [px]": np.abs(kernelShifts - skimageShifts).max(),
+        "skimage correct": int(np.sum(np.all(np.abs(skimageShifts - truth) < 0.5, axis=1))),
+        "PhaseCorrelator correct": int(np.sum(np.all(np.abs(kernelShifts - truth) < 0.5, axis=1))),
+    }
+    if priorError is not None:
+        priors = truth + rng.integers(-priorError, priorError + 1, truth.shape)
+        priorPairs = [(reference, moving, prior) for (reference, moving, _), prior in zip(pairs, priors)]
+        correlator.windowed = correlator.fallbacks = 0
+        t0 = time.perf_counter()
+        for _ in range(repeat):
+            priorShifts = np.array([correlator(reference, moving, prior)[0] for reference, moving, prior in priorPairs])
+        results["with prior [ms]"] = (time.perf_counter() - t0) / repeat / count * 1e3
+        results["with prior correct"] = int(np.sum(np.all(np.abs(priorShifts - truth) < 0.5, axis=1)))
+        results["global fallbacks"] = f"{correlator.fallbacks}/{correlator.windowed}"
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Seam registration benchmark")
+    parser.add_argument("--frame", type=int, default=800, help="[px] along the seam")
+    parser.add_argument("--overlap", type=int, default=None, help="[px] across it, PIC_OVERLAP by default")
+    parser.add_argument("--count", type=int, default=50, help="strip pairs")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--upsample", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--priorError", type=int, default=None, help="[px] also search around a prior this far off")
+    parser.add_argument("--window", action="store_true", help="Hann window the strips (PhaseCorrelator only)")
+    parser.add_argument("--maxShift", type=int, default=8, help="[px] of the true shifts")
+    args = parser.parse_args()
+
+    results = run(
+        args.frame,
+        args.overlap,
+        args.count,
+        args.repeat,
+        args.upsample,
+        args.seed,
+        args.priorError,
+        args.window,
+        args.maxShift,
+    )
+    for key, value in results.items():
+        print(f"{key}: {value:.3f}" if isinstance(value, float) else f"{key}: {value}")
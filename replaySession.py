@@ -0,0 +1,44 @@
+import argparse
+import cProfile
+import pstats
+import time
+import matplotlib
+
+matplotlib.use("Agg")  # headless
+
+from KoalaController import KoalaController
+from SessionRecorder import ReplayClient
+
+# Re-runs a recorded mapArea session offline, e.g. to profile or compare stitching changes against real data.
+# The arguments must match the ones the session was recorded with.
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a recorded mapArea session")
+    parser.add_argument("session", help="session folder written by SessionRecorder.RecordingClient")
+    parser.add_argument("--h", type=float, default=8_000, help="height passed to setLimit")
+    parser.add_argument("--curvature", type=int, default=-1)
+    parser.add_argument("--maxRadius", type=float, default=1_000)
+    parser.add_argument("--square", action="store_true", help="map a square instead of a circle")
+    parser.add_argument("--realTime", action="store_true", help="wait the recorded call durations")
+    parser.add_argument("--profile", action="store_true")
+    args = parser.parse_args()
+
+    client = ReplayClient(args.session, realTime=args.realTime)
+    host = KoalaController(client=client, show=False)
+    host.setup()
+    host.setLimit(h=args.h)
+
+    profiler = cProfile.Profile() if args.profile else None
+    start = time.time()
+    if profiler:
+        profiler.enable()
+    host.mapArea(curvature=args.curvature, circle=not args.square, maxRadius=args.maxRadius)
+    if profiler:
+        profiler.disable()
+    print(f"Time: {time.time() - start:.3f} seconds")
+    host.logout()
+
+    if client.remaining():
+        print(f"Calls recorded but not replayed: {client.remaining()}")
+    if profiler:
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
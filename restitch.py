@@ -0,0 +1,79 @@
+import argparse
+import json
+import time
+from pathlib import Path
+
+from AlignmentGraph import AlignmentGraph
+from AreaMap import AreaMap
+from TileStore import TileStore
+import registration
+
+# Rebuilds a map from the raw tiles mapArea saved (TileStore) without the microscope, e.g. to try another overlap,
+# outlier threshold or the seams measured while mapping. The result goes to a new folder under ./stitches/
+
+
+def restitch(runFolder, overlap=None, workers=None, outlierPx=None, useMeasured=False, curvature=None, upsample=None):
+    """Returns the new AreaMap"""
+    t0 = time.time()
+    store = TileStore.load(runFolder)
+    overlap = overlap or store.meta["overlap"]
+    pxSize = store.meta["pxSize"]
+    # loaded straight into shared memory, which the registration workers read in place
+    first = store.tile(0)
+    shared = registration.SharedTiles(len(store), first.shape, first.dtype)
+    for n in range(len(store)):
+        shared.array[n] = store.tile(n)
+    calibration = store.calibration()  # the priors use the axes the map was taken with
+    keys = store.keys(first.shape, calibration)
+    graph = AlignmentGraph(pxSize, calibration)
+    for n, (key, entry) in enumerate(zip(keys, store.meta["tiles"])):
+        graph.addTile(key, shared.array[n], entry["pos"])
+    print(f"Loaded {len(store)} tiles in {time.time() - t0:.1f}s")
+
+    t0 = time.time()
+    if upsample is not None:
+        AlignmentGraph.upsample = upsample
+    if useMeasured:
+        for edge in store.meta["edges"]:
+            graph.addEdge(tuple(edge["a"]), tuple(edge["b"]), edge["offset"], edge["zDiff"])
+    else:
+        pairs = graph.pairs()
+        jobs = graph.jobs(keys, overlap, first.shape)
+        shifts, _, zDiffs = registration.registerBatch(shared, jobs, workers, AlignmentGraph.upsample)
+        for (a, b, vertical), shift, zDiff in zip(pairs, shifts, zDiffs):
+            result = AlignmentGraph.toEdge(shift, zDiff, vertical, first.shape, overlap)
+            if result is not None:
+                graph.addEdge(a, b, *result)
+    print(f"{len(graph.edges)} seams in {time.time() - t0:.1f}s")
+
+    if outlierPx is not None:
+        AlignmentGraph.outlierPx = outlierPx
+    graph.solve()
+
+    if curvature is None:
+        fitPath = Path(runFolder) / "curvature_fit.json"
+        curvature = json.load(open(fitPath))["curvature"] if fitPath.exists() else 0
+    areaMap = AreaMap(True, first.shape, pxSize, None, curvature, False)
+    centerRowKeys = [key for key in graph.tiles if key[1] == 0]
+    profile = graph.composite(centerRowKeys).dense() if centerRowKeys else None
+    areaMap.setMosaic(graph.composite(), profile, len(graph.tiles))
+    graph.tiles.clear()  # views of the shared block
+    shared.close()
+    areaMap.saveImages()
+    areaMap.saveFit()
+    print(f"Saved to {areaMap.absFolderPath}")
+    return areaMap
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-stitch a mapArea run from its saved raw tiles")
+    parser.add_argument("runFolder", help="e.g. ./stitches/2025-06-12T125334/")
+    parser.add_argument("--overlap", type=int, default=None, help="[px] instead of the one the tiles were taken with")
+    parser.add_argument("--workers", type=int, default=None, help="registration processes (all cores by default)")
+    parser.add_argument("--outlierPx", type=float, default=None)
+    parser.add_argument("--useMeasured", action="store_true", help="reuse the seams measured while mapping")
+    parser.add_argument("--curvature", type=int, default=None, help="for the fit. From the run's fit by default")
+    parser.add_argument("--upsample", type=int, default=None, help="sub-pixel seams, to 1/upsample px")
+    args = parser.parse_args()
+
+    restitch(args.runFolder, args.overlap, args.workers, args.outlierPx, args.useMeasured, args.curvature, args.upsample)
@@ -0,0 +1,89 @@
+import argparse
+import time
+import matplotlib
+
+matplotlib.use("Agg")  # headless
+
+from KoalaController import KoalaController
+from SimKoala import SimKoalaClient, SimSpecimen
+
+
+def timed(name, results, func, *args, **kwargs):
+    t0 = time.time()
+    out = func(*args, **kwargs)
+    results[name] = time.time() - t0
+    print(f"** {name}: {results[name]:.2f}s")
+    return out
+
+
+def run(
+    timeScale=1.0,
+    maxRadius=600,
+    curvature=1,
+    seed=0,
+    cacheName=None,
+    planned=False,
+    aperture=5_000,
+    deferred=False,
+    stageRotation=0.0,
+):
+    """Runs find_focus, traverseToExtreme and mapArea against the simulator and returns their timings.
+    Pass a cacheName to use (and fill) the focus cache under it, a second run then starts from it.
+    An aperture under maxRadius makes mapArea find the lens edge. stageRotation [deg] turns the simulated camera"""
+    specimen = SimSpecimen(curvature=curvature, aperture=aperture)
+    client = SimKoalaClient(specimen, timeScale=timeScale, seed=seed, stageRotation=stageRotation)
+    host = KoalaController(client=client, show=False, specimen=cacheName)
+    host.setup()
+    host.setLimit(h=8_000)
+    results = {}
+
+    # start off the apex and out of focus
+    x0, y0 = specimen.center
+    host.move_to(x0 + 0.3 * aperture, y0 - 0.16 * aperture, 1_000)
+    timed("find_focus", results, host.find_focus)
+    timed("traverseToExtreme", results, host.traverseToExtreme, dir=curvature)
+
+    areaMap = timed(
+        "mapArea",
+        results,
+        host.mapArea,
+        curvature=curvature,
+        circle=True,
+        maxRadius=maxRadius,
+        planned=planned,
+        deferred=deferred,
+    )
+    tiles = areaMap.numPics
+    results["tiles"] = tiles
+    results["tiles/minute"] = tiles / results["mapArea"] * 60
+    results["calls"] = dict(client.calls)
+    host.logout()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Hardware free throughput benchmark")
+    parser.add_argument("--timeScale", type=float, default=1.0, help="0 = no simulated latency")
+    parser.add_argument("--maxRadius", type=float, default=600)
+    parser.add_argument("--curvature", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--cacheName", default=None, help="specimen name for the focus cache")
+    parser.add_argument("--planned", action="store_true", help="mapArea visits a TilePlan")
+    parser.add_argument("--aperture", type=float, default=5_000, help="lens radius [um]")
+    parser.add_argument("--deferred", action="store_true", help="with --planned, solve all seams at the end")
+    parser.add_argument("--stageRotation", type=float, default=0.0, help="[deg] of the camera against the stage")
+    args = parser.parse_args()
+
+    results = run(
+        args.timeScale,
+        args.maxRadius,
+        args.curvature,
+        args.seed,
+        args.cacheName,
+        args.planned,
+        args.aperture,
+        args.deferred,
+        args.stageRotation,
+    )
+    for key, value in results.items():
+        print(f"{key}: {value:.2f}" if isinstance(value, float) else f"{key}: {value}")
@@ -1,5 +1,4 @@
 import json
-import struct
 from matplotlib import gridspec
 from scipy.ndimage import gaussian_filter
 import scipy.optimize as opt
@@ -7,6 +6,7 @@ import pathlib
 import matplotlib.pyplot as plt
 import numpy as np
 import time
+import phaseFile
 
 
 def plot3D(phase, pxSize, plane):
@@ -38,22 +38,7 @@ def load_phase_file(path=None):
     if path == None:
         path = str(basePath / "./tmp/phase.bin")
 
-    with open(path, "rb") as f:
-        hdr_ver, endian = struct.unpack("bb", f.read(2))
-        int32 = "<i" if endian == 0 else ">i"
-        float32 = "<f" if endian == 0 else ">f"
-        header_size = struct.unpack(int32, f.read(4))[0]
-        width = struct.unpack(int32, f.read(4))[0]
-        height = struct.unpack(int32, f.read(4))[0]
-        pxSize_um = struct.unpack(float32, f.read(4))[0] * 1e6
-        hconv = struct.unpack(float32, f.read(4))[0]  # * metres / radian
-        unit = struct.unpack("b", f.read(1))[0]
-        phase = np.fromfile(f, np.float32).reshape(height, width)
-
-    # [rad] * [m/rad] * [um/m]
-    if unit == 1:  # 1 = rad, 2 = m
-        phase = phase * hconv * 1e6
-    return phase, pxSize_um  # [um (height)], [um/px (x and y)]
+    return phaseFile.load(path)  # [um (height)], [um/px (x and y)]
 
 
 def compareXStitch():
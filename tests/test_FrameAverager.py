@@ -0,0 +1,21 @@
+import numpy as np
+
+from FrameAverager import FrameAverager
+
+
+def test_noiseAloneIsNotClipped():
+    rng = np.random.default_rng(0)
+    averager = FrameAverager((100, 100), clip=4)
+    for _ in range(12):
+        assert averager.add(rng.normal(0, 1, (100, 100)))
+    assert averager.rejected == 0
+    assert np.mean(averager.count < 12) < 0.01
+
+
+def test_smearedFrameIsRejected():
+    rng = np.random.default_rng(0)
+    averager = FrameAverager((100, 100), clip=4)
+    for _ in range(FrameAverager.minClipCount):
+        averager.add(rng.normal(0, 1, (100, 100)))
+    assert not averager.add(rng.normal(0, 1, (100, 100)) + 20)
+    assert averager.rejected == 1
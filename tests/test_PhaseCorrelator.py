@@ -0,0 +1,29 @@
+import numpy as np
+
+from PhaseCorrelator import PhaseCorrelator
+
+
+def seam(shift, fixedPattern=0.0, shape=(25, 800), seed=0):
+    """Two strips of the same texture, the second registering onto the first with shift (dy, dx), plus a pattern that
+    doesn't move with the specimen (camera, reference hologram), which peaks at zero shift"""
+    rng = np.random.default_rng(seed)
+    texture = rng.normal(size=(shape[0] + 40, shape[1] + 40))
+    fixed = fixedPattern * rng.normal(size=shape)
+    reference = texture[20 : 20 + shape[0], 20 : 20 + shape[1]] + fixed
+    moving = texture[20 + shift[0] : 20 + shift[0] + shape[0], 20 + shift[1] : 20 + shift[1] + shape[1]] + fixed
+    return reference, moving
+
+
+def test_priorNearTheShift():
+    reference, moving = seam((2, -3))
+    shift = PhaseCorrelator(reference.shape)(reference, moving, prior=(1, -1))[0]
+    assert tuple(shift) == (2, -3)
+
+
+def test_priorOffFallsBackToTheGlobalPeak():
+    # the window around the prior holds the zero shift peak, not the true one 8 px away
+    reference, moving = seam((0, 3), fixedPattern=0.7)
+    correlator = PhaseCorrelator(reference.shape)
+    shift = correlator(reference, moving, prior=(0, -5))[0]
+    assert tuple(shift) == (0, 3)
+    assert correlator.fallbacks == 1
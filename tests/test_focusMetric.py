@@ -0,0 +1,24 @@
+import numpy as np
+
+from focusMetric import MetricCalibration
+
+
+def calibrated():
+    metric = MetricCalibration()
+    metric.calibrate([1e-4, 1e-3, 1e-2, 1e-1], [1.5, 3.0, 4.5, 6.0])
+    return metric
+
+
+def test_allNanTileFailsFocusChecks():
+    metric = calibrated()
+    cont = metric.contrast(np.full((80, 80), np.nan))
+    assert cont == -np.inf
+    assert not (cont >= 1.5)
+
+
+def test_partialTileStillScored():
+    metric = calibrated()
+    rng = np.random.default_rng(0)
+    tile = rng.normal(0, 0.05, (80, 80))
+    tile[:, :40] = np.nan
+    assert np.isfinite(metric.contrast(tile))
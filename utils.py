@@ -15,15 +15,27 @@ def fit_plane(phase, pxSize):
     # [px] * [um/px]
     Y_sub, X_sub = np.mgrid[0:ny:step, 0:nx:step] * pxSize
     A = np.column_stack((X_sub.ravel(), Y_sub.ravel(), np.ones(phase_ds.size)))
+    valid = ~np.isnan(phase_ds.ravel())  # off the specimen edge
+    if np.count_nonzero(valid) < 3:
+        return 0.0, 0.0, np.nan
 
     # A [um] * x [.] = phase [um]
-    x, *_ = np.linalg.lstsq(A, phase_ds.ravel(), rcond=None)
+    x, *_ = np.linalg.lstsq(A[valid], phase_ds.ravel()[valid], rcond=None)
     a, b, c = x
 
     # a = dz/dx [um/um]    b = dz/dy [um/um]    c = height at (x=0, y=0) [um]
     return a, b, c
 
 
+def stageToPx(stageDelta, pxSize, calibration=None):
+    """(dRow, dCol) [px] the picture moves for a stage move of (dx, dy) [um]. Stage +x is right, +y is down, unless
+    calibration (StageCalibration) knows better"""
+    if calibration is not None:
+        return calibration.toPx(stageDelta)
+    dx, dy = np.asarray(stageDelta[:2], float) / pxSize
+    return np.array((dy, dx))
+
+
 def getZDiff(shift, f1Area, f2Area):
     dy, dx = shift
     """Takes 2 overlaped reigons and the 2nd area's relative offset, and returns the difference in their means of their overlapped regions"""
@@ -43,6 +55,10 @@ def getZDiff(shift, f1Area, f2Area):
 
     trim_percent = 40
     diff = a1 - a2
+    diff = diff[~np.isnan(diff)]  # off the lens in either
+    if diff.size == 0:
+        print(f"Stitch has dx={dx}, dy={dy}, no overlap on the lens to level it, zDiff=0")
+        return 0.0
     lower = np.percentile(diff, trim_percent)
     upper = np.percentile(diff, 100 - trim_percent)
     trimmed = diff[(diff >= lower) & (diff <= upper)]